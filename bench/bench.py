@@ -0,0 +1,316 @@
+"""
+Benchmark of taskmasterd: generate a configuration of N services x M processes,
+run the daemon on it and measure
+
+- cold start: until every process is RUNNING
+- reload: response time and time until every process is RUNNING again, with 0%, 1% and 100% of the services changed
+- round-trip time of status (all / one service) and start through the unix socket
+- restart storm: every process SIGKILLed, until they are all RUNNING again (autorestart)
+- idle CPU of the daemon once everything runs
+
+The results are printed in JSON (and written to --output) to compare versions.
+"""
+import argparse, json, math, os, pathlib, platform, shutil, signal, socket, statistics, struct, subprocess, sys, tempfile, time
+from typing import Dict, List, Optional, Set, Tuple
+import yaml
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+DAEMON = ROOT / "src/server/taskmasterd.py"
+
+# Control protocol (see src/server/control.py): payload length and request id, then the payload
+HEADER = struct.Struct("!II")
+
+TAIL: int = 20  # Lines of the log shown when taskmasterd fails to start
+SLEEP: int = 1000000  # Command of the services: sleep <SLEEP + generation>
+PROBES: int = 20  # Services (cmd: true) started by the start round-trip benchmark
+
+
+class Control:
+    """Blocking client of the control socket"""
+
+    def __init__(self, path: str, timeout: float):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(path)
+        self.request_id: int = 0
+
+    def recv_exactly(self, size: int) -> bytes:
+        chunks: List[bytes] = []
+        while size > 0:
+            chunk = self.sock.recv(min(size, 1 << 20))
+            if not chunk:
+                raise ConnectionError("taskmasterd closed the connection")
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b"".join(chunks)
+
+    def request(self, message: str) -> Tuple[str, float]:
+        """Send a command, return its response and the round-trip time"""
+        self.request_id += 1
+        payload = message.encode()
+        start: float = time.perf_counter()
+        self.sock.sendall(HEADER.pack(len(payload), self.request_id) + payload)
+        while True:
+            length, request_id = HEADER.unpack(self.recv_exactly(HEADER.size))
+            response = self.recv_exactly(length)
+            if request_id == self.request_id:
+                return response.decode(), time.perf_counter() - start
+
+    def close(self) -> None:
+        self.sock.close()
+
+
+def summary(samples: List[float]) -> Dict[str, float]:
+    """Statistics of durations in milliseconds"""
+    ordered = sorted(samples)
+
+    def percentile(p: float) -> float:
+        return ordered[min(len(ordered) - 1, math.ceil(p / 100 * len(ordered)) - 1)] * 1000
+
+    return {
+        "count": len(ordered),
+        "min_ms": ordered[0] * 1000,
+        "median_ms": statistics.median(ordered) * 1000,
+        "p90_ms": percentile(90),
+        "p99_ms": percentile(99),
+        "max_ms": ordered[-1] * 1000,
+        "mean_ms": statistics.fmean(ordered) * 1000,
+    }
+
+
+class Bench:
+    def __init__(self, args: argparse.Namespace, workdir: str):
+        self.args = args
+        self.workdir: str = workdir
+        self.config_path: str = os.path.join(workdir, "bench.yml")
+        self.socket_path: str = os.path.join(workdir, "taskmaster.sock")
+        self.state_path: str = os.path.join(workdir, "taskmaster.state")
+        self.log_path: str = os.path.join(workdir, "taskmaster.log")
+        self.stderr_path: str = os.path.join(workdir, "taskmasterd.stderr")  # tracebacks before the logger
+        self.generations: List[int] = [0] * args.services  # cmd of each service
+        self.daemon: Optional[subprocess.Popen] = None
+        self.ctl: Optional[Control] = None
+
+    @property
+    def total(self) -> int:
+        return self.args.services * self.args.numprocs
+
+    def write_config(self) -> None:
+        services: List[Dict] = [
+            {
+                "name": f"svc{i}",
+                "cmd": f"sleep {SLEEP + generation}",
+                "numprocs": self.args.numprocs,
+                "starttime": 0,
+                "stoptime": 2,
+            }
+            for i, generation in enumerate(self.generations)
+        ]
+        services += [
+            {
+                "name": f"probe{i}",
+                "cmd": "true",
+                "autostart": False,
+                "autorestart": "never",
+                "starttime": 0,
+            }
+            for i in range(PROBES)
+        ]
+        config: Dict = {
+            "server": {
+                "unixsocket": self.socket_path,
+                "statefile": self.state_path,
+                "spawnconcurrency": self.args.spawnconcurrency,
+            },
+            "services": services,
+        }
+        tmp: str = self.config_path + ".tmp"
+        with open(tmp, "w") as f:
+            yaml.safe_dump(config, f, sort_keys=False)
+        os.replace(tmp, self.config_path)
+
+    def running(self) -> Tuple[int, Set[int]]:
+        """Number of RUNNING processes of the svc services and their pids"""
+        response, _ = self.ctl.request("status")
+        count: int = 0
+        pids: Set[int] = set()
+        for line in response.splitlines():
+            fields = line.split()
+            if len(fields) >= 4 and fields[0].startswith("svc") and fields[1] == "RUNNING":
+                count += 1
+                pids.add(int(fields[3].rstrip(",")))
+        return count, pids
+
+    def wait_running(self, start: float, old_pids: Set[int] = frozenset()) -> float:
+        """Seconds from start until every process is RUNNING (with none of old_pids)"""
+        deadline: float = time.perf_counter() + self.args.timeout
+        while time.perf_counter() < deadline:
+            count, pids = self.running()
+            if count == self.total and not pids & old_pids:
+                return time.perf_counter() - start
+            time.sleep(self.args.poll)
+        raise TimeoutError(f"processes not all RUNNING after {self.args.timeout} s")
+
+    def cold_start(self) -> Dict:
+        self.write_config()
+        start: float = time.perf_counter()
+        with open(self.stderr_path, "wb") as stderr:
+            self.daemon = subprocess.Popen(
+                [sys.executable, str(DAEMON), self.config_path, "-l", "WARNING"],
+                cwd=DAEMON.parent,
+                env={**os.environ, "TASKMASTER_LOG": self.log_path},  # not in the log/ of the repository
+                stdout=subprocess.DEVNULL,
+                stderr=stderr,
+            )
+        while True:
+            try:
+                self.ctl = Control(self.socket_path, self.args.timeout)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if self.daemon.poll() is not None:
+                    raise RuntimeError(f"taskmasterd exited at startup, see {self.log_path}:\n{self.log_tail()}")
+                if time.perf_counter() - start > self.args.timeout:
+                    raise TimeoutError("taskmasterd is not listening")
+                time.sleep(0.01)
+        listening: float = time.perf_counter() - start
+        return {"listening_s": listening, "all_running_s": self.wait_running(start)}
+
+    def log_tail(self) -> str:
+        lines: List[str] = []
+        for path in (self.log_path, self.stderr_path):
+            try:
+                with open(path, errors="replace") as f:
+                    lines += f.readlines()[-TAIL:]
+            except OSError:
+                pass
+        return "".join(lines[-TAIL:])
+
+    def reload(self, fraction: float) -> Dict:
+        changed: int = math.ceil(self.args.services * fraction)
+        for i in range(changed):
+            self.generations[i] += 1
+        self.write_config()
+        start: float = time.perf_counter()
+        _, rtt = self.ctl.request("reload")
+        return {
+            "changed_services": changed,
+            "response_ms": rtt * 1000,
+            "all_running_s": self.wait_running(start) if changed else 0,
+        }
+
+    def round_trips(self) -> Dict:
+        results: Dict = {}
+        for name, command in (("status_all", "status"), ("status_one", "status svc0")):
+            samples: List[float] = [self.ctl.request(command)[1] for _ in range(self.args.rtt)]
+            results[name] = summary(samples)
+        samples = [self.ctl.request(f"start probe{i % PROBES}")[1] for i in range(self.args.rtt)]
+        results["start"] = summary(samples)
+        return results
+
+    def restart_storm(self) -> Dict:
+        _, pids = self.running()
+        start: float = time.perf_counter()
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        return {"killed": len(pids), "all_running_s": self.wait_running(start, pids)}
+
+    def idle_cpu(self) -> Dict:
+        def cpu_ticks() -> int:
+            with open(f"/proc/{self.daemon.pid}/stat", "rb") as f:
+                fields = f.read().rsplit(b")", 1)[1].split()
+            return int(fields[11]) + int(fields[12])
+
+        time.sleep(self.args.settle)
+        before: int = cpu_ticks()
+        start: float = time.perf_counter()
+        time.sleep(self.args.idle)
+        seconds: float = (cpu_ticks() - before) / os.sysconf("SC_CLK_TCK")
+        return {"cpu_seconds_per_second": seconds / (time.perf_counter() - start)}
+
+    def shutdown(self) -> None:
+        if self.ctl is not None:
+            try:
+                self.ctl.request("shutdown")
+            except OSError:
+                pass
+            self.ctl.close()
+        if self.daemon is not None:
+            try:
+                self.daemon.wait(timeout=self.args.timeout)
+            except subprocess.TimeoutExpired:
+                self.daemon.kill()
+                self.daemon.wait()
+
+    def run(self) -> Dict:
+        results: Dict = {}
+        try:
+            results["cold_start"] = self.cold_start()
+            results["idle"] = self.idle_cpu()
+            results["round_trip"] = self.round_trips()
+            results["reload"] = {
+                "unchanged": self.reload(0),
+                "changed_1pct": self.reload(0.01),
+                "changed_100pct": self.reload(1),
+            }
+            results["restart_storm"] = self.restart_storm()
+        finally:
+            self.shutdown()
+        return results
+
+
+def revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def startup_parsing() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark taskmasterd and print the results in JSON")
+    parser.add_argument("-n", "--services", type=int, default=100, help="Number of services (100)")
+    parser.add_argument("-m", "--numprocs", type=int, default=2, help="Processes per service (2)")
+    parser.add_argument("--rtt", type=int, default=200, help="Requests per round-trip benchmark (200)")
+    parser.add_argument("--idle", type=float, default=5, help="Seconds of idle CPU measure (5)")
+    parser.add_argument("--settle", type=float, default=1, help="Seconds to wait before the idle measure (1)")
+    parser.add_argument("--spawnconcurrency", type=int, default=8, help="'spawnconcurrency' of the server (8)")
+    parser.add_argument("--poll", type=float, default=0.05, help="Seconds between two status while waiting (0.05)")
+    parser.add_argument("--timeout", type=float, default=120, help="Seconds before giving up a step (120)")
+    parser.add_argument("-o", "--output", help="Also write the JSON results to this file")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = startup_parsing()
+    workdir: str = tempfile.mkdtemp(prefix="taskmaster-bench-")
+    try:
+        results: Dict = {
+            "revision": revision(),
+            "python": platform.python_version(),
+            "cpus": os.cpu_count(),
+            "parameters": {
+                "services": args.services,
+                "numprocs": args.numprocs,
+                "processes": args.services * args.numprocs,
+                "rtt_requests": args.rtt,
+                "spawnconcurrency": args.spawnconcurrency,
+            },
+            "results": Bench(args, workdir).run(),
+        }
+    except BaseException:
+        print(f"bench: configuration and logs kept in {workdir}", file=sys.stderr)
+        raise
+    shutil.rmtree(workdir, ignore_errors=True)
+    output: str = json.dumps(results, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
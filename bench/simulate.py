@@ -0,0 +1,166 @@
+"""
+Benchmark of the supervision logic of taskmasterd on simulated processes
+(src/server/simulation.py): no fork, the clock is virtual, so 100k processes
+and hours of supervision run in seconds.
+
+The services mix scripted behaviors:
+- stable: runs until stopped
+- flaky: exits with code 1 after a random lifetime (conditional restart)
+- crashloop: exits before its starttime (BACKOFF until FATAL)
+- stubborn: ignores its stopsignal (SIGKILL after stoptime)
+
+Phases: start of every process (until none is STARTING or in BACKOFF),
+--duration virtual seconds of supervision, then a shutdown. Reported per
+phase: iterations of the loop, their wall cost (the supervision work of one
+server loop iteration), the state transitions and the transitions per wall
+second. The results are printed in JSON (and
+written to --output) to compare versions.
+"""
+import argparse, json, logging, math, pathlib, platform, statistics, subprocess, sys, time
+from typing import Dict, List, Optional
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "src/server"))
+
+from simulation import Behavior, Simulation  # noqa: E402
+from registry import registry  # noqa: E402
+from process import State  # noqa: E402
+from logger import logger, stop_logging  # noqa: E402
+
+BEHAVIORS: Dict[str, Behavior] = {
+    "stable": Behavior(spawn_delay=(0.001, 0.01), stop_delay=(0, 0.5)),
+    "flaky": Behavior(lifetime=(30, 600), exitcode=1, spawn_delay=(0.001, 0.01), stop_delay=(0, 0.5)),
+    "crashloop": Behavior(lifetime=(0, 0.5), exitcode=2, spawn_delay=(0.001, 0.01)),
+    "stubborn": Behavior(spawn_delay=(0.001, 0.01), ignore_stop=True),
+}
+MIX: Dict[str, float] = {"stable": 0.70, "flaky": 0.20, "crashloop": 0.05, "stubborn": 0.05}  # share of the services
+
+
+def configuration(services: int, numprocs: int) -> Dict:
+    names: List[str] = []
+    for behavior, share in MIX.items():
+        names += [behavior] * round(services * share)
+    names = (names + ["stable"] * services)[:services]
+    return {
+        "services": [
+            {
+                "name": f"{behavior}{i}",
+                "cmd": behavior,
+                "numprocs": numprocs,
+                "starttime": 1,
+                "startretries": 3,
+                "stoptime": 5,
+            }
+            for i, behavior in enumerate(names)
+        ]
+    }
+
+
+class Phase:
+    """Measures of a part of the simulation"""
+
+    def __init__(self, sim: Simulation):
+        self.sim = sim
+        self.ticks: int = sim.ticks
+        self.transitions: int = registry.transitions
+        self.virtual: float = sim.clock.now()
+        self.wall: float = time.perf_counter()
+
+    def results(self) -> Dict:
+        wall: float = time.perf_counter() - self.wall
+        costs: List[float] = sorted(self.sim.tick_seconds[self.ticks :])
+        transitions: int = registry.transitions - self.transitions
+        virtual: float = self.sim.clock.now() - self.virtual
+        results: Dict = {
+            "virtual_s": virtual,
+            "wall_s": wall,
+            "speedup": virtual / wall if wall else None,
+            "iterations": len(costs),
+            "transitions": transitions,
+            "transitions_per_s": transitions / wall if wall else None,
+        }
+        if costs:
+            results["iteration_us"] = {
+                "mean": statistics.fmean(costs) * 1e6,
+                "median": statistics.median(costs) * 1e6,
+                "p99": costs[min(len(costs) - 1, math.ceil(0.99 * len(costs)) - 1)] * 1e6,
+                "max": costs[-1] * 1e6,
+            }
+        return results
+
+
+def states() -> Dict[str, int]:
+    return {state.value: len(processes) for state, processes in registry.states.items() if processes}
+
+
+def run(args: argparse.Namespace) -> Dict:
+    sim = Simulation(configuration(args.services, args.numprocs), BEHAVIORS, args.seed, args.resolution)
+    results: Dict = {}
+
+    phase = Phase(sim)
+    sim.start()
+    sim.run(args.timeout, until=lambda: not registry.states[State.STARTING] and not registry.states[State.BACKOFF])
+    results["start"] = phase.results()
+
+    phase = Phase(sim)
+    sim.run(args.duration)
+    results["supervision"] = phase.results()
+    results["supervision"]["states"] = states()
+
+    phase = Phase(sim)
+    sim.daemon.request_shutdown(0)
+    terminated: bool = sim.run(args.timeout, until=sim.master.is_terminated)
+    results["shutdown"] = phase.results()
+    results["shutdown"]["terminated"] = terminated
+    results["spawns"] = sim.backend.spawns
+    return results
+
+
+def revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def startup_parsing() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Simulate taskmasterd on fake processes and print the results in JSON")
+    parser.add_argument("-n", "--services", type=int, default=100, help="Number of services (100)")
+    parser.add_argument("-m", "--numprocs", type=int, default=1000, help="Processes per service (1000)")
+    parser.add_argument("-d", "--duration", type=float, default=600, help="Virtual seconds of supervision (600)")
+    parser.add_argument("--resolution", type=float, default=0.01, help="Events closer than this are handled together (0.01)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the random behaviors (0)")
+    parser.add_argument("--timeout", type=float, default=600, help="Virtual seconds before giving up the start or the shutdown (600)")
+    parser.add_argument("-o", "--output", help="Also write the JSON results to this file")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = startup_parsing()
+    logger.setLevel(logging.CRITICAL + 1)  # 100k processes: the log would be the benchmark
+    results: Dict = {
+        "revision": revision(),
+        "python": platform.python_version(),
+        "parameters": {
+            "services": args.services,
+            "numprocs": args.numprocs,
+            "processes": args.services * args.numprocs,
+            "duration_s": args.duration,
+            "resolution_s": args.resolution,
+            "seed": args.seed,
+            "mix": MIX,
+        },
+        "results": run(args),
+    }
+    output: str = json.dumps(results, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    stop_logging()
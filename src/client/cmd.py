@@ -2,12 +2,18 @@ valid_cmds = {
     "start": "Start the mentionned program present in the configuration file",
     "stop": "Stop the mentionned program present in the configuration file",
     "restart": "Restart the mentionned program present in the configuration file",
-    "status": "Displays the status of all the services present in the configuration file",
+    "status": "Displays the status of all the services present in the configuration file (with -v, the CPU and memory usage of the processes): status [-v] [--json] [--state STATE[,STATE]] [--since TOKEN] [service|glob ...] (--since: only the processes changed after the snapshot of this token, the generation of a previous status)",
+    "top": "Display the processes using the most CPU: top [-n N] [--rss] (sorted by memory with --rss)",
     "avail": "Displays the list of available services present in the configuration file",
     "availx": "Displays the list of available services with their extended information",
     "availxl": "Displays the list of available services with their extended information ad default values",
+    "batch": "Run several commands separated by ';' in one request (e.g. batch stop web ; start worker)",
+    "tail": "Display the last lines of a process output: tail <process> [-n N] [--stderr] (services with 'capture'). With -f, follow the stdout (or stderr) file until Ctrl-C",
+    "subscribe": "Print the state transitions of the processes as they happen until Ctrl-C (one JSON line each): subscribe [--state STATE[,STATE]] [service|glob ...]",
+    "profile": "Profile the server: profile start [seconds] | stop (writes a pstats file) | stats (time per callback of the server loop, see 'slowcallback')",
     "help": "Display the list of valid commands with their description",
     "reload": "Reload the configuration (be careful to reload when configuration file change. Otherwise, changes will be ignored)",
+    "upgrade": "Re-execute taskmasterd (e.g. new version) without restarting the processes: the new one keeps the control sockets and adopts them, then answers",
     "exit": "Exit interactive controller",
     "shutdown": "Shutdown the server exiting gracefully all managed processes",
 }
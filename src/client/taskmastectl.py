@@ -1,51 +1,250 @@
-import socket, readline
+import socket, readline, struct, sys, argparse, itertools, os, pathlib
+from typing import Dict, List, Tuple
 from cmd import is_valid_cmd, print_short_help, print_large_help
 
+# Every message (both ways) is a header followed by the utf-8 payload.
+# Header: payload length and request id (4 bytes big-endian each).
+HEADER = struct.Struct("!II")
 
-def run_client(host="127.0.0.1", port=65432):
-    sock = None
+# Max number of requests sent without having received their response
+PIPELINE_WINDOW: int = 64
+
+# Default unix socket of taskmasterd: in its log directory (see logger.PATH_LOG_FILE of the server)
+DEFAULT_SOCKET: str = os.path.join(
+    os.path.dirname(os.environ.get("TASKMASTER_LOG") or pathlib.Path(__file__).parent.parent.parent / "log/taskmaster.log"),
+    "taskmaster.sock",
+)
+
+request_ids = itertools.count(1)
+
+
+def send_message(sock: socket.socket, message: str) -> int:
+    """Send a request and return its id."""
+    request_id: int = next(request_ids)
+    payload = message.encode()
+    sock.sendall(HEADER.pack(len(payload), request_id) + payload)
+    return request_id
+
+
+def recv_exactly(sock: socket.socket, size: int) -> bytes:
+    """Read exactly size bytes. Return b"" if the server closed the connection."""
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(min(size, 65536))
+        if not chunk:
+            return b""
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def recv_frame(sock: socket.socket) -> Tuple[int, bytes] | None:
+    """Read one complete frame and its request id. None if the server closed the connection."""
+    header = recv_exactly(sock, HEADER.size)
+    if not header:
+        return None
+    length, request_id = HEADER.unpack(header)
+    payload = recv_exactly(sock, length)
+    if length and not payload:
+        return None
+    return request_id, payload
+
+
+def recv_message(sock: socket.socket) -> Tuple[int, str] | None:
+    """Read one complete response and its request id. None if the server closed the connection."""
+    response = recv_frame(sock)
+    if response is None:
+        return None
+    return response[0], response[1].decode()
+
+
+def is_follow(command: str) -> bool:
+    """tail -f and subscribe: the server streams on the connection"""
+    words = command.split()
+    return words[0] == "subscribe" or (words[0] == "tail" and "-f" in words[1:])
+
+
+def follow(sock: socket.socket, command: str) -> int:
+    """Run tail -f or subscribe: print the stream as it comes until Ctrl-C.
+    The first response is a "==> ... <==" header, anything else is an error.
+
+    Returns:
+        int: the exit status (0 on success)
+    """
+    request_id: int = send_message(sock, command)
+    response = recv_message(sock)
+    if response is None:
+        print("Server closed the connection", file=sys.stderr)
+        return 1
+    print(response[1])
+    if not response[1].startswith("==>"):
+        return 1
     try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.connect((host, port))
         while True:
-            message = input("\033[1mtaskmasterctl>\033[0m (try 'help'): ")
-            if not message:
-                continue
-            message = message[:8192]
-            if is_valid_cmd(message) is False:
-                print_short_help()
-                continue
-            if message.split()[0] == "help":
-                print_large_help()
+            frame = recv_frame(sock)
+            if frame is None:
+                print("Server closed the connection", file=sys.stderr)
+                return 1
+            if frame[0] == request_id:
+                sys.stdout.buffer.write(frame[1])
+                sys.stdout.buffer.flush()
+    except KeyboardInterrupt:
+        return 0
+
+
+def run_commands(sock: socket.socket, commands: List[str]) -> int:
+    """Pipeline the commands on one connection and print the responses in order.
+
+    Returns:
+        int: the exit status (0 on success)
+    """
+    pending: Dict[int, int] = {}  # {request id: command index}
+    responses: Dict[int, str] = {}  # {command index: response}
+    next_to_print: int = 0
+    status: int = 0
+
+    def receive_one() -> bool:
+        response = recv_message(sock)
+        if response is None:
+            print("Server closed the connection", file=sys.stderr)
+            return False
+        request_id, data = response
+        if request_id in pending:
+            responses[pending.pop(request_id)] = data
+        return True
+
+    for index, command in enumerate(commands):
+        if command.split() and is_follow(command) and index != len(commands) - 1:
+            responses[index] = f"{command.split()[0]}: ERROR (must be the last command)"
+            status = 1
+        elif command.split() and is_follow(command):
+            while pending:
+                if not receive_one():
+                    return 1
+            while next_to_print in responses:
+                print(responses.pop(next_to_print))
+                next_to_print += 1
+            return follow(sock, command) or status
+        elif not command.split() or not is_valid_cmd(command):
+            responses[index] = f"Invalid command: {command}"
+            status = 1
+        elif command.split()[0] in ("help", "exit"):
+            responses[index] = ""
+        else:
+            pending[send_message(sock, command)] = index
+        while len(pending) >= PIPELINE_WINDOW:
+            if not receive_one():
+                return 1
+        while next_to_print in responses:
+            print(responses.pop(next_to_print))
+            next_to_print += 1
+    while pending:
+        if not receive_one():
+            return 1
+    while next_to_print in responses:
+        print(responses.pop(next_to_print))
+        next_to_print += 1
+    return status
+
+
+def run_interactive(sock: socket.socket, address: str | Tuple[str, int]) -> None:
+    while True:
+        message = input("\033[1mtaskmasterctl>\033[0m (try 'help'): ")
+        if not message:
+            continue
+        if is_valid_cmd(message) is False:
+            print_short_help()
+            continue
+        if message.split()[0] == "help":
+            print_large_help()
+            continue
+        readline.add_history(message)
+        if message.split()[0] == "exit":
+            break
+        try:
+            if is_follow(message):
+                follow(sock, message)
+                # The server keeps streaming on this connection: open a new one
+                sock.close()
+                sock = socket.socket(sock.family, socket.SOCK_STREAM)
+                sock.connect(address)
                 continue
-            readline.add_history(message)
-            if message.split()[0] == "exit":
-                break
-            try:
-                sock.sendall(message.encode())
-                data = sock.recv(8192)
-                if not data:
-                    print("Server closed the connection, you are disconnected")
-                    break
-                print(f"{data.decode()}")
-            except (ConnectionResetError, BrokenPipeError):
-                print("Connection lost with server")
-                break
-            except Exception as e:
-                print(f"Communication error: {e}")
+            send_message(sock, message)
+            response = recv_message(sock)
+            if response is None:
+                print("Server closed the connection, you are disconnected")
                 break
+            print(f"{response[1]}")
+        except (ConnectionResetError, BrokenPipeError):
+            print("Connection lost with server")
+            break
+        except Exception as e:
+            print(f"Communication error: {e}")
+            break
+    sock.close()
+
 
-    except ConnectionRefusedError:
+def run_client(
+    address: str | Tuple[str, int] = DEFAULT_SOCKET, commands: List[str] | None = None
+) -> int:
+    """Run the controller.
+    address: path of the unix socket or (host, port) for TCP
+    commands: run these commands and exit. Interactive mode if None.
+    """
+    sock = None
+    status: int = 0
+    try:
+        if isinstance(address, str):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.connect(address)
+        if commands is None:
+            run_interactive(sock, address)
+        else:
+            status = run_commands(sock, commands)
+    except (ConnectionRefusedError, FileNotFoundError):
         print("Server is not running")
+        status = 1
     except KeyboardInterrupt:
         print("Client shutdown by user")
     except Exception as e:
         print(f"Unexpected error: {e}")
+        status = 1
     finally:
         if sock:
             sock.close()
-        print("Interactive controller exited")
+        if commands is None:
+            print("Interactive controller exited")
+    return status
+
+
+def startup_parsing() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Control a taskmaster daemon. Interactive if no command is given and stdin is a terminal."
+    )
+    parser.add_argument(
+        "command",
+        nargs=argparse.REMAINDER,
+        help="Run this command and exit (e.g. status web worker). '-' reads one command per line from stdin.",
+    )
+    parser.add_argument(
+        "-s",
+        "--socket",
+        default=DEFAULT_SOCKET,
+        help=f"Unix socket of the server ({DEFAULT_SOCKET} if not specified)",
+    )
+    parser.add_argument("-H", "--host", help="Connect with TCP to this address instead of the unix socket")
+    parser.add_argument("-p", "--port", default=65432, type=int, help="TCP port (65432 if not specified)")
+    return parser.parse_args()
 
 
 if __name__ == "__main__":
-    run_client()
+    args = startup_parsing()
+    commands: List[str] | None = None
+    if args.command == ["-"] or (not args.command and not sys.stdin.isatty()):
+        commands = [line.strip() for line in sys.stdin if line.strip()]
+    elif args.command:
+        commands = [" ".join(args.command)]
+    address = (args.host, args.port) if args.host else args.socket
+    sys.exit(run_client(address, commands))
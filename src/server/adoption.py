@@ -0,0 +1,292 @@
+import json, math, os, selectors, signal, stat, time
+from typing import Dict, List, Optional, Tuple
+from logger import logger, PATH_LOG_FILE
+from loop import sel
+from registry import registry
+from timers import timers, Timer
+
+STATE_VERSION: int = 1
+WRITE_DELAY: float = 1.0  # Seconds between a change of a process and the write of the state file
+UNKNOWN_EXITCODE: int = 255  # Exit code of an adopted process which is not our child (reaped by init)
+UPGRADE_ENV: str = "TASKMASTER_UPGRADE"  # {"fds": [...], "state": path} given to the new taskmasterd by upgrade
+ADOPTED_STATES = ("STARTING", "RUNNING", "STOPPING")
+STATE_DIR: str = os.path.dirname(PATH_LOG_FILE)  # default state file and state given by upgrade, next to the log
+# record: [name, pid, start time, hash, state, since, changedate]
+RECORD_TYPES = (str, int, int, str, str, (int, float), (int, float))
+
+
+def boot_id() -> str:
+    """Identifier of the current boot: the pids and start times of another boot mean nothing"""
+    try:
+        with open("/proc/sys/kernel/random/boot_id") as f:
+            return f.read().strip()
+    except OSError:
+        return ""
+
+
+def read_stat(pid: int) -> Optional[Tuple[str, int, int]]:
+    """
+    (state, ppid, start time in clock ticks since the boot) of pid from
+    /proc/<pid>/stat, None if the pid is gone
+    """
+    try:
+        with open(f"/proc/{pid}/stat", "rb") as f:
+            data: bytes = f.read()
+    except OSError:
+        return None
+    # The command name (field 2) may contain spaces: split after its ')'
+    fields: List[bytes] = data[data.rfind(b")") + 2 :].split()
+    try:
+        return fields[0].decode(), int(fields[1]), int(fields[19])
+    except (IndexError, ValueError):
+        return None
+
+
+def start_time(pid: int) -> Optional[int]:
+    """Start time of pid if it is alive (None if it is gone or a zombie)"""
+    stat = read_stat(pid)
+    return stat[2] if stat is not None and stat[0] != "Z" else None
+
+
+class AdoptedProc:
+    """
+    Stand-in for subprocess.Popen of a process started by a previous taskmasterd.
+    Still our child after an upgrade (exec keeps the pid): reaped by the usual
+    waitpid() sweep. Otherwise (taskmasterd crashed, the process was reparented)
+    its exit is watched through a pidfd in the selector; the exit code is lost.
+    """
+
+    __slots__ = ("pid", "returncode", "child", "pidfd", "process")
+
+    def __init__(self, pid: int, child: bool, process):
+        self.pid: int = pid
+        self.returncode: Optional[int] = None  # set once reaped, like Popen
+        self.child: bool = child
+        self.pidfd: Optional[int] = None
+        self.process = process
+        if not child:
+            self.pidfd = os.pidfd_open(pid)
+            sel.register(self.pidfd, selectors.EVENT_READ, data=self.on_exit)
+
+    def on_exit(self, fd: int, mask: int) -> None:
+        self.close()
+        self.returncode = UNKNOWN_EXITCODE
+        if registry.pop_pid(self.pid) is not None:
+            registry.mark_due(self.process)
+
+    def close(self) -> None:
+        if self.pidfd is not None:
+            sel.unregister(self.pidfd)
+            os.close(self.pidfd)
+            self.pidfd = None
+
+    def poll(self) -> Optional[int]:
+        if self.returncode is None and self.child:
+            try:
+                pid, status = os.waitpid(self.pid, os.WNOHANG)
+            except ChildProcessError:
+                return self.returncode
+            if pid == self.pid:
+                self.returncode = os.waitstatus_to_exitcode(status)
+        return self.returncode
+
+    def send_signal(self, sig: int) -> None:
+        if self.returncode is not None:
+            return
+        try:
+            if self.pidfd is not None:
+                signal.pidfd_send_signal(self.pidfd, sig)  # never another process reusing the pid
+            else:
+                os.kill(self.pid, sig)
+        except ProcessLookupError:
+            pass
+
+    def kill(self) -> None:
+        self.send_signal(signal.SIGKILL)
+
+
+class ChildTracker:
+    """
+    State file of the live processes (pid, start time, hash of the service) so
+    that the next taskmasterd, after a crash or an upgrade, adopts them instead
+    of starting them again. Written (atomically) WRITE_DELAY after a change,
+    removed once taskmasterd stopped every process. A saved process is adopted
+    if its service didn't change and its pid still has the same start time
+    (/proc/<pid>/stat: not a reused pid). The processes of a service with
+    'capture' or 'events' are stopped and started again: their pipes were
+    closed with the previous taskmasterd.
+    """
+
+    def __init__(self):
+        self.path: str = ""
+        self.records: Dict[str, List] = {}  # {process name: record} loaded, not adopted yet
+        self.orphans: List[List] = []  # records of the live processes not adopted
+        self.starttimes: Dict[int, int] = {}  # {pid: start time} of the processes written
+        self.generation: int = -1  # registry.generation of the last write
+        self.timer: Optional[Timer] = None
+
+    def configure(self, path: str) -> None:
+        self.path = path
+
+    def load(self, path: str) -> None:
+        """
+        Read the records of a previous taskmasterd (nothing if the file doesn't
+        exist). The file decides which pids are signalled: it must belong to the
+        user of taskmasterd and be writable by nobody else.
+        """
+        try:
+            fd: int = os.open(path, os.O_RDONLY | os.O_NOFOLLOW)
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            logger.error(f"Can't read the state file {path}: {e}")
+            return
+        with os.fdopen(fd, "rb") as f:
+            info = os.fstat(f.fileno())
+            if not stat.S_ISREG(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+                logger.error(f"State file {path} ignored (not a regular file of uid {os.getuid()} writable only by it)")
+                return
+            try:
+                state = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.error(f"Can't read the state file {path}: {e}")
+                return
+        if not isinstance(state, dict) or state.get("version") != STATE_VERSION or state.get("boot") != boot_id():
+            logger.warning(f"State file {path} ignored (other version or boot)")
+            return
+        records = state.get("processes")
+        records = records if isinstance(records, list) else []
+        valid: List[List] = [record for record in records if self.valid(record)]
+        if len(valid) != len(records):
+            logger.warning(f"State file {path}: {len(records) - len(valid)} invalid records skipped")
+        self.records = {record[0]: record for record in valid}
+        logger.info(f"State file {path}: {len(self.records)} processes to adopt")
+
+    @staticmethod
+    def valid(record) -> bool:
+        return (
+            isinstance(record, list)
+            and len(record) == len(RECORD_TYPES)
+            and all(isinstance(value, types) and not isinstance(value, bool) for value, types in zip(record, RECORD_TYPES))
+            and record[1] > 1
+            and record[4] in ADOPTED_STATES
+            and math.isfinite(record[5])
+            and 0 <= record[6] < 1e11  # datetime.fromtimestamp
+        )
+
+    def adopt(self, process) -> bool:
+        """
+        Called when a process is created: take over its saved run if it is still
+        alive. Return False if it has to be started as usual.
+        """
+        record: Optional[List] = self.records.pop(process.name, None)
+        if record is None:
+            return False
+        name, pid, starttime, service_hash, state, since, changedate = record
+        stat = read_stat(pid)
+        if stat is None or stat[2] != starttime:
+            logger.info(f"{name}: {pid} is gone (or the pid was reused), not adopted")
+            return False
+        child: bool = stat[1] == os.getpid()  # after an upgrade
+        if stat[0] == "Z" and not child:
+            logger.info(f"{name}: {pid} exited, not adopted")
+            return False
+        if process.props["capture"] or process.props["events"]:
+            logger.warning(f"{name}: {pid} not adopted (its pipes are closed), started again")
+            self.orphans.append(record)
+            return False
+        try:
+            proc = AdoptedProc(pid, child, process)
+        except OSError as e:
+            logger.error(f"{name}: can't watch {pid} ({e}), started again")
+            self.orphans.append(record)
+            return False
+        self.starttimes[pid] = starttime
+        process.resume(proc, state, since, changedate)
+        logger.info(f"{name}: {pid} adopted ({state})")
+        if service_hash != process.props["hash"] and state != "STOPPING":
+            logger.info(f"{name}: service changed, restarting")
+            process.restart()
+        return True
+
+    def finish(self) -> None:
+        """
+        Once the services are created: stop the saved processes which were not
+        adopted (service removed, numprocs lowered, pipes closed), then save the new state
+        """
+        for record in self.orphans + list(self.records.values()):
+            name, pid, starttime = record[0], record[1], record[2]
+            if start_time(pid) != starttime:
+                continue
+            logger.warning(f"{name}: stopping {pid} (no longer managed)")
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        self.records.clear()
+        self.orphans.clear()
+        self.write()
+
+    def changed(self) -> None:
+        """Called by the server loop: write the state file WRITE_DELAY after a change"""
+        if self.path and self.timer is None and registry.generation != self.generation:
+            self.timer = timers.schedule(WRITE_DELAY, self.write)
+
+    def write(self, path: str = "") -> None:
+        path = path or self.path
+        timers.cancel(self.timer)
+        self.timer = None
+        if not path:
+            return
+        self.generation = registry.generation
+        processes: List[List] = []
+        starttimes: Dict[int, int] = {}
+        live = (process for state, group in registry.states.items() if state.value in ADOPTED_STATES for process in group)
+        for process in live:
+            if process.proc is None or process.retired:
+                continue
+            pid: int = process.proc.pid
+            starttime: Optional[int] = self.starttimes.get(pid)
+            if starttime is None:
+                starttime = start_time(pid)
+                if starttime is None:
+                    continue
+            starttimes[pid] = starttime
+            processes.append(
+                [
+                    process.name,
+                    pid,
+                    starttime,
+                    process.props["hash"],
+                    process.state.value,
+                    process.since,
+                    process.changedate.timestamp() if process.changedate is not None else time.time(),
+                ]
+            )
+        self.starttimes = starttimes
+        state: Dict = {"version": STATE_VERSION, "boot": boot_id(), "pid": os.getpid(), "processes": processes}
+        tmp: str = f"{path}.tmp"
+        try:
+            try:
+                os.unlink(tmp)  # left by a crash (never followed if it is a symlink)
+            except FileNotFoundError:
+                pass
+            fd: int = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o600)
+            with os.fdopen(fd, "w") as f:
+                json.dump(state, f, separators=(",", ":"))
+            os.replace(tmp, path)
+        except OSError as e:
+            logger.error(f"Can't write the state file {path}: {e}")
+
+    def remove(self) -> None:
+        """Every process is stopped: nothing to adopt"""
+        timers.cancel(self.timer)
+        self.timer = None
+        if self.path:
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+
+
+tracker = ChildTracker()
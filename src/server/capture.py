@@ -0,0 +1,130 @@
+import os, selectors
+from typing import BinaryIO, Optional
+from logger import logger
+from loop import sel
+
+READ_SIZE: int = 65536
+MAX_READS_PER_EVENT: int = 4  # Bound the work done for one noisy child per loop iteration
+
+
+class RingBuffer:
+    """
+    Fixed-size byte buffer keeping only the last `size` bytes written.
+    """
+
+    def __init__(self, size: int):
+        self.buf: bytearray = bytearray(size)
+        self.size: int = size
+        self.pos: int = 0  # next write position
+        self.full: bool = False
+
+    def write(self, data: bytes) -> None:
+        if len(data) >= self.size:
+            self.buf[:] = data[-self.size :]
+            self.pos = 0
+            self.full = True
+            return
+        end = self.pos + len(data)
+        if end <= self.size:
+            self.buf[self.pos : end] = data
+        else:
+            first = self.size - self.pos
+            self.buf[self.pos :] = data[:first]
+            self.buf[: end - self.size] = data[first:]
+            self.full = True
+        self.pos = end % self.size
+        if end == self.size:
+            self.full = True
+
+    def getvalue(self) -> bytes:
+        if not self.full:
+            return bytes(self.buf[: self.pos])
+        return bytes(self.buf[self.pos :] + self.buf[: self.pos])
+
+    def tail(self, lines: int) -> bytes:
+        """
+        Last `lines` lines of the buffer
+        """
+        data = self.getvalue()
+        if lines <= 0:
+            return b""
+        end = len(data) - 1 if data.endswith(b"\n") else len(data)
+        start = end
+        for _ in range(lines):
+            start = data.rfind(b"\n", 0, start)
+            if start < 0:
+                return data
+        return data[start + 1 :]
+
+
+class CapturedStream:
+    """
+    Read end of the stdout or stderr pipe of one spawned child.
+    Each chunk goes to the configured file and to the ring buffer of the process.
+    """
+
+    def __init__(self, name: str, fd: int, path: str, ring: RingBuffer):
+        self.name: str = name
+        self.fd: int = fd
+        self.ring: RingBuffer = ring
+        self.file: Optional[BinaryIO] = None
+        try:
+            self.file = open(path, "ab", buffering=0)
+        except OSError as e:
+            logger.error(f"{name}: can't open {path}: {e}")
+        os.set_blocking(fd, False)
+        sel.register(fd, selectors.EVENT_READ, data=self.on_readable)
+
+    def on_readable(self, fd: int, mask: int) -> None:
+        for _ in range(MAX_READS_PER_EVENT):
+            try:
+                data = os.read(self.fd, READ_SIZE)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                logger.error(f"{self.name}: error reading output: {e}")
+                data = b""
+            if not data:
+                self.close()
+                return
+            self.ring.write(data)
+            if self.file is not None:
+                try:
+                    self.file.write(data)
+                except OSError as e:
+                    logger.error(f"{self.name}: can't write output: {e}")
+                    self.file.close()
+                    self.file = None
+
+    def close(self) -> None:
+        try:
+            sel.unregister(self.fd)
+        except (KeyError, ValueError):
+            pass
+        os.close(self.fd)
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class OutputCapture:
+    """
+    Captured output of a process: one ring buffer per stream, kept across restarts.
+    Memory is bounded by 2 * size per process.
+    """
+
+    def __init__(self, name: str, size: int):
+        self.name: str = name
+        self.stdout: RingBuffer = RingBuffer(size)
+        self.stderr: RingBuffer = RingBuffer(size)
+
+    def pipes(self, stdout_path: str, stderr_path: str):
+        """
+        Create the pipes of a new child. Return the write ends to give to Popen
+        (closed by the spawner once the child is forked).
+        """
+        out_r, out_w = os.pipe()
+        err_r, err_w = os.pipe()
+        CapturedStream(f"{self.name} stdout", out_r, stdout_path, self.stdout)
+        CapturedStream(f"{self.name} stderr", err_r, stderr_path, self.stderr)
+        return out_w, err_w
@@ -1,9 +1,134 @@
-import cerberus, yaml
-from logger import logger
-from service import StopSignals, AutoRestart
-from typing import Dict
+import cerberus, yaml, glob, hashlib, os, re, time
+from logger import logger, PATH_LOG_FILE
+from service import StopSignals, AutoRestart, serviceHash
+from process import State
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+try:
+    # libyaml binding: much faster than the pure python loader
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
 
 schemaConfig = {
+    # Files (glob patterns, relative to the configuration file) with more services
+    "include": {
+        "type": "list",
+        "schema": {"type": "string", "empty": False, "nullable": False},
+        "nullable": False,
+    },
+    # Control endpoints of taskmasterd (optional, see SERVER_DEFAULTS)
+    "server": {
+        "type": "dict",
+        "nullable": False,
+        "schema": {
+            "unixsocket": {
+                "type": "string",
+                "empty": True,  # "" to disable the unix socket
+                "nullable": False,
+            },
+            "unixmode": {
+                "type": "integer",
+                "min": 0o0,
+                "max": 0o777,
+                "nullable": False,
+            },
+            "unixusers": {
+                "type": "list",
+                "schema": {"type": "string", "empty": False, "nullable": False},
+                "nullable": False,
+            },
+            "tcp": {
+                "type": "boolean",
+                "nullable": False,
+            },
+            "host": {
+                "type": "string",
+                "empty": False,
+                "nullable": False,
+            },
+            "port": {
+                "type": "integer",
+                "min": 1,
+                "max": 65535,
+                "nullable": False,
+            },
+            "spawnconcurrency": {
+                "type": "integer",
+                "min": 1,
+                "max": 256,
+                "nullable": False,
+            },
+            "logformat": {
+                "type": "string",
+                "allowed": ["text", "json"],
+                "nullable": False,
+            },
+            "logmaxbytes": {
+                "type": "integer",
+                "min": 0,  # 0: never rotate
+                "nullable": False,
+            },
+            "logbackups": {
+                "type": "integer",
+                "min": 0,
+                "max": 100,
+                "nullable": False,
+            },
+            "watch": {
+                "type": "boolean",
+                "nullable": False,
+            },
+            "watchdebounce": {
+                "type": "number",
+                "min": 0,
+                "max": 60,
+                "nullable": False,
+            },
+            "metrics": {
+                "type": "boolean",
+                "nullable": False,
+            },
+            "metricshost": {
+                "type": "string",
+                "empty": False,
+                "nullable": False,
+            },
+            "metricsport": {
+                "type": "integer",
+                "min": 1,
+                "max": 65535,
+                "nullable": False,
+            },
+            "sampleinterval": {
+                "type": "number",
+                "min": 0,
+                "max": 3600,
+                "nullable": False,
+            },
+            "samplehistory": {
+                "type": "integer",
+                "min": 1,
+                "max": 3600,
+                "nullable": False,
+            },
+            "samplechildren": {
+                "type": "boolean",
+                "nullable": False,
+            },
+            "slowcallback": {
+                "type": "number",
+                "min": 0,
+                "max": 60,
+                "nullable": False,
+            },
+            "statefile": {
+                "type": "string",
+                "empty": True,  # "" to disable the adoption after a crash
+                "nullable": False,
+            },
+        },
+    },
     "services": {
         "type": "list",
         "required": True,
@@ -28,7 +153,7 @@ schemaConfig = {
                 "numprocs": {
                     "type": "integer",
                     "min": 1,
-                    "max": 10,  # 32
+                    "max": 1024,
                     "nullable": False,
                 },
                 "autostart": {
@@ -110,7 +235,68 @@ schemaConfig = {
                     "empty": False,
                     "nullable": False,
                 },
+                "capture": {
+                    "type": "boolean",
+                    "nullable": False,
+                },
+                "capturesize": {
+                    "type": "integer",
+                    "min": 1024,
+                    "max": 16 * 1024 * 1024,
+                    "nullable": False,
+                },
+                "maxrss": {
+                    "type": "integer",
+                    "min": 1,
+                    "nullable": False,
+                },
+                "maxcpu": {
+                    "type": "number",
+                    "min": 0,
+                    "nullable": False,
+                },
+                "cpuwindow": {
+                    "type": "integer",
+                    "min": 1,
+                    "max": 86400,
+                    "nullable": False,
+                },
+                "limitrestarts": {
+                    "type": "integer",
+                    "min": 0,
+                    "max": 1000,
+                    "nullable": False,
+                },
+                "limitperiod": {
+                    "type": "integer",
+                    "min": 1,
+                    "max": 86400,
+                    "nullable": False,
+                },
                 # for bonus
+                # Event listener (see eventlisteners.py)
+                "events": {
+                    "type": "list",
+                    "schema": {
+                        "type": "string",
+                        "allowed": ["PROCESS_STATE"] + [f"PROCESS_STATE_{state.value}" for state in State],
+                        "nullable": False,
+                    },
+                    "empty": False,
+                    "nullable": False,
+                },
+                "eventbuffer": {
+                    "type": "integer",
+                    "min": 1,
+                    "max": 100000,
+                    "nullable": False,
+                },
+                "eventbatch": {
+                    "type": "integer",
+                    "min": 1,
+                    "max": 1000,
+                    "nullable": False,
+                },
                 "user": {
                     "type": "string",
                     "empty": False,
@@ -122,36 +308,333 @@ schemaConfig = {
 }
 
 
-ConfValidator = cerberus.Validator(schemaConfig)
+# Same schema split in two: the document without the content of the services,
+# and one service (to validate only the services which changed)
+DocumentValidator = cerberus.Validator(
+    {**schemaConfig, "services": {**schemaConfig["services"], "schema": {"type": "dict"}}}
+)
+ServiceValidator = cerberus.Validator(schemaConfig["services"]["schema"]["schema"])
+# Included file: only services
+IncludeValidator = cerberus.Validator(
+    {"services": {**schemaConfig["services"], "schema": {"type": "dict"}}}
+)
 
 
-def load_config(configPath: str) -> Dict:
-    """Parses a YAML configuration file into a dict.
+############################
+# Compiled schema checks   #
+############################
 
-    Args:
-        configPath (str): The path to the YAML configuration file.
+# Cerberus is slow (a few ms per service): the schema is also compiled into plain
+# python checks. A document accepted by a check is valid. If a check fails,
+# Cerberus validates the document again to give the errors.
 
-    Returns:
-        dict: The parsed configuration.
+COMPILED_TYPES: Dict[str, tuple] = {
+    "string": (str,),
+    "integer": (int,),
+    "number": (int, float),
+    "boolean": (bool,),
+    "list": (list, tuple),
+    "dict": (dict,),
+}
+# bool is an int: not a number for Cerberus (an integer for it, decided by Cerberus then)
+NOT_BOOL_TYPES = ("integer", "number")
+
+Check = Callable[[object], bool]
+
+
+def compileRules(rules: Dict) -> Optional[Check]:
+    """Compiles the Cerberus rules of one field into a check.
+    Returns None if one of the rules is not supported (Cerberus only then).
+    """
+    checks: List[Check] = []
+    field_type: Optional[str] = rules.get("type")
+    if field_type is not None:
+        if field_type not in COMPILED_TYPES:
+            return None
+        types = COMPILED_TYPES[field_type]
+        if field_type in NOT_BOOL_TYPES:
+            checks.append(lambda v: isinstance(v, types) and not isinstance(v, bool))
+        else:
+            checks.append(lambda v: isinstance(v, types))
+    for rule, value in rules.items():
+        if rule in ("type", "required", "nullable", "allow_unknown"):
+            continue
+        elif rule == "empty":
+            if not value:
+                checks.append(lambda v: not hasattr(v, "__len__") or len(v) > 0)
+        elif rule == "maxlength":
+            checks.append(lambda v, n=value: len(v) <= n)
+        elif rule == "min":
+            checks.append(lambda v, n=value: v >= n)
+        elif rule == "max":
+            checks.append(lambda v, n=value: v <= n)
+        elif rule == "allowed":
+            checks.append(lambda v, allowed=list(value): v in allowed)
+        elif rule == "regex":
+            pattern = re.compile(value if value.endswith("$") else value + "$")
+            checks.append(lambda v, p=pattern: p.match(v) is not None)
+        elif rule == "schema" and field_type == "list":
+            item = compileRules(value)
+            if item is None:
+                return None
+            checks.append(lambda v, item=item: all(item(x) for x in v))
+        elif rule == "schema" and field_type == "dict":
+            fields = compileSchema(value, rules.get("allow_unknown", False))
+            if fields is None:
+                return None
+            checks.append(fields)
+        elif rule == "valuesrules":
+            item = compileRules(value)
+            if item is None:
+                return None
+            checks.append(lambda v, item=item: all(item(x) for x in v.values()))
+        elif rule == "keysrules":
+            item = compileRules(value)
+            if item is None:
+                return None
+            checks.append(lambda v, item=item: all(item(x) for x in v.keys()))
+        else:
+            return None
+    nullable: bool = rules.get("nullable", False)
+
+    def check(v) -> bool:
+        if v is None:
+            return nullable
+        for c in checks:
+            if not c(v):
+                return False
+        return True
+
+    return check
+
+
+def compileSchema(schema: Dict, allow_unknown: bool = False) -> Optional[Check]:
+    """Compiles a Cerberus schema (fields of a dict) into a check"""
+    fields: Dict[str, Check] = {}
+    for name, rules in schema.items():
+        field = compileRules(rules)
+        if field is None:
+            return None
+        fields[name] = field
+    required: List[str] = [name for name, rules in schema.items() if rules.get("required")]
+
+    def check(document) -> bool:
+        if not isinstance(document, dict):
+            return False
+        for name in required:
+            if name not in document:
+                return False
+        for name, value in document.items():
+            field = fields.get(name)
+            if field is None:
+                if not allow_unknown:
+                    return False
+            elif not field(value):
+                return False
+        return True
+
+    return check
+
+
+checkDocument: Optional[Check] = compileSchema(DocumentValidator.schema)
+checkService: Optional[Check] = compileSchema(ServiceValidator.schema)
+checkInclude: Optional[Check] = compileSchema(IncludeValidator.schema)
+
+SERVER_DEFAULTS: Dict = {
+    "unixsocket": os.path.join(os.path.dirname(PATH_LOG_FILE), "taskmaster.sock"),  # not in /tmp: another user could bind it first
+    "unixmode": 0o700,
+    "unixusers": [],  # users allowed besides root and the owner of taskmasterd
+    "tcp": False,
+    "host": "127.0.0.1",
+    "port": 65432,
+    "spawnconcurrency": 8,  # processes spawned simultaneously
+    "logformat": "text",  # format of the log file: "text" or "json" (one object per line)
+    "logmaxbytes": 10 * 1024 * 1024,  # rotate the log file above this size
+    "logbackups": 3,  # rotated log files kept
+    "watch": False,  # reload when the configuration files change
+    "watchdebounce": 0.5,  # seconds without change before reloading
+    "metrics": False,  # serve the Prometheus metrics on metricshost:metricsport
+    "metricshost": "127.0.0.1",
+    "metricsport": 65433,
+    "sampleinterval": 5,  # seconds between two samplings of the CPU and memory usage (0 disables)
+    "samplehistory": 60,  # samples kept per process
+    "samplechildren": False,  # add the descendants of the processes to their usage
+    "slowcallback": 0,  # warn when a callback blocks the server loop longer than this (0 disables)
+    "statefile": os.path.join(os.path.dirname(PATH_LOG_FILE), "taskmaster.state"),  # live processes adopted by the next taskmasterd (see adoption.py)
+}
+
+
+def serverConfig(config: Dict) -> Dict:
+    """Returns the 'server' section of the configuration completed with the default values."""
+    return {**SERVER_DEFAULTS, **config.get("server", {})}
+
+
+def indexServices(config: Dict) -> Dict[str, Dict]:
+    """Returns the services of the configuration indexed by name.
+    If a service is defined multiple times, only the last definition is kept
+    (at the position of the last definition).
     """
-    with open(configPath, "r") as f:
-        config: Dict = yaml.safe_load(f)
-    logger.info("Config file loading...")
-    return config
+    services: Dict[str, Dict] = {}
+    for props in config["services"]:
+        services.pop(props["name"], None)
+        services[props["name"]] = props
+    return services
 
 
-def validateConfig(newConfig: Dict) -> None:
-    """Parses a configuration file into a dict.
+def validateConfig(
+    newConfig: Dict, validated: Set[str] = frozenset(), include: bool = False
+) -> Set[str]:
+    """Validates a configuration.
+    The services whose hash is in validated (already accepted) are not validated again.
 
     Args:
         newConfig (dict): The new configuration
+        validated (set): Hashes of services already validated
+        include (bool): newConfig is an included file (only services)
 
     Returns:
-        bool: True if the configuration is valid, False otherwise.
+        set: The hashes of the services of the configuration.
+
+    Raises:
+        ValueError: if the configuration is not valid.
     """
     logger.info("Config file parsing...")
-    if ConfValidator.validate(newConfig):
-        logger.info("Configuration file parsed successfully")
-    else:
-        logger.error(f"Config file corrupted: {ConfValidator.errors}")
-        raise ValueError(f"Config file corrupted: {ConfValidator.errors}")
+    validator = IncludeValidator if include else DocumentValidator
+    check = checkInclude if include else checkDocument
+    if not isinstance(newConfig, dict):
+        logger.error("Config file corrupted: not a mapping")
+        raise ValueError("Config file corrupted: not a mapping")
+    if not (check and check(newConfig)) and not validator.validate(newConfig):
+        logger.error(f"Config file corrupted: {validator.errors}")
+        raise ValueError(f"Config file corrupted: {validator.errors}")
+    hashes: Set[str] = set()
+    for i, props in enumerate(newConfig["services"]):
+        props_hash: str = serviceHash(props)
+        if props_hash not in validated and props_hash not in hashes:
+            if not (checkService and checkService(props)) and not ServiceValidator.validate(
+                props
+            ):
+                errors = {"services": [{i: [ServiceValidator.errors]}]}
+                logger.error(f"Config file corrupted: {errors}")
+                raise ValueError(f"Config file corrupted: {errors}")
+        hashes.add(props_hash)
+    logger.info("Configuration file parsed successfully")
+    return hashes
+
+
+class ConfigFile:
+    """
+    One file of the configuration (main or included) with its parsed and validated content
+    """
+
+    def __init__(self, path: str, stat: Tuple, digest: str, document: Dict, hashes: Set[str]):
+        self.path: str = path
+        self.stat: Tuple = stat  # (dev, ino, size, mtime_ns, ctime_ns)
+        self.digest: str = digest  # content hash
+        self.document: Dict = document
+        self.hashes: Set[str] = hashes  # hashes of its services
+
+
+class ConfigLoader:
+    """
+    Load the configuration file and its included files, keeping what is needed
+    to make the next load cheap:
+    - a file whose stat didn't change is not read again
+    - a file whose content hash didn't change is not parsed again
+    - only the services which changed since the last accepted configuration are validated
+    The services of the included files come after the ones of the main file,
+    in the order of the include patterns (files of a pattern sorted by name):
+    the last definition of a service wins.
+    """
+
+    def __init__(self, configPath: str):
+        self.configPath: str = configPath
+        self.files: Dict[str, ConfigFile] = {}  # {path: ConfigFile} of the accepted configuration
+        self.config: Optional[Dict] = None  # last accepted configuration
+        self.validated: Set[str] = set()  # hashes of the services of the accepted configuration
+        self.report: str = ""  # timings of the last load
+
+    def includedFiles(self, document: Dict) -> List[str]:
+        """Returns the files matched by the include patterns of the main file"""
+        base: str = os.path.dirname(os.path.abspath(self.configPath))
+        paths: List[str] = []
+        for pattern in document.get("include", []):
+            pattern = os.path.join(base, os.path.expanduser(pattern))
+            matched: List[str] = sorted(p for p in glob.glob(pattern) if os.path.isfile(p))
+            if not matched:
+                logger.warning(f"include: no file matches {pattern}")
+            for path in matched:
+                if path not in paths and not os.path.samefile(path, self.configPath):
+                    paths.append(path)
+        return paths
+
+    def loadFile(self, path: str, include: bool, stats: Dict) -> ConfigFile:
+        """Returns the ConfigFile of path, read, parsed and validated only if it changed"""
+        cached: Optional[ConfigFile] = self.files.get(path)
+        st = os.stat(path)
+        stat: Tuple = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+        if cached is not None and cached.stat == stat:
+            return cached
+        with open(path, "rb") as f:
+            data: bytes = f.read()
+        stats["read"] += 1
+        digest: str = hashlib.sha1(data).hexdigest()
+        if cached is not None and cached.digest == digest:
+            return ConfigFile(path, stat, digest, cached.document, cached.hashes)
+        start: float = time.perf_counter()
+        document: Dict = yaml.load(data, Loader=YamlLoader)
+        parsed: float = time.perf_counter()
+        try:
+            hashes: Set[str] = validateConfig(document, self.validated, include)
+        except ValueError as e:
+            raise ValueError(f"{path}: {e}") from None
+        stats["parse"] += parsed - start
+        stats["validate"] += time.perf_counter() - parsed
+        stats["parsed"] += 1
+        stats["validated"] += len(hashes - self.validated)
+        return ConfigFile(path, stat, digest, document, hashes)
+
+    def load(self) -> Optional[Dict]:
+        """Loads and validates the configuration file and its included files.
+
+        Returns:
+            dict: The new configuration, None if no file changed.
+
+        Raises:
+            Exception: if a file can't be read or the configuration is not valid
+            (the last accepted configuration is kept).
+        """
+        start: float = time.perf_counter()
+        stats: Dict = {"read": 0, "parsed": 0, "validated": 0, "parse": 0.0, "validate": 0.0}
+        files: Dict[str, ConfigFile] = {}
+        main: ConfigFile = self.loadFile(self.configPath, False, stats)
+        files[self.configPath] = main
+        for path in self.includedFiles(main.document):
+            files[path] = self.loadFile(path, True, stats)
+        if (
+            self.config is not None
+            and list(files) == list(self.files)
+            and all(files[p].digest == self.files[p].digest for p in files)
+        ):
+            self.files = files  # new stats
+            self.report = (
+                f"files unchanged ({len(files)} checked, {stats['read']} read "
+                f"in {(time.perf_counter() - start) * 1000:.1f} ms)"
+            )
+            logger.info(f"Config {self.report}")
+            return None
+        config: Dict = {
+            **main.document,
+            "services": [props for f in files.values() for props in f.document["services"]],
+        }
+        validated: Set[str] = set()
+        for f in files.values():
+            validated |= f.hashes
+        self.files, self.config, self.validated = files, config, validated
+        self.report = (
+            f"{stats['parsed']}/{len(files)} files parsed in {stats['parse'] * 1000:.1f} ms "
+            f"({YamlLoader.__name__}), {stats['validated']}/{len(config['services'])} services "
+            f"validated in {stats['validate'] * 1000:.1f} ms"
+        )
+        logger.info(f"Config {self.report}")
+        return config
@@ -0,0 +1,320 @@
+import socket, selectors, struct, os, stat, pwd
+from collections import deque
+from typing import Callable, Deque, Iterable, List, Optional, Set, Tuple, Union
+from logger import logger
+
+# Every message (both ways) is a header followed by the utf-8 payload.
+# Header: payload length and request id (4 bytes big-endian each).
+# A response carries the id of its request so that a client can pipeline
+# many requests on one connection and match the responses.
+HEADER = struct.Struct("!II")
+MAX_FRAME: int = 1024 * 1024  # Refuse requests bigger than 1 MiB
+RECV_SIZE: int = 65536
+MAX_PENDING_OUTPUT: int = 16 * 1024 * 1024  # Stop reading requests above this amount of unsent data
+
+
+# struct ucred of SO_PEERCRED: pid, uid, gid
+UCRED = struct.Struct("3i")
+
+
+def frame(payload: bytes, request_id: int = 0) -> bytes:
+    return HEADER.pack(len(payload), request_id) + payload
+
+
+class FileSpan:
+    """
+    Part of a file queued in the output of a connection, sent with os.sendfile
+    (no copy through the user space). Keep a reference to the file object so that
+    its descriptor can't be closed and reused while the span is pending.
+    """
+
+    __slots__ = ("file", "offset", "count")
+
+    def __init__(self, file, offset: int, count: int):
+        self.file = file
+        self.offset: int = offset
+        self.count: int = count
+
+
+#############
+# listeners #
+#############
+
+
+def open_tcp_listener(host: str, port: int) -> socket.socket:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+        sock.bind((host, port))
+        sock.listen(socket.SOMAXCONN)
+    except Exception:
+        sock.close()
+        raise
+    sock.setblocking(False)
+    return sock
+
+
+def open_unix_listener(path: str, mode: int) -> socket.socket:
+    """
+    Bind a unix stream socket on path with the given permissions.
+    A stale socket file (no server behind it) is replaced.
+    """
+    if os.path.exists(path):
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            raise FileExistsError(f"{path} exists and is not a socket")
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            os.unlink(path)
+        else:
+            raise OSError(f"Another taskmaster is already listening on {path}")
+        finally:
+            probe.close()
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o777 & ~mode)  # never expose the socket, even briefly
+    try:
+        sock.bind(path)
+        os.chmod(path, mode)
+        sock.listen(socket.SOMAXCONN)
+    except Exception:
+        sock.close()
+        raise
+    finally:
+        os.umask(old_umask)
+    sock.setblocking(False)
+    return sock
+
+
+def peer_credentials(sock: socket.socket) -> Tuple[int, int, int]:
+    """
+    Return (pid, uid, gid) of the process connected to a unix socket
+    """
+    return UCRED.unpack(
+        sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, UCRED.size)
+    )
+
+
+def allowed_uids(usernames: Iterable[str]) -> Set[int]:
+    """
+    uids allowed on the unix socket: root, the owner of taskmasterd and the listed users
+    """
+    uids: Set[int] = {0, os.getuid()}
+    for name in usernames:
+        try:
+            uids.add(pwd.getpwnam(name).pw_uid)
+        except KeyError:
+            logger.warning(f"Unknown user in unixusers: {name}")
+    return uids
+
+
+class Connection:
+    """
+    A non-blocking control connection driven by the selector.
+    Requests are read in an input buffer and split in frames, responses are queued
+    in an output buffer and written when the socket is writable so that a slow
+    client never blocks the supervision of the processes.
+    """
+
+    def __init__(
+        self,
+        sock: socket.socket,
+        addr,
+        sel: selectors.BaseSelector,
+        on_message: Callable[["Connection", int, str], Optional[str]],
+    ):
+        self.sock: socket.socket = sock
+        self.addr = addr
+        self.sel: selectors.BaseSelector = sel
+        self.on_message = on_message
+        self.inbuf: bytearray = bytearray()
+        self.outbuf: Deque[Union[memoryview, FileSpan]] = deque()
+        self.pending: int = 0  # bytes in outbuf
+        self.queued: int = 0  # bytes ever queued (lets flush see if a drain callback queued more)
+        self.closed: bool = False
+        # Streams (tail -f): called when the output is empty again / when the connection is closed
+        self.drain_callbacks: List[Callable[["Connection"], None]] = []
+        self.close_callbacks: List[Callable[["Connection"], None]] = []
+        self.draining: bool = False
+        self.events: int = selectors.EVENT_READ
+        self.sock.setblocking(False)
+        self.sel.register(self.sock, self.events, data=self.handle_event)
+
+    ##########
+    # events #
+    ##########
+
+    def handle_event(self, sock: socket.socket, mask: int) -> None:
+        try:
+            if mask & selectors.EVENT_WRITE:
+                self.flush()
+            if mask & selectors.EVENT_READ and not self.closed:
+                self.read()
+        except ConnectionResetError:
+            logger.warning(f"Connection reset by {self.addr}")
+            self.close()
+        except BrokenPipeError:
+            logger.warning(f"Connection lost with {self.addr}")
+            self.close()
+        except Exception as e:
+            logger.error(f"Error with {self.addr}: {e}")
+            self.close()
+
+    def read(self) -> None:
+        data = self.sock.recv(RECV_SIZE)
+        if not data:
+            logger.info(f"Connection closed by {self.addr}")
+            self.close()
+            return
+        self.inbuf += data
+        while len(self.inbuf) >= HEADER.size and not self.closed:
+            length, request_id = HEADER.unpack_from(self.inbuf)
+            if length > MAX_FRAME:
+                logger.error(f"Message too large from {self.addr} ({length} bytes)")
+                self.close()
+                return
+            if len(self.inbuf) < HEADER.size + length:
+                break
+            payload = bytes(self.inbuf[HEADER.size : HEADER.size + length])
+            del self.inbuf[: HEADER.size + length]
+            response = self.on_message(self, request_id, payload.decode())
+            if response is not None:
+                self.send(response, request_id)
+        self.update_events()
+
+    ##########
+    # output #
+    ##########
+
+    def send(self, message: str, request_id: int = 0) -> None:
+        """
+        Queue a framed response and write as much as possible without blocking
+        """
+        if self.closed:
+            return
+        self.write(frame(message.encode(), request_id))
+
+    def write(self, data: bytes) -> None:
+        """
+        Queue raw bytes (already framed)
+        """
+        if self.closed or not data:
+            return
+        self.queue(memoryview(data))
+        self.flush()
+
+    def write_frame(self, payload: memoryview, request_id: int) -> None:
+        """
+        Queue a frame without copying its payload: the same buffer can be
+        shared by every connection following the same file.
+        """
+        if self.closed:
+            return
+        self.queue(memoryview(HEADER.pack(len(payload), request_id)))
+        if len(payload):
+            self.queue(payload)
+        self.flush()
+
+    def write_file(self, file, offset: int, count: int, request_id: int) -> None:
+        """
+        Queue a frame whose payload is count bytes of file from offset (sent with sendfile)
+        """
+        if self.closed:
+            return
+        self.queue(memoryview(HEADER.pack(count, request_id)))
+        if count:
+            self.queue(FileSpan(file, offset, count))
+        self.flush()
+
+    def queue(self, item: Union[memoryview, FileSpan]) -> None:
+        self.outbuf.append(item)
+        size = item.count if isinstance(item, FileSpan) else len(item)
+        self.pending += size
+        self.queued += size
+
+    def send_pending(self) -> None:
+        """
+        Write the output buffer until it is empty or the socket would block
+        """
+        while self.outbuf:
+            item = self.outbuf[0]
+            try:
+                if isinstance(item, FileSpan):
+                    sent = os.sendfile(
+                        self.sock.fileno(), item.file.fileno(), item.offset, item.count
+                    )
+                    if sent == 0:
+                        # The frame header announced count bytes: the stream can't go on
+                        raise EOFError("file truncated while being sent")
+                else:
+                    sent = self.sock.send(item)
+            except (BlockingIOError, InterruptedError):
+                return
+            self.pending -= sent
+            if isinstance(item, FileSpan):
+                item.offset += sent
+                item.count -= sent
+                if item.count:
+                    return
+                self.outbuf.popleft()
+            elif sent == len(item):
+                self.outbuf.popleft()
+            else:
+                self.outbuf[0] = item[sent:]
+                return
+
+    def flush(self) -> None:
+        try:
+            while True:
+                self.send_pending()
+                if self.outbuf or self.draining or not self.drain_callbacks:
+                    break
+                # Output empty: let the streams queue what they held back
+                queued = self.queued
+                self.draining = True
+                try:
+                    for callback in list(self.drain_callbacks):
+                        callback(self)
+                finally:
+                    self.draining = False
+                if self.closed or self.queued == queued:
+                    break
+        except (BrokenPipeError, ConnectionResetError):
+            logger.warning(f"Connection lost with {self.addr}")
+            self.close()
+        except (OSError, EOFError) as e:
+            logger.error(f"Error with {self.addr}: {e}")
+            self.close()
+        self.update_events()
+
+    def update_events(self) -> None:
+        """
+        Watch writability only while there is pending output.
+        Stop reading new requests while too much output is pending.
+        """
+        if self.closed:
+            return
+        events: int = 0
+        if self.pending < MAX_PENDING_OUTPUT:
+            events |= selectors.EVENT_READ
+        if self.outbuf:
+            events |= selectors.EVENT_WRITE
+        if events != self.events:
+            self.events = events
+            self.sel.modify(self.sock, events, data=self.handle_event)
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.sel.unregister(self.sock)
+        except (KeyError, ValueError):
+            pass
+        self.sock.close()
+        self.outbuf.clear()
+        self.pending = 0
+        self.drain_callbacks.clear()
+        for callback in self.close_callbacks:
+            callback(self)
+        self.close_callbacks.clear()
@@ -0,0 +1,283 @@
+import itertools, os, selectors
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+from logger import logger
+from loop import sel
+from timers import timers
+from events import events
+
+READ_SIZE: int = 65536
+MAX_LINE: int = 4096  # Unexpected output without newline discarded above this size
+DROP_WARNING_INTERVAL: float = 10  # Seconds between two "events dropped" warnings of a pool
+
+# Protocol states of a listener (see http://supervisord.org/events.html#event-listener-states)
+ACKNOWLEDGED, READY, BUSY = "ACKNOWLEDGED", "READY", "BUSY"
+
+
+class Event:
+    __slots__ = ("serial", "name", "body")
+
+    def __init__(self, serial: int, name: str, body: str):
+        self.serial: int = serial
+        self.name: str = name  # PROCESS_STATE_<STATE>
+        self.body: str = body  # processname:web_1 groupname:web from_state:RUNNING ...
+
+
+class ListenerChannel:
+    """
+    Protocol pipes of one run of a listener process: the notifications are
+    written on its stdin, READY and RESULT <len> are read on its stdout.
+    Both ends are non-blocking and driven by the selector: a listener which
+    doesn't read nor answer only keeps its notification.
+    """
+
+    def __init__(self, pool: "ListenerPool", name: str, stdin: int, stdout: int):
+        self.pool: ListenerPool = pool
+        self.name: str = name
+        self.stdin: int = stdin
+        self.stdout: int = stdout
+        self.state: str = ACKNOWLEDGED  # until the first READY
+        self.inbuf: bytearray = bytearray()
+        self.outbuf: memoryview = memoryview(b"")
+        self.batch: List[Event] = []  # events of the notification being handled
+        self.writing: bool = False  # stdin registered in the selector
+        self.closed: bool = False
+        os.set_blocking(stdin, False)
+        os.set_blocking(stdout, False)
+        sel.register(stdout, selectors.EVENT_READ, data=self.on_readable)
+
+    def notify(self, batch: List[Event], payload: bytes) -> None:
+        self.state = BUSY
+        self.batch = batch
+        self.outbuf = memoryview(payload)
+        self.write()
+
+    def write(self) -> None:
+        try:
+            while self.outbuf:
+                self.outbuf = self.outbuf[os.write(self.stdin, self.outbuf) :]
+        except BlockingIOError:
+            if not self.writing:
+                self.writing = True
+                sel.register(self.stdin, selectors.EVENT_WRITE, data=self.on_writable)
+            return
+        except OSError as e:
+            logger.warning(f"{self.name}: can't write the event: {e}")
+            self.close()
+            return
+        if self.writing:
+            self.writing = False
+            sel.unregister(self.stdin)
+
+    def on_writable(self, fd: int, mask: int) -> None:
+        self.write()
+
+    def on_readable(self, fd: int, mask: int) -> None:
+        try:
+            data = os.read(self.stdout, READ_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            logger.error(f"{self.name}: error reading the listener: {e}")
+            data = b""
+        if not data:
+            self.close()
+            return
+        self.inbuf += data
+        self.parse()
+
+    def parse(self) -> None:
+        while self.inbuf and not self.closed:
+            if self.state == ACKNOWLEDGED and self.inbuf.startswith(b"READY\n"):
+                del self.inbuf[:6]
+                self.state = READY
+                self.pool.schedule()
+                continue
+            if self.state == BUSY and self.inbuf.startswith(b"RESULT "):
+                end = self.inbuf.find(b"\n")
+                if end < 0:
+                    return
+                try:
+                    length = int(self.inbuf[7:end])
+                except ValueError:
+                    length = -1
+                if length >= 0:
+                    if len(self.inbuf) < end + 1 + length:
+                        return
+                    result = bytes(self.inbuf[end + 1 : end + 1 + length])
+                    del self.inbuf[: end + 1 + length]
+                    self.acknowledge(result)
+                    continue
+            if self.inbuf.startswith(b"READY\n"[: len(self.inbuf)]) or self.inbuf.startswith(b"RESULT "[: len(self.inbuf)]):
+                return  # Partial token
+            # Anything else breaks the protocol: discard it up to the end of line
+            end = self.inbuf.find(b"\n")
+            if end < 0 and len(self.inbuf) < MAX_LINE:
+                return
+            end = len(self.inbuf) if end < 0 else end + 1
+            logger.warning(f"{self.name}: unexpected output in state {self.state}: {bytes(self.inbuf[:end])[:80]!r}")
+            del self.inbuf[:end]
+
+    def acknowledge(self, result: bytes) -> None:
+        batch, self.batch = self.batch, []
+        self.state = ACKNOWLEDGED
+        if result != b"OK":
+            logger.warning(f"{self.name}: rejected {len(batch)} events ({result[:80]!r}), buffered again")
+            self.pool.requeue(batch)
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        if self.writing:
+            sel.unregister(self.stdin)
+        sel.unregister(self.stdout)
+        os.close(self.stdin)
+        os.close(self.stdout)
+        if self.state == BUSY and self.batch:
+            # The listener exited without a result: the events go to the next one
+            self.pool.requeue(self.batch)
+        self.pool.channels.remove(self)
+
+
+class ListenerPool:
+    """
+    Processes of an event listener service: the events they subscribed to are
+    buffered in one bounded queue ('eventbuffer', the oldest are dropped) and
+    sent to the READY processes, up to 'eventbatch' events per notification.
+    """
+
+    def __init__(self, name: str, props: Dict):
+        self.name: str = name
+        self.props: Dict = props
+        self.queue: Deque[Event] = deque()
+        self.channels: List[ListenerChannel] = []
+        self.serial = itertools.count(1)  # poolserial of the notifications
+        self.dropped: int = 0  # events dropped since the last warning
+        self.warned: float = -DROP_WARNING_INTERVAL  # time of the last warning
+        self.scheduled: bool = False
+
+    def wants(self, name: str) -> bool:
+        wanted: List[str] = self.props["events"]
+        return "PROCESS_STATE" in wanted or name in wanted
+
+    def push(self, event: Event) -> None:
+        if len(self.queue) >= self.props["eventbuffer"]:
+            self.queue.popleft()
+            self.dropped += 1
+        self.queue.append(event)
+        self.schedule()
+
+    def requeue(self, batch: List[Event]) -> None:
+        self.queue.extendleft(reversed(batch))
+        self.schedule()
+
+    def schedule(self) -> None:
+        """Dispatch once per loop iteration: the events of a burst are batched"""
+        if not self.scheduled:
+            self.scheduled = True
+            timers.schedule(0, self.dispatch)
+
+    def dispatch(self) -> None:
+        self.scheduled = False
+        if self.dropped and timers.now() - self.warned >= DROP_WARNING_INTERVAL:
+            self.warned = timers.now()
+            logger.warning(
+                f"{self.name}: event buffer full ({self.props['eventbuffer']}), {self.dropped} oldest events dropped"
+            )
+            self.dropped = 0
+        for channel in self.channels:
+            if not self.queue:
+                return
+            if channel.state != READY:
+                continue
+            count: int = min(self.props["eventbatch"], len(self.queue))
+            batch: List[Event] = [self.queue.popleft() for _ in range(count)]
+            channel.notify(batch, self.payload(batch))
+
+    def payload(self, batch: List[Event]) -> bytes:
+        """
+        supervisord header and body. With 'eventbatch' > 1 the notification is a
+        PROCESS_STATE_BATCH: one line per event, starting with its eventname.
+        """
+        if self.props["eventbatch"] == 1:
+            name, body = batch[0].name, batch[0].body
+        else:
+            name = "PROCESS_STATE_BATCH"
+            body = "".join(f"eventname:{event.name} {event.body}\n" for event in batch)
+        data: bytes = body.encode()
+        header: str = (
+            f"ver:3.0 server:taskmaster serial:{batch[0].serial} pool:{self.name} "
+            f"poolserial:{next(self.serial)} eventname:{name} len:{len(data)}\n"
+        )
+        return header.encode() + data
+
+
+class EventListeners:
+    """
+    Event listener pools (services with 'events'), fed by the state transitions
+    of the other processes (handler of the EventBus).
+    """
+
+    def __init__(self):
+        self.pools: Dict[str, ListenerPool] = {}  # {service name: ListenerPool}
+        self.serial = itertools.count(1)  # serial of the events
+        self.registered: bool = False
+
+    def join(self, process) -> None:
+        """
+        A process of a listener service is created: make sure its pool exists
+        (the events are buffered until one of its processes is READY)
+        """
+        name: str = process.props["name"]
+        pool: Optional[ListenerPool] = self.pools.get(name)
+        if pool is None:
+            pool = self.pools[name] = ListenerPool(name, process.props)
+        pool.props = process.props  # the service may have been replaced by a reload
+        if not self.registered:
+            self.registered = True
+            events.handlers.append(self.notify)
+
+    def pipes(self, process) -> Tuple[int, int]:
+        """
+        Create the protocol pipes of a new listener process. Return the ends to
+        give to Popen as stdin and stdout (closed by the spawner once forked).
+        """
+        self.join(process)
+        stdin_r, stdin_w = os.pipe()
+        stdout_r, stdout_w = os.pipe()
+        pool: ListenerPool = self.pools[process.props["name"]]
+        pool.channels.append(ListenerChannel(pool, process.name, stdin_w, stdout_r))
+        return stdin_r, stdout_w
+
+    def notify(self, process, old_state, new_state, pid: Optional[int], exitcode: Optional[int]) -> None:
+        if process.props["events"]:
+            return  # No event about the listeners themselves (feedback loop)
+        name: str = f"PROCESS_STATE_{new_state.value}"
+        event: Optional[Event] = None
+        for pool in self.pools.values():
+            if not pool.wants(name):
+                continue
+            if event is None:
+                event = Event(next(self.serial), name, self.body(process, old_state, new_state, pid, exitcode))
+            pool.push(event)
+
+    def body(self, process, old_state, new_state, pid: Optional[int], exitcode: Optional[int]) -> str:
+        fields: List[str] = [
+            f"processname:{process.name.split(':')[-1]}",
+            f"groupname:{process.props['name']}",
+            f"from_state:{old_state.value}",
+        ]
+        if new_state.value in ("STARTING", "BACKOFF"):
+            fields.append(f"tries:{process.current_retry - 1}")
+        if new_state.value == "EXITED" and exitcode is not None:
+            fields.append(f"expected:{int(abs(exitcode) in process.props['exitcodes'])}")
+        if pid is not None:
+            fields.append(f"pid:{pid}")
+        return " ".join(fields)
+
+    def forget(self, service: str) -> None:
+        self.pools.pop(service, None)
+
+
+listeners = EventListeners()
@@ -0,0 +1,142 @@
+import json
+from collections import deque
+from fnmatch import fnmatchcase
+from typing import Callable, Deque, Dict, List, Optional, Set, Union
+from logger import logger
+from timers import timers
+
+MAX_QUEUED: int = 1024  # Events kept per subscriber while its connection doesn't drain
+HIGH_WATER: int = 64 * 1024  # Above this amount of unsent output a subscriber gets no new frame
+
+
+class Overflow:
+    """
+    Marker of the events dropped at this point of the queue of a subscriber
+    """
+
+    __slots__ = ("dropped",)
+
+    def __init__(self):
+        self.dropped: int = 1
+
+    def record(self) -> bytes:
+        return json.dumps({"overflow": self.dropped}, separators=(",", ":")).encode() + b"\n"
+
+
+class EventSubscriber:
+    """
+    A connection receiving the state transitions (subscribe command).
+    states: only the transitions to these states (None: all)
+    patterns: globs on the service or process names (empty: all)
+    """
+
+    __slots__ = ("conn", "request_id", "states", "patterns", "queue", "matches")
+
+    def __init__(self, conn, request_id: int, states: Optional[Set[str]], patterns: List[str]):
+        self.conn = conn
+        self.request_id: int = request_id
+        self.states: Optional[Set[str]] = states
+        self.patterns: List[str] = patterns
+        self.queue: Deque[Union[bytes, Overflow]] = deque()
+        self.matches: Dict[str, bool] = {}  # {process name: matches the patterns}
+
+    def wants(self, process, new_state) -> bool:
+        if self.states is not None and new_state.value not in self.states:
+            return False
+        if not self.patterns:
+            return True
+        match = self.matches.get(process.name)
+        if match is None:
+            match = self.matches[process.name] = any(
+                fnmatchcase(process.props["name"], pattern) or fnmatchcase(process.name, pattern)
+                for pattern in self.patterns
+            )
+        return match
+
+
+class EventBus:
+    """
+    State transitions of the processes pushed to the subscribed connections.
+    publish() (called by the Process.state setter) only queues the record on
+    the interested subscribers: the queues are written once per loop iteration,
+    in one frame per subscriber. A subscriber whose connection doesn't drain
+    keeps at most MAX_QUEUED events, the next ones are dropped and counted in
+    an overflow marker: the supervision never waits for a slow client.
+    """
+
+    def __init__(self):
+        self.subscribers: List[EventSubscriber] = []
+        self.handlers: List[Callable] = []  # called with every transition (see eventlisteners.py)
+        self.scheduled: bool = False
+
+    def subscribe(self, conn, request_id: int, states: Optional[Set[str]], patterns: List[str], header: str) -> None:
+        subscriber = EventSubscriber(conn, request_id, states, patterns)
+        conn.send(header, request_id)
+        self.subscribers.append(subscriber)
+        conn.drain_callbacks.append(lambda c: self.send(subscriber))
+        conn.close_callbacks.append(lambda c: self.unsubscribe(subscriber))
+
+    def renamed(self, old_name: str) -> None:
+        """A process was renamed (numprocs scaled): its pattern matches are computed again"""
+        for subscriber in self.subscribers:
+            subscriber.matches.pop(old_name, None)
+
+    def unsubscribe(self, subscriber: EventSubscriber) -> None:
+        if subscriber in self.subscribers:
+            self.subscribers.remove(subscriber)
+
+    def publish(self, process, old_state, new_state, pid: Optional[int], exitcode: Optional[int]) -> None:
+        for handler in self.handlers:
+            handler(process, old_state, new_state, pid, exitcode)
+        record: Optional[bytes] = None  # serialized once for every subscriber
+        for subscriber in self.subscribers:
+            if not subscriber.wants(process, new_state):
+                continue
+            queue = subscriber.queue
+            if len(queue) >= MAX_QUEUED:
+                if isinstance(queue[-1], Overflow):
+                    queue[-1].dropped += 1
+                else:
+                    queue.append(Overflow())
+                continue
+            if record is None:
+                record = (
+                    json.dumps(
+                        {
+                            "process": process.name,
+                            "from": old_state.value,
+                            "to": new_state.value,
+                            "pid": pid,
+                            "exitcode": exitcode,
+                            "time": round(timers.now(), 6),
+                        },
+                        separators=(",", ":"),
+                    ).encode()
+                    + b"\n"
+                )
+            queue.append(record)
+            if not self.scheduled:
+                self.scheduled = True
+                timers.schedule(0, self.flush)
+
+    def flush(self) -> None:
+        self.scheduled = False
+        for subscriber in list(self.subscribers):
+            self.send(subscriber)
+
+    def send(self, subscriber: EventSubscriber) -> None:
+        """
+        Write the queued events of the subscriber in one frame (unless its connection is behind)
+        """
+        conn = subscriber.conn
+        if not subscriber.queue or conn.closed or conn.pending >= HIGH_WATER:
+            return
+        queue, subscriber.queue = subscriber.queue, deque()
+        payload: bytes = b"".join(item.record() if isinstance(item, Overflow) else item for item in queue)
+        for item in queue:
+            if isinstance(item, Overflow):
+                logger.warning(f"{conn.addr}: {item.dropped} events dropped (subscriber too slow)")
+        conn.write_frame(memoryview(payload), subscriber.request_id)
+
+
+events = EventBus()
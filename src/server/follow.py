@@ -0,0 +1,281 @@
+import os, selectors
+from typing import Dict, List, Optional
+from logger import logger
+from loop import sel
+from timers import timers
+from utils.inotify import (
+    Inotify,
+    IN_MODIFY,
+    IN_ATTRIB,
+    IN_MOVE_SELF,
+    IN_DELETE_SELF,
+    IN_IGNORED,
+    IN_Q_OVERFLOW,
+)
+
+READ_SIZE: int = 256 * 1024  # Max bytes read (or sent with sendfile) per step
+HIGH_WATER: int = 256 * 1024  # Above this amount of unsent output a follower gets no live data
+MAX_HISTORY: int = 1024 * 1024  # Max bytes scanned backwards to find the last lines
+POLL_INTERVAL: float = 0.5  # stat() period of the files not watched with inotify
+
+WATCH_MASK: int = IN_MODIFY | IN_ATTRIB | IN_MOVE_SELF | IN_DELETE_SELF
+
+
+class Subscriber:
+    """
+    A connection following a file. offset is the position in the file up to
+    which data has been queued on the connection.
+    """
+
+    __slots__ = ("conn", "request_id", "offset")
+
+    def __init__(self, conn, request_id: int, offset: int):
+        self.conn = conn
+        self.request_id: int = request_id
+        self.offset: int = offset
+
+
+class FileFollower:
+    """
+    One log file followed by any number of connections.
+    New data is read once and the same buffer is queued on every subscriber which
+    is up to date. A subscriber with too much unsent output is left behind and
+    catches up later straight from the file with sendfile, so a slow client
+    costs no memory and never slows down the others.
+    """
+
+    def __init__(self, manager: "FollowManager", path: str):
+        self.manager: "FollowManager" = manager
+        self.path: str = path
+        self.file = open(path, "rb", buffering=0)
+        st = os.fstat(self.file.fileno())
+        self.inode = (st.st_dev, st.st_ino)
+        self.offset: int = st.st_size  # Position read so far
+        self.subscribers: List[Subscriber] = []
+        self.wd: Optional[int] = None  # inotify watch, None if polled
+        self.detached: bool = False  # The file was moved or deleted: poll its path
+        self.scheduled: bool = False
+
+    def history_start(self, lines: int) -> int:
+        """
+        Offset of the last `lines` lines (bounded by MAX_HISTORY bytes)
+        """
+        if lines <= 0 or self.offset == 0:
+            return self.offset
+        limit = max(0, self.offset - MAX_HISTORY)
+        end = self.offset
+        # A trailing newline ends the last line, it doesn't start a new one
+        if os.pread(self.file.fileno(), 1, end - 1) == b"\n":
+            end -= 1
+        found = 0
+        while end > limit:
+            start = max(limit, end - 8192)
+            block = os.pread(self.file.fileno(), end - start, start)
+            pos = len(block)
+            while True:
+                pos = block.rfind(b"\n", 0, pos)
+                if pos < 0:
+                    break
+                found += 1
+                if found == lines:
+                    return start + pos + 1
+            end = start
+        return limit
+
+    def subscribe(self, conn, request_id: int, lines: int) -> None:
+        start = self.history_start(lines)
+        subscriber = Subscriber(conn, request_id, start)
+        self.subscribers.append(subscriber)
+        conn.drain_callbacks.append(lambda c: self.catch_up(subscriber))
+        conn.close_callbacks.append(lambda c: self.unsubscribe(subscriber))
+        self.catch_up(subscriber)
+
+    def unsubscribe(self, subscriber: Subscriber) -> None:
+        if subscriber in self.subscribers:
+            self.subscribers.remove(subscriber)
+        if not self.subscribers:
+            self.manager.release(self)
+
+    def catch_up(self, subscriber: Subscriber) -> None:
+        """
+        Send the data the subscriber is missing directly from the file
+        """
+        conn = subscriber.conn
+        while subscriber.offset < self.offset and conn.pending < HIGH_WATER and not conn.closed:
+            offset = subscriber.offset
+            count = min(self.offset - offset, READ_SIZE)
+            subscriber.offset += count  # Before writing: write_file may call the drain callbacks
+            conn.write_file(self.file, offset, count, subscriber.request_id)
+
+    def on_change(self) -> None:
+        """
+        Read the new data once and fan it out
+        """
+        self.scheduled = False
+        if self.file.closed:
+            return  # Released meanwhile
+        try:
+            size = os.fstat(self.file.fileno()).st_size
+        except OSError:
+            return
+        if size < self.offset:
+            logger.info(f"{self.path}: truncated, following from the start")
+            self.offset = 0
+            for subscriber in self.subscribers:
+                subscriber.offset = 0
+        if size == self.offset:
+            return
+        data = os.pread(self.file.fileno(), min(size - self.offset, READ_SIZE), self.offset)
+        if not data:
+            return
+        view = memoryview(data)
+        for subscriber in list(self.subscribers):
+            conn = subscriber.conn
+            if subscriber.offset == self.offset and conn.pending < HIGH_WATER:
+                subscriber.offset += len(data)
+                conn.write_frame(view, subscriber.request_id)
+        self.offset += len(data)
+        for subscriber in list(self.subscribers):
+            if subscriber.offset < self.offset:
+                self.catch_up(subscriber)
+        if self.offset < size and not self.scheduled:
+            # Bound the work per loop iteration: continue at the next one
+            self.scheduled = True
+            timers.schedule(0, self.on_change)
+
+    def check_rotation(self) -> None:
+        """
+        The path now names another file (rotated, deleted then recreated...):
+        send what is left of the old one and follow the new one from its start.
+        """
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            self.detached = True
+            return
+        if (st.st_dev, st.st_ino) == self.inode:
+            return
+        self.on_change()
+        try:
+            new_file = open(self.path, "rb", buffering=0)
+        except OSError:
+            self.detached = True
+            return
+        self.detached = False
+        logger.info(f"{self.path}: replaced, following the new file")
+        # The old file object is not closed here: the pending FileSpans keep it alive
+        self.file = new_file
+        self.inode = (st.st_dev, st.st_ino)
+        self.offset = 0
+        for subscriber in self.subscribers:
+            subscriber.offset = 0
+        self.manager.watch(self)
+        self.on_change()
+
+
+class FollowManager:
+    """
+    Followed files of the server (tail -f). Changes are detected with inotify,
+    or by polling the files with stat() when inotify is not available.
+    """
+
+    def __init__(self):
+        self.followers: Dict[str, FileFollower] = {}  # {real path: FileFollower}
+        self.watches: Dict[int, FileFollower] = {}  # {inotify watch: FileFollower}
+        self.inotify: Optional[Inotify] = None
+        self.inotify_failed: bool = False
+        self.poll_timer = None
+
+    def follow(self, conn, request_id: int, path: str, lines: int, header: str) -> Optional[str]:
+        """
+        Send header, then stream the last lines of path and its new data on conn.
+        Return an error message, None on success.
+        """
+        real_path = os.path.realpath(path)
+        follower = self.followers.get(real_path)
+        if follower is None:
+            if not os.path.isfile(real_path):
+                return f"{path} is not a regular file"
+            try:
+                follower = FileFollower(self, real_path)
+            except OSError as e:
+                return f"can't open {path}: {e.strerror}"
+            self.followers[real_path] = follower
+            self.watch(follower)
+        else:
+            follower.check_rotation()
+            follower.on_change()
+        conn.send(header, request_id)
+        follower.subscribe(conn, request_id, lines)
+        return None
+
+    def watch(self, follower: FileFollower) -> None:
+        if follower.wd is not None and self.inotify is not None:
+            self.watches.pop(follower.wd, None)
+            self.inotify.rm_watch(follower.wd)
+            follower.wd = None
+        if self.inotify is None and not self.inotify_failed:
+            try:
+                self.inotify = Inotify()
+                sel.register(self.inotify, selectors.EVENT_READ, data=self.on_events)
+            except OSError as e:
+                logger.warning(f"inotify not available ({e}), polling followed files")
+                self.inotify_failed = True
+        if self.inotify is not None:
+            try:
+                follower.wd = self.inotify.add_watch(follower.path, WATCH_MASK)
+                self.watches[follower.wd] = follower
+                return
+            except OSError as e:
+                logger.warning(f"Can't watch {follower.path} ({e}), polling it")
+        self.schedule_poll()
+
+    def release(self, follower: FileFollower) -> None:
+        """
+        Stop following a file nobody follows anymore
+        """
+        self.followers.pop(follower.path, None)
+        if follower.wd is not None:
+            self.watches.pop(follower.wd, None)
+            if self.inotify is not None:
+                self.inotify.rm_watch(follower.wd)
+            follower.wd = None
+        follower.file.close()  # No subscriber left, so no FileSpan pending on it
+
+    def on_events(self, fileobj, mask: int) -> None:
+        for event in self.inotify.read_events():
+            if event.mask & IN_Q_OVERFLOW:
+                for follower in list(self.followers.values()):
+                    follower.on_change()
+                continue
+            follower = self.watches.get(event.wd)
+            if follower is None:
+                continue
+            if event.mask & IN_IGNORED:
+                # Watch removed by the kernel (file deleted): poll until it comes back
+                self.watches.pop(event.wd, None)
+                follower.wd = None
+                self.schedule_poll()
+            elif event.mask & (IN_MOVE_SELF | IN_DELETE_SELF):
+                follower.check_rotation()
+                if follower.detached:
+                    self.schedule_poll()
+            else:
+                follower.on_change()
+
+    def schedule_poll(self) -> None:
+        if self.poll_timer is None:
+            self.poll_timer = timers.schedule(POLL_INTERVAL, self.poll)
+
+    def poll(self) -> None:
+        self.poll_timer = None
+        polled = [f for f in self.followers.values() if f.wd is None or f.detached]
+        for follower in polled:
+            follower.check_rotation()
+            if follower.wd is None:
+                follower.on_change()
+        if any(f.wd is None or f.detached for f in self.followers.values()):
+            self.schedule_poll()
+
+
+followers = FollowManager()
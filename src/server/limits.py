@@ -0,0 +1,70 @@
+from collections import deque
+from typing import Deque, Dict
+from logger import logger
+from timers import timers
+from sampler import UsageHistory, format_bytes
+from process import State
+
+
+class LimitPolicy:
+    """
+    Restart the processes which exceed the 'maxrss' or 'maxcpu' (average over
+    'cpuwindow' seconds) of their service, like the memmon event listener of
+    supervisord. Evaluated on the samples of the sampler (no extra syscall):
+    the policy is a listener of the sampler.
+    The restart is a graceful stop (stopsignal, stoptime) followed by a start,
+    at most 'limitrestarts' times per 'limitperiod' seconds for each service.
+    """
+
+    def __init__(self):
+        self.restarts: Dict[str, Deque[float]] = {}  # {service name: times of the restarts}
+        self.capped: Dict[str, float] = {}  # {service name: time of the "cap reached" warning}
+
+    def check(self, process, usage: UsageHistory) -> None:
+        props: Dict = process.props
+        if props["maxrss"] is None and props["maxcpu"] is None:
+            return
+        if process.restart_pending or process.state != State.RUNNING:
+            return
+        reason: str = ""
+        rss: int = usage.last()[1]
+        if props["maxrss"] is not None and rss > props["maxrss"]:
+            reason = f"rss {format_bytes(rss)} > maxrss {format_bytes(props['maxrss'])}"
+        elif props["maxcpu"] is not None:
+            cpu = usage.average_cpu_since(timers.now() - props["cpuwindow"])
+            if cpu is not None and cpu > props["maxcpu"]:
+                reason = f"cpu {cpu:.1f}% over {props['cpuwindow']} s > maxcpu {props['maxcpu']}%"
+        if reason:
+            self.restart(process, reason)
+
+    def allowed(self, service: str, limit: int, period: float) -> bool:
+        """
+        Record a restart of the service if it stays under the cap
+        """
+        now: float = timers.now()
+        history: Deque[float] = self.restarts.setdefault(service, deque())
+        while history and history[0] <= now - period:
+            history.popleft()
+        if len(history) >= limit:
+            if self.capped.get(service, -period) <= now - period:
+                self.capped[service] = now
+                logger.warning(
+                    f"{service}: {limit} restarts on resource limits in {period} s, not restarting anymore for now"
+                )
+            return False
+        history.append(now)
+        return True
+
+    def restart(self, process, reason: str) -> None:
+        props: Dict = process.props
+        if not self.allowed(props["name"], props["limitrestarts"], props["limitperiod"]):
+            return
+        logger.warning(f"{process.name}: {reason}: restarting")
+        process.restart()
+
+    def forget(self, service: str) -> None:
+        self.restarts.pop(service, None)
+        self.capped.pop(service, None)
+
+
+limits = LimitPolicy()
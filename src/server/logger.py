@@ -1,4 +1,5 @@
-import logging, os, pathlib, sys
+import logging, logging.handlers, os, pathlib, sys, queue, threading, time, json, datetime, atexit
+from typing import Dict, List, Optional, TextIO
 
 # Create a shared logger instance
 logger: logging.Logger = logging.getLogger("BIG-LOGGER")
@@ -9,33 +10,225 @@ logger.setLevel(logging.INFO)
 
 logger.propagate = False  # Prevent propagation to the root logger
 
+# The formats use none of these record attributes: don't collect them on the hot path
+logging.logThreads = False
+logging.logProcesses = False
+logging.logMultiprocessing = False
 
-# Create log directory alongside src directory
-PATH_LOG_FILE: str = pathlib.Path(__file__).parent.parent.parent / "log/taskmaster.log"
+
+# Create log directory alongside src directory (TASKMASTER_LOG: another log file, e.g. the benchmark)
+PATH_LOG_FILE: str = pathlib.Path(
+    os.environ.get("TASKMASTER_LOG") or pathlib.Path(__file__).parent.parent.parent / "log/taskmaster.log"
+)
 if not os.path.exists(PATH_LOG_FILE):
     PATH_LOG_FILE.parent.mkdir(exist_ok=True, parents=True)
 
-# Clear the log file
-# 'w' for overwrite mode
+QUEUE_SIZE: int = 10000  # Records waiting for the writer, dropped above
+BATCH_SIZE: int = 256  # Write as soon as this many records are waiting...
+FLUSH_INTERVAL: float = 0.1  # ...or this many seconds after the first one
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per line: {"time": ..., "level": ..., "message": ...}
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry: Dict = {
+            "time": datetime.datetime.fromtimestamp(record.created)
+            .astimezone()
+            .isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "message": record.getMessage(),
+        }
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Handler of the event loop thread: only put the record in a bounded queue.
+    When the writer can't keep up the record is dropped (and counted)
+    instead of blocking the server loop.
+    """
+
+    def __init__(self, records: queue.Queue):
+        super().__init__(records)
+        self.dropped: int = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """
+        Merge the arguments in the message now (they could change before the
+        writer formats the record). This handler is the only one of the logger:
+        the record is modified in place instead of being copied.
+        """
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LogWriter(threading.Thread):
+    """
+    Background thread writing the queued records to the log file and stdout.
+    Records are written in batches (one write per sink), the file is rotated
+    when it exceeds max_bytes.
+    """
+
+    def __init__(self, records: queue.Queue, handler: DroppingQueueHandler, path: str):
+        super().__init__(name="log-writer", daemon=True)
+        self.records: queue.Queue = records
+        self.handler: DroppingQueueHandler = handler
+        self.path: str = path
+        self.text_formatter = logging.Formatter(
+            "%(asctime)s - %(levelname)s - %(message)s", datefmt="%d %b %H:%M:%S"
+        )
+        self.file_formatter: logging.Formatter = self.text_formatter
+        self.max_bytes: int = 0  # No rotation until configure_logging
+        self.backups: int = 0
+        self.file: Optional[TextIO] = open(path, "a")
+        self.stream: TextIO = sys.stdout
+        self.written: int = 0
+        self.reported_drops: int = 0
+
+    def run(self) -> None:
+        batch: List[logging.LogRecord] = []
+        deadline: float = 0
+        stop: bool = False
+        flushed: Optional[threading.Event] = None
+        while not stop:
+            try:
+                if batch:
+                    record = self.records.get(timeout=max(deadline - time.monotonic(), 0))
+                else:
+                    record = self.records.get()
+                    deadline = time.monotonic() + FLUSH_INTERVAL
+                if record is None:
+                    stop = True  # Sentinel of stop_logging
+                elif isinstance(record, threading.Event):
+                    flushed = record  # Sentinel of flush_logging
+                else:
+                    batch.append(record)
+            except queue.Empty:
+                pass
+            if batch and (
+                stop or flushed or len(batch) >= BATCH_SIZE or time.monotonic() >= deadline
+            ):
+                self.write(batch)
+                batch = []
+            if flushed is not None:
+                flushed.set()
+                flushed = None
+
+    def write(self, batch: List[logging.LogRecord]) -> None:
+        dropped = self.handler.dropped - self.reported_drops
+        if dropped:
+            self.reported_drops += dropped
+            batch.append(
+                logging.makeLogRecord(
+                    {
+                        "levelname": "WARNING",
+                        "levelno": logging.WARNING,
+                        "msg": f"{dropped} log records dropped (logger overloaded)",
+                    }
+                )
+            )
+        self.written += len(batch)
+        text = "".join(self.text_formatter.format(r) + "\n" for r in batch)
+        if self.file is not None:
+            if self.file_formatter is not self.text_formatter:
+                data = "".join(self.file_formatter.format(r) + "\n" for r in batch)
+            else:
+                data = text
+            try:
+                self.file.write(data)
+                self.file.flush()
+                if self.max_bytes and self.file.tell() >= self.max_bytes:
+                    self.rotate()
+            except OSError as e:
+                print(f"Failed to write log file <{self.path}>: {e}", file=sys.stderr)
+        try:
+            self.stream.write(text)
+            self.stream.flush()
+        except (OSError, ValueError):
+            pass
+
+    def rotate(self) -> None:
+        """
+        taskmaster.log -> taskmaster.log.1 -> ... -> taskmaster.log.<backups>
+        """
+        self.file.close()
+        self.file = None  # Stay None (stdout only) if the new file can't be opened
+        if self.backups > 0:
+            for i in range(self.backups - 1, 0, -1):
+                if os.path.exists(f"{self.path}.{i}"):
+                    os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+            os.replace(self.path, f"{self.path}.1")
+            self.file = open(self.path, "a")
+        else:
+            self.file = open(self.path, "w")
 
-try:
-    open(PATH_LOG_FILE, "w").close()
-except Exception as e:
-    print(f"Failed to access log file <{PATH_LOG_FILE}>: {e}")
-    sys.exit(1)
 
 if not logger.handlers:
-    # Create formatter
-    formatter = logging.Formatter(
-        "%(asctime)s - %(levelname)s - %(message)s", datefmt="%d %b %H:%M:%S"
-    )
-
-    # Create file handler
-    file_handler = logging.FileHandler(PATH_LOG_FILE)
-    file_handler.setFormatter(formatter)
-    logger.addHandler(file_handler)
-
-    # Create stdout handler
-    stdout_handler = logging.StreamHandler(sys.stdout)
-    stdout_handler.setFormatter(formatter)
-    logger.addHandler(stdout_handler)
+    log_records: queue.Queue = queue.Queue(QUEUE_SIZE)
+    queue_handler = DroppingQueueHandler(log_records)
+    logger.addHandler(queue_handler)
+    log_writer = LogWriter(log_records, queue_handler, PATH_LOG_FILE)
+    log_writer.start()
+
+
+def configure_logging(server_conf: Dict) -> None:
+    """Apply the log settings of the 'server' section (format and rotation).
+    Called once taskmasterd owns its control endpoints so that a second
+    instance which fails to start doesn't rotate the log of the running one
+    (until then max_bytes is 0: no rotation).
+    """
+    if server_conf["logformat"] == "json":
+        log_writer.file_formatter = JsonFormatter()
+    log_writer.max_bytes = server_conf["logmaxbytes"]
+    log_writer.backups = server_conf["logbackups"]
+    # A log file already over max_bytes is rotated with the next batch
+
+
+def log_stats() -> Dict[str, int]:
+    """Counters of the logging pipeline"""
+    return {
+        "queued": log_records.qsize(),
+        "written": log_writer.written,
+        "dropped": queue_handler.dropped,
+    }
+
+
+def flush_logging(timeout: float = 2) -> bool:
+    """Write the records queued so far, the writer keeps running. False if it timed out"""
+    if not log_writer.is_alive():
+        return False
+    flushed = threading.Event()
+    try:
+        log_records.put(flushed, timeout=timeout)
+    except queue.Full:
+        return False
+    return flushed.wait(timeout)
+
+
+def stop_logging() -> None:
+    """Write the records still queued and stop the writer"""
+    if not log_writer.is_alive():
+        return
+    try:
+        log_records.put(None, timeout=1)
+    except queue.Full:
+        return
+    log_writer.join(timeout=2)
+
+
+atexit.register(stop_logging)
@@ -0,0 +1,4 @@
+import selectors
+
+# The selector of the server loop, shared by every module registering a file descriptor
+sel = selectors.DefaultSelector()
@@ -1,9 +1,15 @@
-import os
-from typing import List, Optional, Dict
-from service import Service, ServiceState
+import os, heapq, json
+from fnmatch import fnmatchcase
+from typing import List, Optional, Dict, Set
+from service import Service, ServiceState, serviceHash
 from logger import logger
-from config import load_config, validateConfig
+from config import ConfigLoader, indexServices
 from utils.colors import Color
+from registry import registry, ProcessRegistry
+from process import LIVE_STATES, Process, State
+from follow import followers
+from events import events
+from sampler import sampler, format_bytes
 
 
 class MasterCtl:
@@ -11,25 +17,30 @@ class MasterCtl:
         self,
         configPath: str = "",
         conf: Dict = {},
+        loader: Optional[ConfigLoader] = None,
     ):
         self.configPath = configPath
         self.fullconfig: Dict = conf
+        self.loader: ConfigLoader = loader or ConfigLoader(configPath)  # keeps the last accepted file
         self.services: Dict[str, Service] = {}  # {"name": Service}
+        self.services_config: Dict[str, Dict] = {}  # {"name": props} of the last loaded configuration
         self.pid: int = os.getpid()
+        self.registry: ProcessRegistry = registry  # processes indexed by pid and state
+        self.shutting_down: bool = False
 
     def init_services(self) -> None:
         """
         Use to instanciate services
         If a service is defined multiple times, it remains only the last defition
         """
-        i: int = 1
-        for new_serv in self.fullconfig["services"]:
-            name = new_serv["name"]
-            if name not in self.services.keys() and name not in [
-                serv["name"] for serv in self.fullconfig["services"][i:]
-            ]:
-                self.services[name] = Service(name, new_serv)
-            i += 1
+        self.services_config = indexServices(self.fullconfig)
+        # Event listeners first: they must not miss the start of the other services
+        created: Dict[str, Service] = {
+            name: Service(name, props)
+            for name, props in sorted(self.services_config.items(), key=lambda item: not item[1].get("events"))
+        }
+        for name in self.services_config:
+            self.services[name] = created[name]
 
     ###############################
     # taskmaster control commands #
@@ -77,26 +88,189 @@ class MasterCtl:
     def terminate(self) -> str:
         """
         Exit taskmaster and all its programs.
+        Only send the stop signals: the server loop exits once is_terminated()
         """
+        self.shutting_down = True
         messages: List[str] = []
         for serv in self.services.values():
             messages.append(serv.stop())
         return os.linesep.join(messages)
 
+    def kill_all(self) -> str:
+        """
+        Kill every process still running (forced shutdown)
+        """
+        messages: List[str] = []
+        for process in registry.in_states(*LIVE_STATES):
+            if process.proc is not None and process.proc.returncode is None:
+                messages.append(process.kill())
+        return os.linesep.join(messages)
+
+    def is_terminated(self) -> bool:
+        """
+        True once no process is alive (nor being spawned)
+        """
+        return not any(registry.live.values()) and not Process.backend.inflight
+
     def status(self, args: Optional[List[str]] = None) -> str:
         """
-        Display the status of the mentionned service(s). All services if not specified
+        Display the status of the mentionned service(s). All services if not specified.
+        status [-v] [--json] [--state STATE[,STATE]] [--since TOKEN] [service|glob ...]
+        -v: also the CPU and memory usage of the processes (see sampler.py)
+        --json: structured fields and the token of the snapshot
+        --state: only the processes in these states
+        glob: services or processes whose name matches (e.g. 'web*', '*_1', 'web:web_2')
+        --since: only the processes changed after this snapshot (see registry.token)
         """
+        usage: str = "Usage: status [-v] [--json] [--state STATE[,STATE]] [--since TOKEN] [service|glob ...]"
+        verbose: bool = False
+        as_json: bool = False
+        states: Optional[Set[str]] = None
+        since: Optional[int] = None
+        full: bool = False  # --since with a token of another run
+        names: List[str] = []
+        args = args or []
+        i: int = 0
+        while i < len(args):
+            if args[i] == "-v":
+                verbose = True
+            elif args[i] == "--json":
+                as_json = True
+            elif args[i] == "--state" and i + 1 < len(args):
+                i += 1
+                try:
+                    states = (states or set()) | self.parse_states(args[i])
+                except ValueError as e:
+                    return str(e)
+            elif args[i] == "--since" and i + 1 < len(args):
+                i += 1
+                try:
+                    since = registry.parse_token(args[i])
+                except ValueError:
+                    return usage
+                full = since is None  # token of another taskmasterd run: full snapshot
+            elif args[i].startswith("-"):
+                return usage
+            else:
+                names.append(args[i])
+            i += 1
+        if names == ["all"]:
+            names = []
+
         messages: List[str] = []
-        if args is None or len(args) == 0 or (args[0] == "all" and len(args) == 1):
-            for serv in self.services.values():
-                messages.append(serv.status())
+        services: Set[str] = set()  # requested by name
+        patterns: List[str] = []  # globs or process names
+        for name in names:
+            if name in self.services:
+                services.add(name)
+            elif any(
+                fnmatchcase(service.name, name) or any(fnmatchcase(process.name, name) for process in service.processes)
+                for service in self.services.values()
+            ):
+                patterns.append(name)
+            else:
+                messages.append(f"Service not found: {name}")
+        if names and not services and not patterns:
             return os.linesep.join(messages)
-        for arg in args:
-            if arg in self.services.keys():
-                messages.append(self.services[arg].status())
+
+        def selected(name: str, service: str) -> bool:
+            if not names:
+                return True
+            return service in services or any(
+                fnmatchcase(service, pattern) or fnmatchcase(name, pattern) for pattern in patterns
+            )
+
+        if since is None:
+            candidates = (
+                process
+                for service in self.services.values()
+                if not names or service.name in services or patterns
+                for process in service.processes
+            )
+            removed: List[str] = []
+        else:
+            candidates = registry.changed_since(since)
+            removed = [
+                name for name in registry.removed_since(since) if selected(name, name.split(":")[0])
+            ]
+        processes: List[Process] = [
+            process
+            for process in candidates
+            if (states is None or process.state.value in states)
+            and selected(process.name, process.props["name"])
+        ]
+        not_modified: bool = since is not None and not processes and not removed
+
+        if as_json:
+            response: Dict = {"generation": registry.token(), "not_modified": not_modified}
+            if not not_modified:
+                response["processes"] = [process.info(verbose) for process in processes]
+                if since is not None:
+                    response["removed"] = removed
+            if messages:
+                response["errors"] = messages
+            return json.dumps(response)
+        if not_modified:
+            messages.append(f"Not modified (generation {registry.token()})")
+            return os.linesep.join(messages)
+        messages += [process.status(verbose) for process in processes]
+        messages += [f"{name}: removed" for name in removed]
+        if since is not None or full:
+            messages.append(f"generation {registry.token()}")
+        return os.linesep.join(messages)
+
+    def parse_states(self, arg: str) -> Set[str]:
+        """
+        STATE[,STATE] of a --state option. ValueError on an unknown state.
+        """
+        states: Set[str] = {state.upper() for state in arg.split(",") if state}
+        unknown: Set[str] = states - {state.value for state in State}
+        if unknown:
+            raise ValueError(f"Unknown state: {', '.join(sorted(unknown))}")
+        return states
+
+    def top(self, args: Optional[List[str]] = None) -> str:
+        """
+        The processes using the most CPU (or memory with --rss).
+        top [-n N] [--rss]
+        """
+        usage: str = "Usage: top [-n N] [--rss]"
+        if not sampler.enabled:
+            return "top: ERROR (sampling disabled, set 'sampleinterval' in the 'server' section)"
+        count: int = 20
+        by_rss: bool = False
+        args = args or []
+        i: int = 0
+        while i < len(args):
+            if args[i] == "-n" and i + 1 < len(args) and args[i + 1].isdigit():
+                count = int(args[i + 1])
+                i += 1
+            elif args[i] == "--rss":
+                by_rss = True
             else:
-                messages.append(f"Service not found: {arg}")
+                return usage
+            i += 1
+        sampled = [
+            process
+            for process in registry.pids.values()
+            if process.usage is not None and process.usage.count
+        ]
+        key = 1 if by_rss else 0
+        top = heapq.nlargest(count, sampled, key=lambda p: p.usage.last()[key])
+        messages: List[str] = [
+            f"{'PROCESS':<30} {'PID':>8} {'CPU%':>7} {'AVG CPU%':>9} {'RSS':>11} {'AVG RSS':>11}"
+        ]
+        for process in top:
+            cpu, rss = process.usage.last()
+            avg_cpu, avg_rss = process.usage.average()
+            messages.append(
+                f"{process.name:<30} {process.usage.pid:>8} {cpu:>7.1f} {avg_cpu:>9.1f} "
+                f"{format_bytes(rss):>11} {format_bytes(avg_rss):>11}"
+            )
+        messages.append(
+            f"{len(sampled)} processes sampled every {sampler.delay:g} s "
+            f"(last pass {sampler.duration * 1000:.1f} ms, {sampler.history} samples kept)"
+        )
         return os.linesep.join(messages)
 
     def reload(self) -> str:
@@ -104,56 +278,60 @@ class MasterCtl:
         Reload the configuration file.
         Accept only the last defined service if the service is defined multiple times
         """
+        if self.shutting_down:
+            return "ERROR (taskmaster is shutting down)"
         logger.info("Reloading...")
         messages: List[str] = []
         try:
-            new_conf = load_config(self.configPath)
-            validateConfig(new_conf)
+            new_conf = self.loader.load()
         except Exception as e:
             logger.warning(f"Failed to reload configuration: {e}")
             messages.append(f"Failed to reload configuration: {e}")
             return os.linesep.join(messages)
+        messages.append(f"Configuration {self.loader.report}")
 
-        if new_conf == self.fullconfig:
+        if new_conf is None or new_conf == self.fullconfig:
             logger.info("Configuration didn't change")
             messages.append("Configuration didn't change")
             return os.linesep.join(messages)
 
-        # New services or known services
-        i: int = 1
-        for new_props in new_conf["services"]:
-            name = new_props["name"]
+        if new_conf.get("server") != self.fullconfig.get("server"):
+            logger.warning("'server' section changed: restart taskmaster to apply it")
+            messages.append("'server' section changed: restart taskmaster to apply it")
+
+        # Linear diff: services indexed by name, compared by hash
+        new_services: Dict[str, Dict] = indexServices(new_conf)
+        for name, new_props in new_services.items():
+            service: Optional[Service] = self.services.get(name)
+            # New
+            if service is None:
+                messages.append(f"{name}: process group added")
+                self.services[name] = Service(name, new_props)
             # Known
-            if name in self.services.keys() and name not in [
-                serv["name"] for serv in new_conf["services"][i:]
-            ]:
-                if new_props != self.services[name].props:
+            elif service.hash == serviceHash(new_props):
+                messages.append(f"{name}: process group didn't change")
+            else:
+                # Only properties of taskmaster (numprocs, stoptime...) changed: applied in place
+                message: Optional[str] = None
+                if service.state == ServiceState.NOTHING:
+                    message = service.update(new_props)
+                if message is not None:
+                    messages.append(message)
+                else:
                     messages.append(
                         f"{name}: process group updated -> will stop and start"
                     )
-                    messages.append(self.services[name].stop())
-                    self.services[name].state = ServiceState.UPDATING
+                    messages.append(service.stop())
+                    service.state = ServiceState.UPDATING
                     messages.append(f"{name}: restarting (once all its processes terminated)")
-                else:
-                    messages.append(f"{name}: process group didn't change")
-            # New
-            elif name not in [serv["name"] for serv in new_conf["services"][i:]]:
-                messages.append(f"{name}: process group added")
-                self.services[name] = Service(name, new_props)
-            i += 1
 
-        # List of services to remove
-        services_to_remove: List[str] = [
-            service.name
-            for service in self.services.values()
-            if service.name
-            not in [new_props["name"] for new_props in new_conf["services"]]
-        ]
-        # Stop and remove the service
-        for serv in services_to_remove:
-            messages.append(f"{serv}: process group removed -> will stop processes")
-            messages.append(self.services[serv].stop())
-            self.services[serv].state = ServiceState.REMOVING
+        # Stop and remove the services which are not in the configuration anymore
+        for name, service in self.services.items():
+            if name not in new_services:
+                messages.append(f"{name}: process group removed -> will stop processes")
+                messages.append(service.stop())
+                service.state = ServiceState.REMOVING
+        self.services_config = new_services
         self.fullconfig = new_conf
         return os.linesep.join(messages)
 
@@ -162,6 +340,8 @@ class MasterCtl:
         Start mentionned services. All services if not specified
         """
         messages: List[str] = []
+        if self.shutting_down:
+            return "ERROR (taskmaster is shutting down)"
         if args is None or len(args) == 0 or (len(args) == 1 and args[0] == "all"):
             for serv in self.services.values():
                 messages.append(serv.start())
@@ -211,3 +391,117 @@ class MasterCtl:
                 logger.warning(f"Service not found: {arg}")
                 messages.append(f"Service not found: {arg}")
         return os.linesep.join(messages)
+
+    def subscribe(self, conn, request_id: int, args: List[str]) -> Optional[str]:
+        """
+        subscribe [--state STATE[,STATE]] [service|glob ...]: stream the state
+        transitions of the processes on the connection, one JSON record per line
+        (frames with the id of the request, see events.py).
+        The first frame is a "==> ... <==" header, any other response is an error.
+        Return None once streaming, the error message otherwise.
+        """
+        usage: str = "Usage: subscribe [--state STATE[,STATE]] [service|glob ...]"
+        states: Optional[Set[str]] = None
+        patterns: List[str] = []  # services may be added later by a reload: no check
+        i: int = 0
+        while i < len(args):
+            if args[i] == "--state" and i + 1 < len(args):
+                i += 1
+                try:
+                    states = (states or set()) | self.parse_states(args[i])
+                except ValueError as e:
+                    return str(e)
+            elif args[i].startswith("-"):
+                return usage
+            elif args[i] != "all":
+                patterns.append(args[i])
+            i += 1
+        filters: str = " ".join(patterns) or "all"
+        if states is not None:
+            filters += f", states {','.join(sorted(states))}"
+        events.subscribe(conn, request_id, states, patterns, f"==> events ({filters}) <==")
+        logger.info(f"{conn.addr} subscribed to the events ({filters})")
+        return None
+
+    def find_process(self, name: str):
+        """
+        Find a process by its name ("service" or "service:service_N")
+        """
+        service = self.services.get(name.split(":")[0])
+        if service is None:
+            return None
+        for process in service.processes:
+            if process.name == name:
+                return process
+        return None
+
+    def parse_tail(self, args: Optional[List[str]]):
+        """
+        Parse <process> [-n N] [--stderr] [-f]. Return (process name, lines, stream, follow) or None
+        """
+        if args is None or len(args) == 0:
+            return None
+        lines: int = 10
+        stream: str = "stdout"
+        follow: bool = False
+        name: Optional[str] = None
+        i: int = 0
+        while i < len(args):
+            if args[i] == "-n" and i + 1 < len(args) and args[i + 1].isdigit():
+                lines = int(args[i + 1])
+                i += 1
+            elif args[i] == "--stderr":
+                stream = "stderr"
+            elif args[i] == "-f":
+                follow = True
+            elif name is None:
+                name = args[i]
+            else:
+                return None
+            i += 1
+        if name is None:
+            return None
+        return name, lines, stream, follow
+
+    def tail(self, args: Optional[List[str]] = None) -> str:
+        """
+        Display the last lines of the captured output of a process.
+        tail <process> [-n N] [--stderr]
+        """
+        usage: str = "Usage: tail <process> [-n N] [--stderr] [-f]"
+        parsed = self.parse_tail(args)
+        if parsed is None:
+            return usage
+        name, lines, stream, follow = parsed
+        if follow:
+            return "tail: ERROR (-f can't be used in a batch)"
+        process = self.find_process(name)
+        if process is None:
+            return f"Process not found: {name}"
+        if process.output is None:
+            return f"{process.name}: ERROR (output not captured, set 'capture' in the configuration)"
+        ring = process.output.stderr if stream == "stderr" else process.output.stdout
+        return ring.tail(lines).decode(errors="replace").rstrip("\n")
+
+    def follow(self, conn, request_id: int, args: List[str]) -> Optional[str]:
+        """
+        tail -f: stream the last lines of the stdout (or stderr) file of a process,
+        then everything appended to it, on the connection (frames with the id of the request).
+        The first frame is a "==> ... <==" header, any other response is an error.
+        Return None once streaming, the error message otherwise.
+        """
+        parsed = self.parse_tail(args)
+        if parsed is None:
+            return "Usage: tail <process> [-n N] [--stderr] [-f]"
+        name, lines, stream, _ = parsed
+        process = self.find_process(name)
+        if process is None:
+            return f"Process not found: {name}"
+        path: str = process.props[stream]
+        error = followers.follow(
+            conn, request_id, path, lines, f"==> {process.name} {stream} ({path}) <=="
+        )
+        if error is not None:
+            return f"{process.name}: ERROR ({error})"
+        logger.info(f"{conn.addr} follows {path}")
+        return None
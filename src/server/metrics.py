@@ -0,0 +1,325 @@
+import bisect, selectors, socket, time
+from typing import Callable, Dict, List, Optional, Tuple
+from logger import logger, log_stats
+from loop import sel
+from registry import registry
+from timers import timers, Timer
+from control import open_tcp_listener
+from profiling import watchdog, callback_name
+
+# Upper bounds (seconds) of the histogram buckets
+LATENCY_BUCKETS: Tuple[float, ...] = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5,
+)
+SPAWN_BUCKETS: Tuple[float, ...] = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+)
+
+MAX_REQUEST: int = 8192  # Bytes of HTTP request headers accepted
+REQUEST_TIMEOUT: float = 10  # Seconds to send a request and read the response
+CONTENT_TYPE: str = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def escape(value: str) -> str:
+    """Escape a label value of the text format"""
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Histogram:
+    """
+    Cumulative histogram with fixed buckets: observe() is one bisect and
+    three additions, the buckets are only summed when rendered.
+    """
+
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds: Tuple[float, ...] = bounds
+        self.counts: List[int] = [0] * (len(bounds) + 1)  # last one is +Inf
+        self.sum: float = 0
+        self.count: int = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name: str, labels: str, out: List[str]) -> None:
+        """labels: '' or 'key="value",' (a trailing comma)"""
+        cumulative: int = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            out.append(f'{name}_bucket{{{labels}le="{bound}"}} {cumulative}\n')
+        out.append(f'{name}_bucket{{{labels}le="+Inf"}} {self.count}\n')
+        labels = f"{{{labels.rstrip(',')}}}" if labels else ""
+        out.append(f"{name}_sum{labels} {self.sum}\n")
+        out.append(f"{name}_count{labels} {self.count}\n")
+
+
+class HistogramFamily:
+    """
+    Histograms of one metric by the value of one label (e.g. the command)
+    """
+
+    def __init__(self, name: str, label: str, bounds: Tuple[float, ...]):
+        self.name: str = name
+        self.label: str = label
+        self.bounds: Tuple[float, ...] = bounds
+        self.children: Dict[str, Histogram] = {}
+
+    def observe(self, value: str, duration: float) -> None:
+        histogram = self.children.get(value)
+        if histogram is None:
+            histogram = self.children[value] = Histogram(self.bounds)
+        histogram.observe(duration)
+
+    def render(self, out: List[str]) -> None:
+        for value, histogram in sorted(self.children.items()):
+            histogram.render(self.name, f'{self.label}="{escape(value)}",', out)
+
+
+class Metrics:
+    """
+    Metrics of the daemon. The event loop only updates numbers here, the
+    text format is built when /metrics is scraped. The per-process metrics
+    are read from the processes themselves (see render_processes).
+    """
+
+    def __init__(self):
+        self.started: float = time.time()
+        self.loop = Histogram(LATENCY_BUCKETS)
+        self.monitoring = Histogram(LATENCY_BUCKETS)
+        self.spawn = Histogram(SPAWN_BUCKETS)
+        self.commands = HistogramFamily("taskmaster_command_seconds", "command", LATENCY_BUCKETS)
+        self.scrapes: int = 0
+        self.render_seconds: float = 0  # duration of the previous rendering
+        self.labels: Dict[Tuple[str, str], str] = {}  # {(service, process): 'service="..",process=".."'}
+
+    def process_labels(self, service: str, name: str) -> str:
+        labels = self.labels.get((service, name))
+        if labels is None:
+            labels = self.labels[(service, name)] = (
+                f'service="{escape(service)}",process="{escape(name)}"'
+            )
+        return labels
+
+    def render_processes(self, out: List[str]) -> None:
+        """
+        One pass over the processes (every state of the registry), one list per
+        metric: the samples of a metric must be grouped in the text format.
+        """
+        now: float = timers.now()
+        states: List[str] = []
+        restarts: List[str] = []
+        exitcodes: List[str] = []
+        backoff: List[str] = []
+        uptime: List[str] = []
+        cpu: List[str] = []
+        rss: List[str] = []
+        for state, processes in registry.states.items():
+            value: str = state.value
+            for process in processes:
+                labels = self.process_labels(process.props["name"], process.name)
+                states.append(f'taskmaster_process_state{{{labels},state="{value}"}} 1\n')
+                restarts.append(f"taskmaster_process_restarts_total{{{labels}}} {process.restarts}\n")
+                if process.exitcode is not None:
+                    exitcodes.append(f"taskmaster_process_last_exit_code{{{labels}}} {process.exitcode}\n")
+                backoff_seconds: float = process.backoff_seconds
+                if value == "BACKOFF":
+                    backoff_seconds += now - process.since
+                backoff.append(f"taskmaster_process_backoff_seconds_total{{{labels}}} {backoff_seconds:.3f}\n")
+                uptime.append(
+                    f"taskmaster_process_uptime_seconds{{{labels}}} "
+                    f"{now - process.since if value == 'RUNNING' else 0:.3f}\n"
+                )
+                usage = process.usage
+                if usage is not None and usage.count and process.proc is not None:
+                    last_cpu, last_rss = usage.last()
+                    cpu.append(f"taskmaster_process_cpu_percent{{{labels}}} {last_cpu:.1f}\n")
+                    rss.append(f"taskmaster_process_resident_memory_bytes{{{labels}}} {last_rss}\n")
+        out.append("# HELP taskmaster_process_state Current state of the process (1 for the state label)\n")
+        out.append("# TYPE taskmaster_process_state gauge\n")
+        out.extend(states)
+        out.append("# HELP taskmaster_process_restarts_total Starts of the process after the first one\n")
+        out.append("# TYPE taskmaster_process_restarts_total counter\n")
+        out.extend(restarts)
+        out.append("# HELP taskmaster_process_last_exit_code Exit code of the last run (-N: killed by signal N)\n")
+        out.append("# TYPE taskmaster_process_last_exit_code gauge\n")
+        out.extend(exitcodes)
+        out.append("# HELP taskmaster_process_backoff_seconds_total Time spent in BACKOFF\n")
+        out.append("# TYPE taskmaster_process_backoff_seconds_total counter\n")
+        out.extend(backoff)
+        out.append("# HELP taskmaster_process_uptime_seconds Time since the process entered RUNNING (0 if not running)\n")
+        out.append("# TYPE taskmaster_process_uptime_seconds gauge\n")
+        out.extend(uptime)
+        out.append("# HELP taskmaster_process_cpu_percent CPU usage at the last sampling (% of one CPU)\n")
+        out.append("# TYPE taskmaster_process_cpu_percent gauge\n")
+        out.extend(cpu)
+        out.append("# HELP taskmaster_process_resident_memory_bytes RSS at the last sampling\n")
+        out.append("# TYPE taskmaster_process_resident_memory_bytes gauge\n")
+        out.extend(rss)
+
+    def render(self) -> bytes:
+        start: float = time.perf_counter()
+        out: List[str] = []
+        self.render_processes(out)
+        out.append("# HELP taskmaster_processes Processes by state\n")
+        out.append("# TYPE taskmaster_processes gauge\n")
+        for state, processes in registry.states.items():
+            out.append(f'taskmaster_processes{{state="{state.value}"}} {len(processes)}\n')
+        out.append("# HELP taskmaster_loop_iteration_seconds Work done by one iteration of the event loop (without the wait)\n")
+        out.append("# TYPE taskmaster_loop_iteration_seconds histogram\n")
+        self.loop.render("taskmaster_loop_iteration_seconds", "", out)
+        out.append("# HELP taskmaster_process_monitoring_seconds Duration of process_monitoring\n")
+        out.append("# TYPE taskmaster_process_monitoring_seconds histogram\n")
+        self.monitoring.render("taskmaster_process_monitoring_seconds", "", out)
+        out.append("# HELP taskmaster_command_seconds Duration of the control commands\n")
+        out.append("# TYPE taskmaster_command_seconds histogram\n")
+        self.commands.render(out)
+        out.append("# HELP taskmaster_spawn_seconds From the start request to the spawned process (fork+exec in the spawner)\n")
+        out.append("# TYPE taskmaster_spawn_seconds histogram\n")
+        self.spawn.render("taskmaster_spawn_seconds", "", out)
+        if watchdog.budget:
+            out.append("# HELP taskmaster_callback_seconds_total Time spent in each callback of the server loop\n")
+            out.append("# TYPE taskmaster_callback_seconds_total counter\n")
+            callbacks = [(escape(callback_name(c)), stats) for c, stats in watchdog.stats.items()]
+            for name, stats in callbacks:
+                out.append(f'taskmaster_callback_seconds_total{{callback="{name}"}} {stats.total:.6f}\n')
+            out.append("# HELP taskmaster_slow_callbacks_total Callbacks which ran longer than 'slowcallback'\n")
+            out.append("# TYPE taskmaster_slow_callbacks_total counter\n")
+            for name, stats in callbacks:
+                out.append(f'taskmaster_slow_callbacks_total{{callback="{name}"}} {stats.slow}\n')
+        stats: Dict[str, int] = log_stats()
+        out.append("# HELP taskmaster_log_records_queued Log records waiting for the writer\n")
+        out.append("# TYPE taskmaster_log_records_queued gauge\n")
+        out.append(f"taskmaster_log_records_queued {stats['queued']}\n")
+        out.append("# HELP taskmaster_log_records_dropped_total Log records dropped (writer overloaded)\n")
+        out.append("# TYPE taskmaster_log_records_dropped_total counter\n")
+        out.append(f"taskmaster_log_records_dropped_total {stats['dropped']}\n")
+        out.append("# HELP taskmaster_timers Pending timers of the event loop\n")
+        out.append("# TYPE taskmaster_timers gauge\n")
+        out.append(f"taskmaster_timers {len(timers)}\n")
+        out.append("# HELP taskmaster_start_time_seconds Start time of taskmaster (unix time)\n")
+        out.append("# TYPE taskmaster_start_time_seconds gauge\n")
+        out.append(f"taskmaster_start_time_seconds {self.started:.3f}\n")
+        out.append("# HELP taskmaster_metrics_render_seconds Duration of the previous rendering of the metrics\n")
+        out.append("# TYPE taskmaster_metrics_render_seconds gauge\n")
+        out.append(f"taskmaster_metrics_render_seconds {self.render_seconds:.6f}\n")
+        self.scrapes += 1
+        data: bytes = "".join(out).encode()
+        self.render_seconds = time.perf_counter() - start
+        return data
+
+
+metrics = Metrics()
+
+
+############
+# endpoint #
+############
+
+
+class HttpExchange:
+    """
+    One non-blocking HTTP/1.0 request on the metrics listener: read the request
+    headers, send the whole response, close. Driven by the selector like the
+    control connections, with a timeout for the clients which never finish.
+    """
+
+    def __init__(self, sock: socket.socket, render: Callable[[], bytes]):
+        self.sock: socket.socket = sock
+        self.render: Callable[[], bytes] = render
+        self.inbuf: bytearray = bytearray()
+        self.outbuf: Optional[memoryview] = None
+        self.closed: bool = False
+        self.sock.setblocking(False)
+        self.timer: Optional[Timer] = timers.schedule(REQUEST_TIMEOUT, self.close)
+        sel.register(self.sock, selectors.EVENT_READ, data=self.handle_event)
+
+    def handle_event(self, sock: socket.socket, mask: int) -> None:
+        try:
+            if mask & selectors.EVENT_READ and self.outbuf is None:
+                self.read()
+            if self.outbuf is not None and not self.closed:
+                self.flush()
+        except OSError:
+            self.close()
+
+    def read(self) -> None:
+        data = self.sock.recv(MAX_REQUEST)
+        if not data:
+            self.close()
+            return
+        self.inbuf += data
+        if b"\r\n\r\n" not in self.inbuf and b"\n\n" not in self.inbuf:
+            if len(self.inbuf) > MAX_REQUEST:
+                self.respond("431 Request Header Fields Too Large", b"")
+            return
+        request: List[str] = self.inbuf.split(b"\n", 1)[0].decode("latin-1").split()
+        if len(request) < 2:
+            self.respond("400 Bad Request", b"")
+        elif request[0] not in ("GET", "HEAD"):
+            self.respond("405 Method Not Allowed", b"")
+        elif request[1].split("?")[0] != "/metrics":
+            self.respond("404 Not Found", b"Try /metrics\n")
+        else:
+            self.respond("200 OK", self.render(), head=request[0] == "HEAD")
+
+    def respond(self, status: str, body: bytes, head: bool = False) -> None:
+        header: bytes = (
+            f"HTTP/1.0 {status}\r\n"
+            f"Content-Type: {CONTENT_TYPE}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n"
+        ).encode()
+        self.outbuf = memoryview(header if head else header + body)
+        sel.modify(self.sock, selectors.EVENT_WRITE, data=self.handle_event)
+
+    def flush(self) -> None:
+        try:
+            sent: int = self.sock.send(self.outbuf)
+        except (BlockingIOError, InterruptedError):
+            return
+        self.outbuf = self.outbuf[sent:]
+        if not self.outbuf:
+            self.close()
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        timers.cancel(self.timer)
+        self.timer = None
+        try:
+            sel.unregister(self.sock)
+        except (KeyError, ValueError):
+            pass
+        self.sock.close()
+
+
+class MetricsServer:
+    """
+    Local HTTP listener serving GET /metrics (Prometheus text format),
+    registered in the selector of the server loop
+    """
+
+    def __init__(self, host: str, port: int, render: Callable[[], bytes] = metrics.render):
+        self.render: Callable[[], bytes] = render
+        self.sock: socket.socket = open_tcp_listener(host, port)
+        sel.register(self.sock, selectors.EVENT_READ, data=self.accept)
+        logger.info(f"Metrics on http://{host}:{port}/metrics")
+
+    def accept(self, sock: socket.socket, mask: int) -> None:
+        while True:
+            try:
+                conn, addr = sock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            HttpExchange(conn, self.render)
+
+    def close(self) -> None:
+        try:
+            sel.unregister(self.sock)
+        except (KeyError, ValueError):
+            pass
+        self.sock.close()
@@ -1,6 +1,13 @@
-import datetime, subprocess, signal
+import datetime, subprocess, signal, os
 from enum import Enum
 from logger import logger
+from registry import registry
+from timers import timers, Timer
+from spawner import spawner
+from capture import OutputCapture
+from events import events
+from eventlisteners import listeners
+from adoption import tracker
 
 class State(Enum):
     """
@@ -17,20 +24,164 @@ class State(Enum):
     # UNKNOWN = "unknown"  # Not used in taskmaster due to the subject
 
 
+# States in which a process has a child alive (a service is not "ready" while it has one)
+LIVE_STATES = frozenset({State.STARTING, State.RUNNING, State.STOPPING})
+
+
 class Process:
-    def __init__(self, name: str, props: dict):
+    # Starts and reaps the processes: the Spawner (fork+exec) or the
+    # SimulatedBackend of simulation.py (fake processes, virtual clock)
+    backend = spawner
+
+    def __init__(self, name: str, props: dict, autostart: bool = True):
         self.name: str = name
-        self.state: State = State.STOPPED
+        self._state: State = State.STOPPED
         self.changedate: datetime.datetime | None = None
         self.props: dict = props
         self.proc: subprocess.Popen | None = None
         self.graceful_stop: bool = True
         self.current_retry: int = 1
         self.error_message: str = ""
-        if props["autostart"]:
+        self.timer: Timer | None = None  # pending starttime, stoptime or backoff deadline
+        self.spawning: bool = False  # Popen running in the spawner
+        self.killed: bool = False  # SIGKILL sent, waiting for the reaping
+        self.output: OutputCapture | None = None  # ring buffers if the service captures its output
+        self.retired: bool = False  # Removed from its service (numprocs lowered), forgotten once terminated
+        # Metrics (see metrics.py)
+        self.since: float = timers.now()  # monotonic time of the last state transition
+        self.restarts: int = 0  # starts after the first one
+        self.started: bool = False
+        self.exitcode: int | None = None  # of the last run
+        self.backoff_seconds: float = 0  # time spent in BACKOFF (before the current one)
+        self.usage = None  # UsageHistory: CPU and memory samples (see sampler.py)
+        self.restart_pending: bool = False  # start again once stopped (see restart)
+        registry.add(self, self._state, False)
+        if props["events"]:
+            listeners.join(self)
+        # autostart False: the caller decides (see Service.scale)
+        if not tracker.adopt(self) and autostart and props["autostart"]:
             self.start()
 
-    def status(self) -> str:
+    @property
+    def state(self) -> State:
+        return self._state
+
+    @state.setter
+    def state(self, new_state: State) -> None:
+        """
+        Every state transition goes through here to keep the registry indexes up to date
+        """
+        old_state: State = self._state
+        if new_state == old_state:
+            return
+        now: float = timers.now()
+        if old_state == State.BACKOFF:
+            self.backoff_seconds += now - self.since
+        if self.proc is not None and self.proc.returncode is not None:
+            self.exitcode = self.proc.returncode
+        self.since = now
+        self._state = new_state
+        registry.move(
+            self,
+            old_state,
+            new_state,
+            (new_state in LIVE_STATES) - (old_state in LIVE_STATES),
+        )
+        if events.subscribers or events.handlers:
+            # The proc of a STARTING process is the previous one (spawn pending)
+            proc = self.proc if new_state != State.STARTING else None
+            events.publish(
+                self,
+                old_state,
+                new_state,
+                proc.pid if proc is not None else None,
+                proc.returncode if proc is not None else None,
+            )
+
+    def forget(self) -> None:
+        """
+        Remove the process from the registry once it is no longer managed
+        """
+        self.cancel_deadline()
+        registry.remove(self, self._state, self._state in LIVE_STATES)
+
+    def resume(self, proc, state: str, since: float, changedate: float) -> None:
+        """
+        Take over the run of a previous taskmasterd (see adoption.py) in the saved state
+        """
+        self.proc = proc
+        self.started = True
+        self.graceful_stop = state == "STOPPING"
+        registry.add_pid(proc.pid, self)
+        self.state = State[state]
+        self.since = since
+        self.changedate = datetime.datetime.fromtimestamp(changedate)
+        if self.state == State.STARTING:
+            self.set_deadline(self.props["starttime"])
+        elif self.state == State.STOPPING:
+            self.send_stop_signal()
+
+    def drop_proc(self) -> None:
+        """
+        Forget the finished run. Its pid is unregistered here too: Popen may
+        have reaped it (send_signal, poll) without the waitpid() sweep.
+        """
+        if self.proc is not None and registry.pids.get(self.proc.pid) is self:
+            registry.pop_pid(self.proc.pid)
+        self.proc = None
+
+    def retire(self) -> str:
+        """
+        The process is no longer part of its service (numprocs lowered):
+        stop it, it is forgotten once terminated (see process_monitoring)
+        """
+        self.retired = True
+        message: str = f"{self.name}: removed"
+        if self.state in (State.STARTING, State.RUNNING):
+            message = self.stop()
+        elif self.state == State.BACKOFF:
+            self.stop()
+        if self.state not in LIVE_STATES:
+            self.forget()
+        return message
+
+    def set_deadline(self, delay: float) -> None:
+        """
+        Schedule a check of this process by the monitoring in delay seconds.
+        Replace the previous deadline if any.
+        """
+        timers.cancel(self.timer)
+        self.timer = timers.schedule(delay, registry.mark_due, self)
+
+    def cancel_deadline(self) -> None:
+        timers.cancel(self.timer)
+        self.timer = None
+
+    def deadline_reached(self) -> bool:
+        return self.timer is not None and self.timer.expired
+
+    def info(self, verbose: bool = False) -> dict:
+        """
+        Fields of status --json (with the CPU and memory usage if verbose)
+        """
+        live: bool = self.proc is not None and self.state in LIVE_STATES
+        info: dict = {
+            "name": self.name,
+            "service": self.props["name"],
+            "state": self.state.value,
+            "pid": self.proc.pid if live else None,
+            "uptime": round(timers.now() - self.since, 3) if self.state == State.RUNNING else None,
+            "exitcode": self.exitcode,
+            "retries": self.current_retry - 1,
+            "restarts": self.restarts,
+            "error": self.error_message or None,
+        }
+        if verbose and live and self.usage is not None and self.usage.count:
+            cpu, info["rss_bytes"] = self.usage.last()
+            info["cpu_percent"] = round(cpu, 1)
+        return info
+
+    def status(self, verbose: bool = False) -> str:
         message: str = ""
         if self.state == State.STARTING or self.state == State.STOPPING:
             message = (
@@ -66,6 +217,8 @@ class Process:
                 + (43 - len(self.name)) * " "
                 + f"{self.state.value}   {self.error_message}"
             )
+        if verbose and self.usage is not None and self.proc is not None:
+            message += f"{os.linesep}{45 * ' '}{self.usage.summary()}"
         return message
 
     def start(self) -> str:
@@ -77,51 +230,121 @@ class Process:
         ):
             logger.warning(f"{self.name}: ERROR (already started)")
             return f"{self.name}: ERROR (already started)"
-        if self.state == State.BACKOFF:
-            self.state = (
-                State.STARTING
-            )  # To avoid a start by monitoring on backoff state which would cause 2 differents starts
-        try:
-            with open(self.props["stdout"], "a") as f_out, open(
-                self.props["stderr"], "a"
-            ) as f_err:
-                self.proc = subprocess.Popen(
-                    self.props["cmd"].split(),
-                    stdout=f_out,
-                    stderr=f_err,
-                    stdin=subprocess.DEVNULL,
-                    text=True,
-                    umask=self.props["umask"],
-                    user=self.props["user"],
-                    cwd=self.props["workingdir"],
-                    env=self.props["env"],
-                )
-            self.graceful_stop = False
-        except Exception as e:
+        # STARTING right now: avoid a second start (e.g. by monitoring on backoff state)
+        # until the worker thread returns (see on_spawned)
+        self.state = State.STARTING
+        self.changedate = datetime.datetime.now()
+        self.cancel_deadline()
+        self.drop_proc()
+        self.restarts += self.started
+        self.started = True
+        self.spawning = True
+        self.killed = False
+        stdout, stderr = self.props["stdout"], self.props["stderr"]
+        if self.props["capture"]:
+            if self.output is None:
+                self.output = OutputCapture(self.name, self.props["capturesize"])
+            stdout, stderr = self.output.pipes(stdout, stderr)
+        stdin = subprocess.DEVNULL
+        if self.props["events"]:
+            # Event listener: stdin and stdout are the protocol (see eventlisteners.py)
+            if isinstance(stdout, int):
+                os.close(stdout)  # only stderr is captured
+            stdin, stdout = listeners.pipes(self)
+        self.backend.submit(
+            self,
+            self.props["cmd"].split(),
+            {
+                "stdout": stdout,
+                "stderr": stderr,
+                "stdin": stdin,
+                "text": True,
+                "umask": self.props["umask"],
+                "user": self.props["user"],
+                "cwd": self.props["workingdir"],
+                "env": self.props["env"],
+            },
+        )
+        logger.info(f"Starting {self.name}")
+        return f"{self.name}: starting"
+
+    def on_spawned(self, proc: subprocess.Popen | None, error: Exception | None) -> None:
+        """
+        Called in the main thread once Popen returned in the spawner
+        """
+        self.spawning = False
+        if error is not None:
             logger.critical(
-                f"Unexpected Error encountered while trying to start {self.name}: {e}"
+                f"Unexpected Error encountered while trying to start {self.name}: {error}"
             )
             self.state = State.FATAL
-            self.error_message = str(e)
+            self.error_message = str(error)
             self.changedate = datetime.datetime.now()
             self.proc = None
-            return f"{self.name}: ERROR (spawn error)"
-
-        self.state = State.STARTING
+            self.cancel_deadline()
+            if self.retired:
+                self.forget()
+            return
+        self.proc = proc
+        registry.touch(self)  # new pid
+        returncode = registry.claim(proc.pid)  # already reaped by the server loop
+        if returncode is not None:
+            proc.returncode = returncode
+        else:
+            registry.add_pid(proc.pid, self)
+        self.graceful_stop = False
+        if self.state == State.STOPPING:
+            # stop requested while spawning
+            self.graceful_stop = True
+            self.changedate = datetime.datetime.now()
+            self.send_stop_signal()
+            return
         self.changedate = datetime.datetime.now()
-        logger.info(f"Starting {self.name}")
-        return f"{self.name}: starting"
+        self.set_deadline(self.props["starttime"])
+        if returncode is not None:
+            registry.mark_due(self)
+
+    def send_stop_signal(self) -> None:
+        self.set_deadline(self.props["stoptime"])
+        self.proc.send_signal(signal.Signals[self.props["stopsignal"]].value)
+        if self.props["stoptime"] <= 0:
+            self.kill()
+        elif self.proc.returncode is not None:
+            registry.mark_due(self)  # reaped by send_signal
+        elif self.proc is not None and self.proc.returncode is not None:
+            registry.mark_due(self)
+
+    def restart(self) -> str:
+        """
+        Graceful stop (stopsignal then SIGKILL after stoptime) and start again:
+        the start is done by process_monitoring once the process is STOPPED
+        """
+        message: str = self.stop()
+        if self.state == State.STOPPING:
+            self.restart_pending = True
+        elif self.state == State.STOPPED:
+            message = self.start()
+        return message
 
     def stop(self) -> str:
         logger.info(f"Stop request for: {self.name}")
         self.current_retry = 1
+        self.restart_pending = False
         if self.proc is None and self.state == State.BACKOFF:
             self.state = State.STOPPED
             self.graceful_stop = True
             self.changedate = datetime.datetime.now()
+            self.cancel_deadline()
             logger.info(f"{self.name}: stopped")
             self.proc = None
             return f"{self.name}: stopped"
+        if self.spawning and self.state == State.STARTING:
+            # Popen not returned yet: the signal is sent by on_spawned
+            self.graceful_stop = True
+            self.state = State.STOPPING
+            self.changedate = datetime.datetime.now()
+            logger.info(f"Stopping {self.name}")
+            return f"{self.name}: stopping"
         if self.proc is not None and (
             self.state == State.RUNNING
             or self.state == State.STARTING
@@ -130,15 +353,17 @@ class Process:
             self.graceful_stop = True
             self.state = State.STOPPING
             self.changedate = datetime.datetime.now()
+            self.set_deadline(self.props["stoptime"])
+            # Popen.send_signal may reap the child (returncode set) outside the waitpid() sweep
             self.proc.send_signal(signal.Signals[self.props["stopsignal"]].value)
-            self.proc.poll()
             if self.props["stoptime"] <= 0:
                 return self.kill()
             elif self.proc.returncode is not None:
                 self.state = State.STOPPED
                 self.changedate = datetime.datetime.now()
+                self.cancel_deadline()
                 logger.info(f"{self.name}: {self.proc.pid} has been stopped")
-                self.proc = None
+                self.drop_proc()
                 logger.info(f"Stopping {self.name}")
                 return f"{self.name}: stopped"
             logger.info(f"Stopping {self.name}")
@@ -147,6 +372,10 @@ class Process:
         return f"{self.name}: ERROR (not running)"
 
     def kill(self) -> str:
+        """
+        Send SIGKILL without waiting: the process stays STOPPING until the
+        server loop reaps it (see process_monitoring)
+        """
         self.current_retry = 1
         if (
             self.proc is None
@@ -157,9 +386,10 @@ class Process:
             logger.error(f"Try to kill {self.name} but not running")
             return f"{self.name}: ERROR (not running)"
         self.proc.kill()
-        self.proc.wait()
-        self.state = State.STOPPED
-        self.changedate = datetime.datetime.now()
-        logger.info(f"{self.name}: {self.proc.pid} has been killed")
-        self.proc = None
-        return f"{self.name}: stopped (killed)"
+        self.killed = True
+        self.state = State.STOPPING
+        self.cancel_deadline()
+        logger.info(f"{self.name}: {self.proc.pid} SIGKILL sent")
+        if self.proc.returncode is not None:
+            registry.mark_due(self)
+        return f"{self.name}: stopping (killed)"
@@ -0,0 +1,143 @@
+import cProfile, io, math, os, pstats, time
+from typing import Callable, Dict, List, Optional
+from logger import logger, PATH_LOG_FILE
+from timers import timers, Timer
+
+PROFILE_DIR: str = os.path.dirname(PATH_LOG_FILE)  # pstats files are written next to the log
+TOP_FUNCTIONS: int = 15  # Functions listed in the response of 'profile stop'
+MAX_DURATION: float = 86400  # Longest 'profile start <seconds>'
+
+
+def callback_name(callback: Callable) -> str:
+    """'Class.method' or 'function' (bound methods, functions and lambdas)"""
+    return getattr(callback, "__qualname__", None) or repr(callback)
+
+
+class CallbackStats:
+    __slots__ = ("count", "total", "max", "slow")
+
+    def __init__(self):
+        self.count: int = 0
+        self.total: float = 0
+        self.max: float = 0
+        self.slow: int = 0  # calls over the budget
+
+
+class CallbackWatchdog:
+    """
+    Time every callback of the server loop (selector events, timers, monitoring)
+    and warn when one blocks the loop longer than `budget` seconds.
+    Disabled when budget is 0: the server loop then calls the callbacks directly.
+    """
+
+    def __init__(self):
+        self.budget: float = 0
+        self.stats: Dict[Callable, CallbackStats] = {}  # {code or function: stats}
+
+    def configure(self, budget: float) -> None:
+        self.budget = budget
+
+    def call(self, callback: Callable, *args) -> None:
+        start: float = time.perf_counter()
+        try:
+            callback(*args)
+        finally:
+            duration: float = time.perf_counter() - start
+            # Bound methods are new objects at each access: key on the function
+            key = getattr(callback, "__func__", callback)
+            stats = self.stats.get(key)
+            if stats is None:
+                stats = self.stats[key] = CallbackStats()
+            stats.count += 1
+            stats.total += duration
+            if duration > stats.max:
+                stats.max = duration
+            if duration > self.budget:
+                stats.slow += 1
+                logger.warning(
+                    f"Slow callback {callback_name(callback)}: {duration * 1000:.1f} ms "
+                    f"(budget {self.budget * 1000:.0f} ms)"
+                )
+
+    def report(self, limit: int = 20) -> str:
+        if not self.budget:
+            return "Callback timing disabled (set 'slowcallback' in the 'server' section)"
+        lines: List[str] = [
+            f"{'CALLBACK':<40} {'CALLS':>9} {'TOTAL ms':>10} {'AVG us':>9} {'MAX ms':>8} {'SLOW':>6}"
+        ]
+        ranked = sorted(self.stats.items(), key=lambda item: item[1].total, reverse=True)
+        for callback, stats in ranked[:limit]:
+            lines.append(
+                f"{callback_name(callback)[:40]:<40} {stats.count:>9} {stats.total * 1000:>10.1f} "
+                f"{stats.total / stats.count * 1e6:>9.1f} {stats.max * 1000:>8.1f} {stats.slow:>6}"
+            )
+        return os.linesep.join(lines)
+
+
+class Profiler:
+    """
+    On demand cProfile of the server loop (main thread) controlled by the
+    'profile' command. The stats are dumped in a pstats file (load it with
+    python3 -m pstats <file>). Nothing is hooked while it is stopped.
+    """
+
+    def __init__(self):
+        self.profile: Optional[cProfile.Profile] = None
+        self.started: float = 0
+        self.timer: Optional[Timer] = None  # stop after the given duration
+
+    def start(self, seconds: Optional[float] = None) -> str:
+        if self.profile is not None:
+            return "profile: ERROR (already running)"
+        if seconds is not None and not (math.isfinite(seconds) and 0 < seconds <= MAX_DURATION):
+            return f"profile: ERROR (duration must be between 0 and {MAX_DURATION:g} seconds)"
+        self.profile = cProfile.Profile()
+        self.started = time.time()
+        if seconds:
+            self.timer = timers.schedule(seconds, self.stop)
+        self.profile.enable()
+        logger.info("Profiling started")
+        return "profile: started" + (f" for {seconds:g} s" if seconds else "")
+
+    def stop(self) -> str:
+        if self.profile is None:
+            return "profile: ERROR (not running)"
+        self.profile.disable()
+        timers.cancel(self.timer)
+        self.timer = None
+        profile, self.profile = self.profile, None
+        path: str = os.path.join(
+            PROFILE_DIR,
+            f"taskmaster-{time.strftime('%Y%m%d-%H%M%S', time.localtime(self.started))}.pstats",
+        )
+        profile.dump_stats(path)
+        summary = io.StringIO()
+        pstats.Stats(profile, stream=summary).sort_stats("tottime").print_stats(TOP_FUNCTIONS)
+        logger.info(f"Profiling stopped: {path}")
+        return f"profile: stopped after {time.time() - self.started:.1f} s, stats in {path}{os.linesep}{summary.getvalue().strip()}"
+
+    def command(self, args: List[str]) -> str:
+        """
+        profile start [seconds] | stop | stats
+        """
+        usage: str = "Usage: profile start [seconds] | stop | stats"
+        if not args:
+            return usage
+        if args[0] == "start" and len(args) <= 2:
+            seconds: Optional[float] = None
+            if len(args) == 2:
+                try:
+                    seconds = float(args[1])
+                except ValueError:
+                    return usage
+            return self.start(seconds)
+        if args[0] == "stop" and len(args) == 1:
+            return self.stop()
+        if args[0] == "stats" and len(args) == 1:
+            state: str = "running" if self.profile is not None else "stopped"
+            return f"profile: {state}{os.linesep}{watchdog.report()}"
+        return usage
+
+
+watchdog = CallbackWatchdog()
+profiler = Profiler()
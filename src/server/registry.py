@@ -0,0 +1,148 @@
+import secrets
+from collections import defaultdict
+from typing import DefaultDict, Dict, List, Optional, Set
+
+
+class ProcessRegistry:
+    """
+    Index of the managed processes shared by the event loop and the processes.
+    Kept up to date by the Process.state and Service.state setters so that
+    the monitoring never has to walk over every process.
+    """
+
+    def __init__(self):
+        self.pids: Dict[int, object] = {}  # {pid: Process}
+        self.due: Set[object] = set()  # Processes to check at the next monitoring
+        self.states: DefaultDict[object, Set[object]] = defaultdict(set)  # {State: {Process}}
+        self.live: DefaultDict[str, int] = defaultdict(int)  # {service name: STARTING + RUNNING + STOPPING}
+        self.transitioning: Set[object] = set()  # Services REMOVING, UPDATING or RESTARTING
+        self.unclaimed: Dict[int, int] = {}  # {pid: exit code} reaped before their spawn was delivered
+        self.transitions: int = 0  # state transitions of the processes (simulation benchmark)
+        # Snapshot versioning of status --since: every change of a process seen
+        # by status (state, pid) increments the generation. The epoch tells the
+        # runs of taskmasterd apart (an upgraded one too): the generations start at 0 again
+        self.epoch: str = secrets.token_hex(4)
+        self.generation: int = 0
+        self.changed: Dict[object, int] = {}  # {Process: generation of its last change}, oldest first
+        self.removed: Dict[str, int] = {}  # {process name: generation of its removal}, oldest first
+
+    def add_pid(self, pid: int, process) -> None:
+        self.pids[pid] = process
+
+    def pop_pid(self, pid: int):
+        return self.pids.pop(pid, None)
+
+    def claim(self, pid: int) -> Optional[int]:
+        """
+        Return the exit code of pid if it was reaped before being registered
+        """
+        return self.unclaimed.pop(pid, None)
+
+    def mark_due(self, process) -> None:
+        """
+        Ask process_monitoring to check this process (child exited, deadline expired...)
+        """
+        self.due.add(process)
+
+    def touch(self, process) -> None:
+        """
+        Record a change of the process (moved to the end of changed)
+        """
+        self.generation += 1
+        self.changed.pop(process, None)
+        self.changed[process] = self.generation
+
+    def rename(self, process, old_name: str) -> None:
+        """
+        The process got a new name (numprocs scaled): the old name is reported removed
+        """
+        self.generation += 1
+        self.removed.pop(old_name, None)
+        self.removed[old_name] = self.generation
+        self.removed.pop(process.name, None)
+        self.touch(process)
+
+    def token(self) -> str:
+        """
+        Snapshot token given to status --since: <epoch>-<generation>
+        """
+        return f"{self.epoch}-{self.generation}"
+
+    def parse_token(self, token: str) -> Optional[int]:
+        """
+        Generation of a token of this run, None if it comes from another run
+        (full snapshot). Raises ValueError if it is not a token.
+        """
+        if token.isdigit():
+            return None  # generation alone, of a taskmasterd without epochs
+        epoch, sep, generation = token.rpartition("-")
+        if not sep or not epoch or not generation.isdigit():
+            raise ValueError(f"invalid token: {token}")
+        if epoch != self.epoch or int(generation) > self.generation:
+            return None
+        return int(generation)
+
+    def changed_since(self, generation: int) -> List[object]:
+        """
+        Processes changed after generation, oldest change first
+        """
+        processes: List[object] = []
+        for process, changed in reversed(self.changed.items()):
+            if changed <= generation:
+                break
+            processes.append(process)
+        processes.reverse()
+        return processes
+
+    def removed_since(self, generation: int) -> List[str]:
+        names: List[str] = []
+        for name, removed in reversed(self.removed.items()):
+            if removed <= generation:
+                break
+            names.append(name)
+        names.reverse()
+        return names
+
+    def add(self, process, state, live: bool) -> None:
+        self.states[state].add(process)
+        self.removed.pop(process.name, None)
+        self.touch(process)
+        if live:
+            self.live[process.props["name"]] += 1
+
+    def move(self, process, old_state, new_state, live_delta: int) -> None:
+        """
+        Update the indexes after a state transition of a process.
+        live_delta is +1 if the process became live, -1 if it is not live anymore.
+        """
+        self.states[old_state].discard(process)
+        self.states[new_state].add(process)
+        self.transitions += 1
+        self.touch(process)
+        if live_delta:
+            self.live[process.props["name"]] += live_delta
+
+    def remove(self, process, state, live: bool) -> None:
+        """
+        Forget a process which is no longer managed (service removed or updated)
+        """
+        self.states[state].discard(process)
+        self.due.discard(process)
+        self.changed.pop(process, None)
+        self.generation += 1
+        self.removed.pop(process.name, None)
+        self.removed[process.name] = self.generation
+        if live:
+            self.live[process.props["name"]] -= 1
+
+    def live_count(self, service_name: str) -> int:
+        return self.live.get(service_name, 0)
+
+    def in_states(self, *states) -> Set[object]:
+        processes: Set[object] = set()
+        for state in states:
+            processes |= self.states.get(state, set())
+        return processes
+
+
+registry = ProcessRegistry()
@@ -0,0 +1,241 @@
+import array, os, time
+from typing import Callable, Dict, List, Optional, Tuple
+from logger import logger
+from registry import registry
+from timers import timers, Timer
+
+CLK_TCK: int = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE: int = os.sysconf("SC_PAGE_SIZE")
+BUDGET: float = 0.01  # The sampler uses at most 1% of the server loop (the interval is stretched)
+
+
+def read_stat(pid: int) -> Optional[Tuple[int, int, int, int, int]]:
+    """
+    Parse /proc/<pid>/stat (one read, no buffering).
+    Return (ppid, utime + stime, cutime + cstime, starttime, rss pages) or None if the pid is gone.
+    rss is the same value as the resident field of /proc/<pid>/statm.
+    """
+    try:
+        fd = os.open(f"/proc/{pid}/stat", os.O_RDONLY)
+        try:
+            data: bytes = os.read(fd, 1024)
+        finally:
+            os.close(fd)
+    except OSError:
+        return None
+    # The command name (field 2) may contain spaces: split after its ')'
+    fields: List[bytes] = data[data.rfind(b")") + 2 :].split()
+    try:
+        return (
+            int(fields[1]),
+            int(fields[11]) + int(fields[12]),
+            int(fields[13]) + int(fields[14]),
+            int(fields[19]),
+            int(fields[21]),
+        )
+    except (IndexError, ValueError):
+        return None
+
+
+def read_uptime() -> float:
+    with open("/proc/uptime", "rb") as f:
+        return float(f.read().split()[0])
+
+
+def format_bytes(size: float) -> str:
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024 or unit == "GiB":
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+    return ""
+
+
+class UsageHistory:
+    """
+    Last samples of a process (time, CPU% and RSS) in fixed-size arrays used as
+    ring buffers: no allocation per sample. Reset when the process gets a new pid.
+    """
+
+    __slots__ = ("times", "cpu", "rss", "size", "index", "count", "pid", "starttime", "ticks", "time")
+
+    def __init__(self, size: int):
+        self.times: array.array = array.array("d", bytes(8 * size))  # monotonic
+        self.cpu: array.array = array.array("f", bytes(4 * size))  # % of one CPU
+        self.rss: array.array = array.array("q", bytes(8 * size))  # bytes
+        self.size: int = size
+        self.index: int = 0  # next slot
+        self.count: int = 0
+        self.pid: int = 0
+        self.starttime: int = 0  # of the pid (clock ticks after boot): detects a reused pid
+        self.ticks: int = 0  # CPU time at the last sample
+        self.time: float = 0  # monotonic time of the last sample
+
+    def reset(self, pid: int, starttime: int) -> None:
+        self.index = 0
+        self.count = 0
+        self.pid = pid
+        self.starttime = starttime
+
+    def add(self, when: float, cpu: float, rss: int) -> None:
+        self.times[self.index] = when
+        self.cpu[self.index] = cpu
+        self.rss[self.index] = rss
+        self.index = (self.index + 1) % self.size
+        if self.count < self.size:
+            self.count += 1
+
+    def last(self) -> Tuple[float, int]:
+        i: int = (self.index - 1) % self.size
+        return self.cpu[i], self.rss[i]
+
+    def average(self) -> Tuple[float, float]:
+        if self.count == self.size:
+            return sum(self.cpu) / self.count, sum(self.rss) / self.count
+        return (
+            sum(self.cpu[: self.count]) / self.count,
+            sum(self.rss[: self.count]) / self.count,
+        )
+
+    def average_cpu_since(self, since: float) -> Optional[float]:
+        """
+        Average CPU% of the samples taken after since. None until the samples
+        cover the whole window (or fill the buffer: average of the kept samples then).
+        """
+        if not self.count:
+            return None
+        oldest: int = self.index % self.size if self.count == self.size else 0
+        if self.times[oldest] > since and self.count < self.size:
+            return None
+        total: float = 0
+        count: int = 0
+        i: int = (self.index - 1) % self.size
+        for _ in range(self.count):
+            if self.times[i] < since:
+                break
+            total += self.cpu[i]
+            count += 1
+            i = (i - 1) % self.size
+        return total / count if count else None
+
+    def summary(self) -> str:
+        if not self.count:
+            return "no sample"
+        cpu, rss = self.last()
+        avg_cpu, avg_rss = self.average()
+        return (
+            f"cpu {cpu:.1f}% (avg {avg_cpu:.1f}%), "
+            f"rss {format_bytes(rss)} (avg {format_bytes(avg_rss)})"
+        )
+
+
+class Sampler:
+    """
+    Sample the CPU and memory usage of every managed pid from /proc in one
+    batched pass every `interval` seconds (a timer of the server loop).
+    With `children`, the descendants of each process are added to it (one scan
+    of /proc per pass). The cost of a pass is measured and the next pass is
+    delayed so that the sampler stays under BUDGET of the loop time.
+    """
+
+    def __init__(self):
+        self.interval: float = 0  # 0: disabled
+        self.history: int = 60
+        self.children: bool = False
+        self.timer: Optional[Timer] = None
+        self.duration: float = 0  # of the last pass
+        self.delay: float = 0  # until the next pass (interval, or more if the passes are slow)
+        self.listeners: List[Callable] = []  # called with (process, UsageHistory) after each sample
+
+    def configure(self, interval: float, history: int, children: bool) -> None:
+        self.interval = interval
+        self.history = history
+        self.children = children
+
+    @property
+    def enabled(self) -> bool:
+        return self.interval > 0
+
+    def start(self) -> None:
+        if self.enabled and self.timer is None:
+            self.delay = self.interval
+            self.timer = timers.schedule(self.interval, self.sample)
+
+    def stop(self) -> None:
+        timers.cancel(self.timer)
+        self.timer = None
+
+    def scan(self) -> Tuple[Dict[int, Tuple], Dict[int, List[int]]]:
+        """
+        Read the stat of every pid of the system: ({pid: stat}, {ppid: [child pids]})
+        """
+        stats: Dict[int, Tuple] = {}
+        children: Dict[int, List[int]] = {}
+        for entry in os.scandir("/proc"):
+            if not entry.name.isdigit():
+                continue
+            pid: int = int(entry.name)
+            stat = read_stat(pid)
+            if stat is not None:
+                stats[pid] = stat
+                children.setdefault(stat[0], []).append(pid)
+        return stats, children
+
+    def sample(self) -> None:
+        start: float = time.perf_counter()
+        self.timer = None
+        now: float = timers.now()
+        uptime: float = read_uptime()
+        stats: Dict[int, Tuple] = {}
+        tree: Dict[int, List[int]] = {}
+        if self.children:
+            stats, tree = self.scan()
+        for pid, process in list(registry.pids.items()):
+            stat = stats.get(pid) if self.children else read_stat(pid)
+            if stat is None:
+                continue  # exited, reaped at the next SIGCHLD
+            ticks: int = stat[1]
+            rss: int = stat[4]
+            if self.children:
+                ticks, rss = self.descendants(pid, stats, tree)
+            usage: Optional[UsageHistory] = process.usage
+            if usage is None or usage.size != self.history:
+                usage = process.usage = UsageHistory(self.history)
+            if usage.pid != pid or usage.starttime != stat[3]:
+                # New run: CPU% since the start of the process
+                usage.reset(pid, stat[3])
+                elapsed: float = uptime - stat[3] / CLK_TCK
+                cpu: float = ticks / CLK_TCK / elapsed * 100 if elapsed > 0 else 0
+            else:
+                elapsed = now - usage.time
+                cpu = max(ticks - usage.ticks, 0) / CLK_TCK / elapsed * 100 if elapsed > 0 else 0
+            usage.ticks = ticks
+            usage.time = now
+            usage.add(now, cpu, rss * PAGE_SIZE)
+            for listener in self.listeners:
+                listener(process, usage)
+        self.duration = time.perf_counter() - start
+        self.delay = max(self.interval, self.duration / BUDGET)
+        if self.delay > self.interval:
+            logger.debug(f"Sampling took {self.duration * 1000:.1f} ms: next one in {self.delay:.1f} s")
+        self.timer = timers.schedule(self.delay, self.sample)
+
+    def descendants(self, pid: int, stats: Dict[int, Tuple], tree: Dict[int, List[int]]) -> Tuple[int, int]:
+        """
+        CPU ticks and RSS pages of pid and its descendants. The time of the reaped
+        descendants (cutime + cstime) is counted so the total doesn't drop when one exits.
+        """
+        ticks: int = 0
+        rss: int = 0
+        stack: List[int] = [pid]
+        while stack:
+            current: int = stack.pop()
+            stat = stats.get(current)
+            if stat is None:
+                continue
+            ticks += stat[1] + stat[2]
+            rss += stat[4]
+            stack.extend(tree.get(current, ()))
+        return ticks, rss
+
+
+sampler = Sampler()
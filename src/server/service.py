@@ -1,7 +1,9 @@
-import os
+import os, hashlib, json
 from enum import Enum
-from typing import List, Dict
+from typing import List, Dict, Optional
 from process import Process
+from registry import registry
+from events import events
 
 
 class AutoRestart(Enum):
@@ -34,6 +36,36 @@ class ServiceState(Enum):
     REMOVING = "REMOVING"
 
 
+# Properties only used by taskmaster itself: a reload applies them to the running processes.
+# A change of any other property (cmd, env, stdout...) restarts the processes.
+LIVE_PROPS = frozenset(
+    {
+        "numprocs",
+        "autostart",
+        "starttime",
+        "startretries",
+        "autorestart",
+        "exitcodes",
+        "stopsignal",
+        "stoptime",
+        "maxrss",
+        "maxcpu",
+        "cpuwindow",
+        "limitrestarts",
+        "limitperiod",
+        "eventbuffer",
+        "eventbatch",
+    }
+)
+
+
+def serviceHash(props: Dict) -> str:
+    """Returns a digest of the properties of a service (independent of the key order)."""
+    return hashlib.sha1(
+        json.dumps(props, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
 class Service:
     def __init__(self, name: str, props: Dict):
         """
@@ -42,9 +74,38 @@ class Service:
         self.name: str = name
         self.props: Dict = props
         self.processes: List[Process] = []
+        self._state: ServiceState = ServiceState.NOTHING
         self.setProps(props)
         self.initProcesses()
-        self.state: ServiceState = ServiceState.NOTHING
+
+    @property
+    def state(self) -> ServiceState:
+        return self._state
+
+    @state.setter
+    def state(self, new_state: ServiceState) -> None:
+        """
+        Services waiting for their processes to terminate are indexed in the registry
+        """
+        self._state = new_state
+        if new_state == ServiceState.NOTHING:
+            registry.transitioning.discard(self)
+        else:
+            registry.transitioning.add(self)
+
+    def isReady(self) -> bool:
+        """
+        True if none of the processes of the service is STARTING, RUNNING or STOPPING
+        """
+        return registry.live_count(self.name) == 0
+
+    def forget(self) -> None:
+        """
+        Remove the processes from the registry once the service is no longer managed
+        """
+        registry.transitioning.discard(self)
+        for process in self.processes:
+            process.forget()
 
     def setProps(self, props: Dict):
         """
@@ -68,34 +129,84 @@ class Service:
         self.umask: int = props.get("umask", -1)
         self.stdout: str = props.get("stdout", "/dev/null")
         self.stderr: str = props.get("stderr", "/dev/null")
+        self.capture: bool = props.get("capture", False)
+        self.capturesize: int = props.get("capturesize", 65536)
+        self.maxrss: Optional[int] = props.get("maxrss", None)
+        self.maxcpu: Optional[float] = props.get("maxcpu", None)
+        self.cpuwindow: int = props.get("cpuwindow", 60)
+        self.limitrestarts: int = props.get("limitrestarts", 3)
+        self.limitperiod: int = props.get("limitperiod", 3600)
+        self.events: Optional[List[str]] = props.get("events", None)
+        self.eventbuffer: int = props.get("eventbuffer", 100)
+        self.eventbatch: int = props.get("eventbatch", 1)
 
         self.user: str = props.get("user", None) # for bonus
 
         self.props = props
+        self.hash: str = serviceHash(props)
+
+    def processName(self, i: int) -> str:
+        return f"{self.name}:{self.name}_{i+1}" if self.numprocs > 1 else self.name
 
     def initProcesses(self) -> None:
         """
         Initialize the processes of the service.
         """
         for i in range(self.numprocs):
-            self.processes.append(
-                Process(
-                    name=(
-                        f"{self.name}:{self.name}_{i+1}"
-                        if self.numprocs > 1
-                        else self.name
-                    ),
-                    props=self.__dict__,
-                )
-            )
+            self.processes.append(Process(name=self.processName(i), props=self.__dict__))
+
+    def update(self, props: Dict) -> Optional[str]:
+        """
+        Apply new properties without restarting the processes when only LIVE_PROPS changed.
+        Return None if the processes have to be restarted.
+        """
+        changed = {
+            key
+            for key in self.props.keys() | props.keys()
+            if self.props.get(key) != props.get(key)
+        }
+        if not changed <= LIVE_PROPS:
+            return None
+        self.setProps(props)
+        messages: List[str] = [
+            f"{self.name}: process group updated in place ({', '.join(sorted(changed))})"
+        ]
+        if len(self.processes) != self.numprocs:
+            messages.append(self.scale())
+        return os.linesep.join(messages)
+
+    def scale(self) -> str:
+        """
+        numprocs changed: spawn the missing processes or stop the surplus ones.
+        The other processes keep running.
+        """
+        messages: List[str] = []
+        running: bool = registry.live_count(self.name) > 0
+        while len(self.processes) > self.numprocs:
+            messages.append(self.processes.pop().retire())
+        # The names depend on numprocs ("web" <-> "web:web_1")
+        for i, process in enumerate(self.processes):
+            old_name: str = process.name
+            process.name = self.processName(i)
+            if process.name != old_name:
+                registry.rename(process, old_name)
+                events.renamed(old_name)
+        for i in range(len(self.processes), self.numprocs):
+            process = Process(name=self.processName(i), props=self.__dict__, autostart=False)
+            self.processes.append(process)
+            messages.append(f"{process.name}: added")
+            if running:
+                # Started like its siblings (not if they were stopped)
+                messages.append(process.start())
+        return os.linesep.join(messages)
 
-    def status(self) -> str:
+    def status(self, verbose: bool = False) -> str:
         """
-        Return the status of the service.
+        Return the status of the service (with the CPU and memory usage if verbose).
         """
         messages: List[str] = []
         for process in self.processes:
-            messages.append(process.status())
+            messages.append(process.status(verbose))
         return os.linesep.join(messages)
 
     def start(self) -> str:
@@ -0,0 +1,222 @@
+import heapq, itertools, math, random, signal, time
+from array import array
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+from registry import registry
+from timers import timers
+from process import Process
+
+# A duration in seconds, or (min, max): drawn at random (seeded) for each process
+Duration = Union[float, Tuple[float, float]]
+
+SPAWN, EXIT = 0, 1  # Kinds of events of the SimulatedBackend
+
+
+class VirtualClock:
+    """
+    Monotonic clock moved forward by the simulation only (see timers.MonotonicClock)
+    """
+
+    def __init__(self, start: float = 0):
+        self.time: float = start
+
+    def now(self) -> float:
+        return self.time
+
+    def advance_to(self, when: float) -> None:
+        if when > self.time:
+            self.time = when
+
+
+class Behavior:
+    """
+    Script of a simulated command (the first word of 'cmd'):
+    lifetime: seconds before it exits by itself with exitcode (None: runs until stopped)
+    spawn_delay: duration of the fork+exec
+    stop_delay: seconds to exit after the stop signal (ignore_stop: only SIGKILL stops it)
+    spawn_error: the spawn fails with this message (like a missing executable)
+    """
+
+    def __init__(
+        self,
+        lifetime: Optional[Duration] = None,
+        exitcode: int = 0,
+        spawn_delay: Duration = 0,
+        stop_delay: Duration = 0,
+        ignore_stop: bool = False,
+        spawn_error: Optional[str] = None,
+    ):
+        self.lifetime: Optional[Duration] = lifetime
+        self.exitcode: int = exitcode
+        self.spawn_delay: Duration = spawn_delay
+        self.stop_delay: Duration = stop_delay
+        self.ignore_stop: bool = ignore_stop
+        self.spawn_error: Optional[str] = spawn_error
+
+
+class FakeProc:
+    """
+    Stand-in for subprocess.Popen: what Process uses of it
+    """
+
+    __slots__ = ("backend", "pid", "behavior", "returncode", "exited")
+
+    def __init__(self, backend: "SimulatedBackend", pid: int, behavior: Behavior):
+        self.backend: SimulatedBackend = backend
+        self.pid: int = pid
+        self.behavior: Behavior = behavior
+        self.returncode: Optional[int] = None  # set once reaped, like Popen
+        self.exited: bool = False  # zombie or reaped
+
+    def poll(self) -> Optional[int]:
+        if self.returncode is None and self.pid in self.backend.zombies:
+            self.returncode = self.backend.zombies.pop(self.pid)
+        return self.returncode
+
+    def send_signal(self, sig: int) -> None:
+        self.backend.signal(self, sig)
+
+    def kill(self) -> None:
+        self.backend.signal(self, signal.SIGKILL)
+
+
+class SimulatedBackend:
+    """
+    Process backend (see Process.backend) without any real process: the spawns
+    and exits are events on the virtual clock, scripted by the Behavior of each
+    command. Deterministic for a given seed.
+    """
+
+    def __init__(self, clock: VirtualClock, behaviors: Dict[str, Behavior], seed: int = 0):
+        self.clock: VirtualClock = clock
+        self.behaviors: Dict[str, Behavior] = behaviors
+        self.default: Behavior = Behavior()
+        self.random: random.Random = random.Random(seed)
+        self.events: List[Tuple[float, int, int, object]] = []  # (time, sequence, kind, data)
+        self.sequence = itertools.count()
+        self.pids = itertools.count(1000)
+        self.zombies: Dict[int, int] = {}  # {pid: exit code} exited, not reaped yet
+        self.inflight: int = 0
+        self.spawns: int = 0
+
+    def draw(self, duration: Duration) -> float:
+        if isinstance(duration, tuple):
+            return self.random.uniform(*duration)
+        return duration
+
+    def push(self, delay: float, kind: int, data) -> None:
+        heapq.heappush(self.events, (self.clock.now() + delay, next(self.sequence), kind, data))
+
+    def submit(self, process, argv: List[str], popen_kwargs: Dict) -> None:
+        self.inflight += 1
+        behavior: Behavior = self.behaviors.get(argv[0], self.default)
+        self.push(self.draw(behavior.spawn_delay), SPAWN, (process, behavior))
+
+    def signal(self, proc: FakeProc, sig: int) -> None:
+        if proc.exited:
+            return
+        if sig == signal.SIGKILL:
+            self.push(0, EXIT, (proc, -signal.SIGKILL))
+        elif not proc.behavior.ignore_stop:
+            self.push(self.draw(proc.behavior.stop_delay), EXIT, (proc, -sig))
+
+    def next_event(self) -> Optional[float]:
+        return self.events[0][0] if self.events else None
+
+    def deliver(self) -> None:
+        """
+        Apply the events due at the current time (spawns done, processes exited)
+        """
+        now: float = self.clock.now()
+        while self.events and self.events[0][0] <= now:
+            _, _, kind, data = heapq.heappop(self.events)
+            if kind == SPAWN:
+                process, behavior = data
+                self.inflight -= 1
+                self.spawns += 1
+                if behavior.spawn_error is not None:
+                    process.on_spawned(None, OSError(behavior.spawn_error))
+                    continue
+                proc = FakeProc(self, next(self.pids), behavior)
+                if behavior.lifetime is not None:
+                    self.push(self.draw(behavior.lifetime), EXIT, (proc, behavior.exitcode))
+                process.on_spawned(proc, None)
+            else:
+                proc, returncode = data
+                if not proc.exited:  # the first exit wins (stop signal vs end of lifetime)
+                    proc.exited = True
+                    self.zombies[proc.pid] = returncode
+
+    def reap(self) -> Iterator[Tuple[int, int]]:
+        zombies, self.zombies = self.zombies, {}
+        for pid, returncode in zombies.items():
+            yield pid, returncode
+
+
+class Simulation:
+    """
+    Run the supervision of taskmasterd (timers, reaping and process_monitoring)
+    on simulated processes with a virtual clock: the loop jumps from one event
+    to the next instead of waiting. Events closer than `resolution` are handled
+    in the same iteration, like the server loop does under load.
+    """
+
+    def __init__(self, config: Dict, behaviors: Dict[str, Behavior], seed: int = 0, resolution: float = 0.01):
+        import taskmasterd
+
+        taskmasterd.load_modules()
+        self.daemon = taskmasterd
+        self.clock: VirtualClock = VirtualClock()
+        timers.clock = self.clock
+        self.backend: SimulatedBackend = SimulatedBackend(self.clock, behaviors, seed)
+        Process.backend = self.backend
+        self.resolution: float = resolution
+        self.master = taskmasterd.MasterCtl("", config)
+        taskmasterd.master = self.master
+        self.ticks: int = 0
+        self.tick_seconds: array = array("d")  # wall time of each iteration
+
+    def start(self) -> None:
+        """Create the services (and start the autostart processes)"""
+        self.master.init_services()
+
+    def tick(self) -> None:
+        start: float = time.perf_counter()
+        self.backend.deliver()
+        timers.run_expired()
+        self.daemon.reap_children()
+        self.daemon.process_monitoring()
+        self.tick_seconds.append(time.perf_counter() - start)
+        self.ticks += 1
+
+    def next_time(self) -> Optional[float]:
+        """Virtual time of the next iteration (None if nothing is pending)"""
+        if registry.due or self.backend.zombies:
+            return self.clock.now()
+        candidates: List[float] = []
+        timeout: Optional[float] = timers.next_timeout()
+        if timeout is not None:
+            candidates.append(self.clock.now() + timeout)
+        event: Optional[float] = self.backend.next_event()
+        if event is not None:
+            candidates.append(event)
+        if not candidates:
+            return None
+        when: float = min(candidates)
+        # Rounded up to the resolution (never below when: float rounding)
+        return max(when, math.ceil(when / self.resolution) * self.resolution)
+
+    def run(self, duration: float, until=None) -> bool:
+        """
+        Run for duration virtual seconds, or until until() is true.
+        Return True if until() became true.
+        """
+        end: float = self.clock.now() + duration
+        while True:
+            self.tick()
+            if until is not None and until():
+                return True
+            when: Optional[float] = self.next_time()
+            if when is None or when > end:
+                self.clock.advance_to(end)
+                return False
+            self.clock.advance_to(when)
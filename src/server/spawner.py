@@ -0,0 +1,120 @@
+import os, queue, subprocess, time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, Optional, Tuple
+from logger import logger
+from metrics import metrics
+
+
+class Spawner:
+    """
+    Run the fork+exec of the processes (subprocess.Popen) in a bounded pool of
+    worker threads so that starting many processes never blocks the server loop.
+    The results are handed back to the main thread through a queue and a pipe
+    registered in the selector: the state transitions stay in the main thread.
+
+    This is the process backend of Process (see Process.backend):
+    submit() starts a process, reap() returns the exited children, inflight
+    counts the spawns not delivered yet (see simulation.SimulatedBackend).
+    """
+
+    def __init__(self, concurrency: int = 8):
+        self.concurrency: int = concurrency
+        self.pool: Optional[ThreadPoolExecutor] = None
+        self.results: queue.SimpleQueue = queue.SimpleQueue()
+        self.inflight: int = 0  # Spawns submitted and not delivered yet
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        os.set_blocking(self.wakeup_r, False)
+        os.set_blocking(self.wakeup_w, False)
+
+    def configure(self, concurrency: int) -> None:
+        """
+        Set the maximum number of simultaneous spawns (before the first spawn)
+        """
+        if self.pool is None:
+            self.concurrency = concurrency
+
+    def fileno(self) -> int:
+        return self.wakeup_r
+
+    def submit(self, process, argv, popen_kwargs: Dict) -> None:
+        """
+        Spawn the process in a worker thread. process.on_spawned(proc, error)
+        is called from the main thread (see deliver) once Popen returned.
+        """
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(
+                max_workers=self.concurrency, thread_name_prefix="spawner"
+            )
+        self.inflight += 1
+        self.pool.submit(self._spawn, process, argv, popen_kwargs, time.monotonic())
+
+    def _spawn(self, process, argv, popen_kwargs: Dict, submitted: float) -> None:
+        """
+        Worker thread: only fork+exec here, no state change
+        """
+        proc: Optional[subprocess.Popen] = None
+        error: Optional[Exception] = None
+        streams: Dict = {name: popen_kwargs.pop(name) for name in ("stdin", "stdout", "stderr")}
+        # Pipes (capture.py, eventlisteners.py) are fds: closed here once the child is forked
+        pipes = [fd for fd in streams.values() if isinstance(fd, int) and fd >= 0]
+        files = []
+        try:
+            for name in ("stdout", "stderr"):
+                if isinstance(streams[name], str):
+                    streams[name] = open(streams[name], "a")
+                    files.append(streams[name])
+            proc = subprocess.Popen(argv, **streams, **popen_kwargs)
+        except Exception as e:
+            error = e
+        finally:
+            for f in files:
+                f.close()
+            for fd in pipes:
+                os.close(fd)
+        self.results.put((process, proc, error, submitted))
+        try:
+            os.write(self.wakeup_w, b"\0")
+        except BlockingIOError:
+            pass  # The pipe is full: the main thread is already woken up
+
+    def deliver(self, fd: int, mask: int) -> None:
+        """
+        Main thread (selector callback): apply the results of the finished spawns
+        """
+        try:
+            while os.read(self.wakeup_r, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        while True:
+            try:
+                process, proc, error, submitted = self.results.get_nowait()
+            except queue.Empty:
+                break
+            self.inflight -= 1
+            metrics.spawn.observe(time.monotonic() - submitted)
+            try:
+                process.on_spawned(proc, error)
+            except Exception as e:
+                logger.critical(f"{process.name}: error after spawn: {e}")
+
+    def reap(self) -> Iterator[Tuple[int, int]]:
+        """
+        (pid, exit code) of every exited child, in one waitpid() sweep.
+        The exit code is the one Popen.returncode would have (-N if killed by signal N).
+        """
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            yield pid, os.waitstatus_to_exitcode(status)
+
+    def shutdown(self) -> None:
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+spawner = Spawner()
@@ -1,23 +1,43 @@
-import socket, selectors, signal, sys, argparse, os, datetime
-from typing import List, Tuple, Dict
+import socket, selectors, signal, sys, argparse, os, datetime, time, json
+from typing import Callable, List, Tuple, Dict, Optional, Set
+from loop import sel
 
 ####################
 # Global variables #
 ####################
 
-sel = selectors.DefaultSelector()
 shutdown_flag = False
+sigchld_flag = False  # Set by SIGCHLD, cleared once the children are reaped
+pending_signals: List[int] = []  # Signals received, handled by the server loop
+exit_code: int = 0
+unix_allowed_uids: Set[int] = set()  # Peers allowed on the unix control socket
+config_watcher = None  # ConfigWatcher if 'watch' is set in the 'server' section
+metrics_server = None  # MetricsServer if 'metrics' is set in the 'server' section
+control_listeners: List[socket.socket] = []  # Control endpoints (given to the new taskmasterd by upgrade)
+UPGRADE_RETRY: float = 0.05  # Seconds between two checks of the spawns in flight before the upgrade exec
+UPGRADE_WAIT: float = 5  # Seconds waiting for them before refusing the upgrade
 
 
 def load_modules():
-    global logger, MasterCtl, load_config, validateConfig, State, AutoRestart, Service, ServiceState, Color
+    global logger, configure_logging, flush_logging, MasterCtl, ConfigLoader, State, AutoRestart, Service, ServiceState, Process, Color, registry, timers, Connection, serverConfig, open_unix_listener, open_tcp_listener, peer_credentials, allowed_uids, spawner, ConfigWatcher, metrics, MetricsServer, sampler, limits, watchdog, profiler, listeners, tracker, UPGRADE_ENV, STATE_DIR
     from utils.colors import Color
-    from logger import logger
+    from logger import logger, configure_logging, flush_logging
     from masterctl import MasterCtl
     from service import Service, ServiceState
-    from process import State
+    from process import State, Process
     from service import AutoRestart
-    from config import load_config, validateConfig
+    from config import ConfigLoader, serverConfig
+    from registry import registry
+    from timers import timers
+    from control import Connection, open_unix_listener, open_tcp_listener, peer_credentials, allowed_uids
+    from spawner import spawner
+    from watcher import ConfigWatcher
+    from metrics import metrics, MetricsServer
+    from sampler import sampler
+    from limits import limits
+    from profiling import watchdog, profiler
+    from eventlisteners import listeners
+    from adoption import tracker, UPGRADE_ENV, STATE_DIR
 
 
 ###########
@@ -27,23 +47,61 @@ def load_modules():
 
 def signal_handler(sig, frame) -> None:
     """Handle signals (TERM, INT, QUIT, HUP).
-    Calls the exit method of masterctl for TERM, INT, QUIT then exit with 128 + signumber.
-    Reload the configuration file for HUP
+    Only queue the signal: it is handled by the server loop (see handle_signals)
+    so that no state changes in the middle of a monitoring pass.
     """
-    # 'global' refers to the existing global variable (create it if not exist)
-    global master
-    global shutdown_flag
+    pending_signals.append(sig)
 
-    logger.warning(
-        f"Taskmaster (pid={master.pid}) received {signal.Signals(sig).name}({sig})"
-    )
-    if sig == signal.SIGHUP:
-        master.reload()
-    else:
+
+def handle_signals() -> None:
+    """
+    TERM, INT, QUIT: stop all the programs then exit with 128 + signumber
+    (a second one kills the remaining programs and exits right away).
+    HUP: reload the configuration file
+    """
+    while pending_signals:
+        sig = pending_signals.pop(0)
+        logger.warning(
+            f"Taskmaster (pid={master.pid}) received {signal.Signals(sig).name}({sig})"
+        )
+        if sig == signal.SIGHUP:
+            reload_config()
+        else:
+            request_shutdown(128 + sig)
+
+
+def request_shutdown(code: int) -> str:
+    """
+    Stop every process and leave the server loop once they all terminated.
+    Each process gets its stopsignal at once and SIGKILL when its own stoptime expires.
+    """
+    # 'global' refers to the existing global variable (create it if not exist)
+    global shutdown_flag, exit_code
+    if master.shutting_down:
+        logger.warning("Shutdown forced: killing the remaining processes")
+        message = master.kill_all()
         shutdown_flag = True
-        sel.close()
-        master.terminate()
-        sys.exit(128 + sig)
+        return message
+    exit_code = code
+    logger.info("Shutting down: stopping all the processes...")
+    return master.terminate()
+
+
+def sigchld_handler(sig, frame) -> None:
+    """Only flag the exit of a child: reaping is done by the server loop.
+    The signal wakes the loop up through the wakeup fd (see init_signal_handling)
+    """
+    global sigchld_flag
+    sigchld_flag = True
+
+
+def drain_wakeup_fd(fd: int, mask: int) -> None:
+    """Empty the self-pipe written by the signal module on each signal"""
+    try:
+        while os.read(fd, 4096):
+            pass
+    except BlockingIOError:
+        pass
 
 
 def init_signal_handling() -> None:
@@ -51,6 +109,40 @@ def init_signal_handling() -> None:
     signal.signal(signal.SIGQUIT, signal_handler)
     signal.signal(signal.SIGHUP, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
+    signal.signal(signal.SIGCHLD, sigchld_handler)
+
+    # Self-pipe: each handled signal writes a byte in it and wakes up sel.select()
+    wakeup_r, wakeup_w = os.pipe()
+    os.set_blocking(wakeup_r, False)
+    os.set_blocking(wakeup_w, False)
+    signal.set_wakeup_fd(wakeup_w, warn_on_full_buffer=False)
+    sel.register(wakeup_r, selectors.EVENT_READ, data=drain_wakeup_fd)
+
+
+def reap_children() -> None:
+    """Reap every exited child (one waitpid() sweep with the Spawner).
+    The exit code is stored in the Popen object like Popen.poll() would do
+    """
+    global sigchld_flag
+    sigchld_flag = False
+    for pid, returncode in Process.backend.reap():
+        process = registry.pop_pid(pid)
+        if process is None and Process.backend.inflight:
+            # Exited before its spawn was delivered to the main thread
+            registry.unclaimed[pid] = returncode
+            continue
+        if process is None or process.proc is None or process.proc.pid != pid:
+            logger.debug(f"Reaped unmanaged child {pid}")
+            continue
+        process.proc.returncode = returncode
+        registry.mark_due(process)
+
+
+def deliver_spawns(fd: int, mask: int) -> None:
+    """Apply the results of the spawns done by the worker threads"""
+    spawner.deliver(fd, mask)
+    if not spawner.inflight:
+        registry.unclaimed.clear()
 
 
 ##############
@@ -64,200 +156,167 @@ def process_monitoring():
     services_ready_to_update: List[Service] = []  # After a reload request
     services_ready_to_restart: List[Service] = []  # After a restart request
 
-    ## Manage Reload and Restart
-    for service in master.services.values():
-        ## Services removed
-        if service.state == ServiceState.REMOVING:
-            isReady: bool = False
-            for process in service.processes:
-                if (
-                    process.state == State.STARTING
-                    or process.state == State.STOPPING
-                    or process.state == State.RUNNING
-                ):
-                    isReady = False
-                    break
-                else:
-                    isReady = True
-            if isReady:
-                services_ready_to_remove.append(service)
-
-        ## Services updated
-        if service.state == ServiceState.UPDATING:
-            isReady: bool = False
-            for process in service.processes:
-                if (
-                    process.state == State.STARTING
-                    or process.state == State.STOPPING
-                    or process.state == State.RUNNING
-                ):
-                    isReady = False
-                    break
-                else:
-                    isReady = True
-            if isReady:
-                services_ready_to_update.append(service)
-
-        ## Services restarted
-        if service.state == ServiceState.RESTARTING:
-            isReady: bool = False
-            for process in service.processes:
-                if (
-                    process.state == State.STARTING
-                    or process.state == State.STOPPING
-                    or process.state == State.RUNNING
-                ):
-                    isReady = False
-                    break
-                else:
-                    isReady = True
-            if isReady:
-                services_ready_to_restart.append(service)
-
-        for process in service.processes:
-            ## Check BACKOFF process
-            if process.proc is None and process.state == State.BACKOFF:
-                if process.current_retry > service.startretries:
-                    logger.critical(f"{process.name}: reached maximum retries")
-                    process.state = State.FATAL
-                    process.changedate = datetime.datetime.now()
-                    process.current_retry = 1
-                elif datetime.datetime.now() - process.changedate > datetime.timedelta(
-                    seconds=process.current_retry
-                ):
-                    logger.info(
-                        f"{process.name}: retrying to start ({process.current_retry})"
-                    )
+    ## Check the processes with a pending event (child exited or deadline expired)
+    due, registry.due = registry.due, set()
+    for process in due:
+        props: Dict = process.props
+
+        ## Check BACKOFF process
+        if process.proc is None and process.state == State.BACKOFF:
+            if process.current_retry > props["startretries"]:
+                logger.critical(f"{process.name}: reached maximum retries")
+                process.state = State.FATAL
+                process.changedate = datetime.datetime.now()
+                process.current_retry = 1
+                process.cancel_deadline()
+            elif process.deadline_reached():
+                logger.info(
+                    f"{process.name}: retrying to start ({process.current_retry})"
+                )
+                process.start()
+                process.current_retry += 1
+
+        ## Check EXITED process
+        if process.proc is not None and process.state == State.EXITED:
+            if master.shutting_down:
+                process.drop_proc()  # no restart while shutting down
+            elif props["autorestart"] == AutoRestart.ALWAYS.value:
+                # process.proc = None
+                try:
+                    logger.info(f"{process.name}: unconditional restart")
                     process.start()
-                    process.current_retry += 1
-
-            ## Check EXITED process
-            if process.proc is not None and process.state == State.EXITED:
-                if service.autorestart == AutoRestart.ALWAYS.value:
-                    # process.proc = None
-                    try:
-                        logger.info(f"{process.name}: unconditional restart")
-                        process.start()
-                    except Exception as e:
-                        logger.critical(f"{process.name} Error restarting: {e}")
-                elif (
-                    service.autorestart == AutoRestart.UNEXPECTED.value
-                    and abs(process.proc.returncode) not in service.exitcodes
-                ):
-                    # process.proc = None
-                    try:
-                        logger.info(f"{process.name}: conditional restart")
-                        process.start()
-                    except Exception as e:
-                        logger.critical(
-                            f"{process.name}: Error restarting process: {e}"
-                        )
-                else:
-                    process.proc = None
-
-            ## Check RUNNING process
-            if process.proc is not None and process.state == State.RUNNING:
-                process.proc.poll()
-                if process.proc.returncode is not None:
-                    process.state = State.EXITED
-                    process.changedate = datetime.datetime.now()
-                    if abs(process.proc.returncode) in service.exitcodes:
-                        logger.error(
-                            f"{process.name}: {process.proc.pid} exited expectedly with code {abs(process.proc.returncode)}"
-                        )
-                    else:
-                        logger.error(
-                            f"{process.name}: {process.proc.pid} exited unexpectedly with code {abs(process.proc.returncode)}"
-                        )
-                    process.current_retry = 1
-
-            ## Check STARTING process
-            if process.proc is not None and process.state == State.STARTING:
-                process.proc.poll()
-                # Success
-                if (
-                    process.proc.returncode is None
-                    and datetime.datetime.now() - process.changedate
-                    >= datetime.timedelta(seconds=service.starttime)
-                ):
-                    process.state = State.RUNNING
-                    process.changedate = datetime.datetime.now()
-                    logger.info(
-                        f"{process.name}: {process.proc.pid} is in running state for now"
+                except Exception as e:
+                    logger.critical(f"{process.name} Error restarting: {e}")
+            elif (
+                props["autorestart"] == AutoRestart.UNEXPECTED.value
+                and abs(process.proc.returncode) not in props["exitcodes"]
+            ):
+                # process.proc = None
+                try:
+                    logger.info(f"{process.name}: conditional restart")
+                    process.start()
+                except Exception as e:
+                    logger.critical(f"{process.name}: Error restarting process: {e}")
+            else:
+                process.drop_proc()
+
+        ## Check RUNNING process
+        if process.proc is not None and process.state == State.RUNNING:
+            if process.proc.returncode is not None:
+                process.state = State.EXITED
+                process.changedate = datetime.datetime.now()
+                if abs(process.proc.returncode) in props["exitcodes"]:
+                    logger.error(
+                        f"{process.name}: {process.proc.pid} exited expectedly with code {abs(process.proc.returncode)}"
                     )
-                    process.current_retry = 1
-                # Success but exited immediatly
-                elif (
-                    process.proc.returncode is not None
-                    and datetime.datetime.now() - process.changedate
-                    >= datetime.timedelta(seconds=service.starttime)
-                ):
-                    process.state = State.EXITED
-                    process.changedate = datetime.datetime.now()
-                    if abs(process.proc.returncode) in service.exitcodes:
-                        logger.error(
-                            f"{process.name}: {process.proc.pid} exited expectedly with code {abs(process.proc.returncode)} immediatly after enter in running state"
-                        )
-                    else:
-                        logger.error(
-                            f"{process.name}: {process.proc.pid} exited unexpectedly with code {abs(process.proc.returncode)} immediatly after enter in running state"
-                        )
-                    process.current_retry = 1
-
-                # Failed before enter in running state
-                elif (
-                    process.proc.returncode is not None
-                    and datetime.datetime.now() - process.changedate
-                    < datetime.timedelta(seconds=service.starttime)
-                ):
-                    process.state = State.BACKOFF
-                    process.changedate = datetime.datetime.now()
+                else:
                     logger.error(
-                        f"{process.name}: {process.proc.pid} failed with exit code {abs(process.proc.returncode)} during starting"
+                        f"{process.name}: {process.proc.pid} exited unexpectedly with code {abs(process.proc.returncode)}"
                     )
-                    process.error_message = (
-                        "Exited too quickly (process log may have details)"
+                process.current_retry = 1
+                registry.mark_due(process)  # autorestart at the next loop
+
+        ## Check STARTING process
+        if process.proc is not None and process.state == State.STARTING:
+            # Success
+            if process.proc.returncode is None and process.deadline_reached():
+                process.state = State.RUNNING
+                process.changedate = datetime.datetime.now()
+                logger.info(
+                    f"{process.name}: {process.proc.pid} is in running state for now"
+                )
+                process.current_retry = 1
+                process.cancel_deadline()
+            # Success but exited immediatly
+            elif process.proc.returncode is not None and process.deadline_reached():
+                process.state = State.EXITED
+                process.changedate = datetime.datetime.now()
+                if abs(process.proc.returncode) in props["exitcodes"]:
+                    logger.error(
+                        f"{process.name}: {process.proc.pid} exited expectedly with code {abs(process.proc.returncode)} immediatly after enter in running state"
                     )
-                    process.proc = None
-
-            ## Check STOPPING process
-            if process.proc is not None and process.state == State.STOPPING:
-                # If didn't stop after stop time
-                if datetime.datetime.now() - process.changedate >= datetime.timedelta(
-                    seconds=service.stoptime
-                ):
+                else:
                     logger.error(
-                        f"{process.name}: {process.proc.pid} didn't stop in time"
+                        f"{process.name}: {process.proc.pid} exited unexpectedly with code {abs(process.proc.returncode)} immediatly after enter in running state"
                     )
-                    process.kill()
-                # If stopped before time
+                process.current_retry = 1
+                process.cancel_deadline()
+                registry.mark_due(process)  # autorestart at the next loop
+
+            # Failed before enter in running state
+            elif process.proc.returncode is not None:
+                process.state = State.BACKOFF
+                process.changedate = datetime.datetime.now()
+                logger.error(
+                    f"{process.name}: {process.proc.pid} failed with exit code {abs(process.proc.returncode)} during starting"
+                )
+                process.error_message = (
+                    "Exited too quickly (process log may have details)"
+                )
+                process.drop_proc()
+                # Retry after current_retry seconds (or give up right now)
+                process.set_deadline(
+                    0
+                    if process.current_retry > props["startretries"]
+                    else process.current_retry
+                )
+
+        ## Check STOPPING process
+        if process.proc is not None and process.state == State.STOPPING:
+            # If stopped before time (or killed)
+            if process.proc.returncode is not None:
+                process.state = State.STOPPED
+                process.changedate = datetime.datetime.now()
+                if process.killed:
+                    logger.info(f"{process.name}: {process.proc.pid} has been killed")
                 else:
-                    process.proc.poll()
-                    if process.proc.returncode is not None:
-                        process.state = State.STOPPED
-                        process.changedate = datetime.datetime.now()
-                        logger.info(
-                            f"{process.name}: {process.proc.pid} has been stopped"
-                        )
-                        process.proc = None
-        # Then: do nothing and wait for the next loop to check again
+                    logger.info(f"{process.name}: {process.proc.pid} has been stopped")
+                process.drop_proc()
+                process.cancel_deadline()
+                if process.retired:
+                    process.forget()
+                elif process.restart_pending:
+                    process.restart_pending = False
+                    service = master.services.get(props["name"])
+                    if not master.shutting_down and service is not None and service.state == ServiceState.NOTHING:
+                        logger.info(f"{process.name}: restarting after stop")
+                        process.start()
+            # If didn't stop after stop time
+            elif process.deadline_reached():
+                logger.error(f"{process.name}: {process.proc.pid} didn't stop in time")
+                process.kill()
+    # Then: do nothing and wait for the next event on these processes
+
+    ## Manage Reload and Restart (only the services waiting for their processes)
+    for service in registry.transitioning:
+        if not service.isReady() or master.shutting_down:
+            continue
+        ## Services removed
+        if service.state == ServiceState.REMOVING:
+            services_ready_to_remove.append(service)
+        ## Services updated
+        elif service.state == ServiceState.UPDATING:
+            services_ready_to_update.append(service)
+        ## Services restarted
+        elif service.state == ServiceState.RESTARTING:
+            services_ready_to_restart.append(service)
 
     # Remove services after reload
     for service in services_ready_to_remove:
         if master.services.get(service.name) is not None:
             master.services.get(service.name).state = ServiceState.NOTHING
-            master.services.pop(service.name)
+            master.services.pop(service.name).forget()
+            limits.forget(service.name)
+            listeners.forget(service.name)
             logger.info(f"{service.name}: well terminated -> is no longer managed")
 
     # Update services after reload (remove then recreate)
     for service in services_ready_to_update:
         if master.services.get(service.name) is not None:
             serv_name: str = service.name
-            for props in master.fullconfig["services"]:
-                if props["name"] == serv_name:
-                    new_props: Dict = props
+            new_props: Dict = master.services_config[serv_name]
             master.services.get(service.name).state = ServiceState.NOTHING
-            master.services.pop(service.name)
+            master.services.pop(service.name).forget()
             logger.info(f"{serv_name}: well terminated -> updating")
             master.services[serv_name] = Service(serv_name, new_props)
 
@@ -268,92 +327,285 @@ def process_monitoring():
             master.services.get(service.name).start()
 
 
+def next_timeout() -> Optional[float]:
+    """
+    Return the number of seconds until the next deadline of a process
+    (starttime, stoptime or backoff delay). None if nothing is pending:
+    the server loop then sleeps until a signal or a client wakes it up.
+    """
+    if registry.due:
+        return 0
+    return timers.next_timeout()
+
+
 ####################
 #   Server loop    #
 ####################
 
 
-def select_action(cmd: str, args: List[str]) -> str:
-    global shutdown_flag
-    if cmd == "shutdown":
-        # just like SIGTERM handling
-        shutdown_flag = True
-        sel.close()
-        master.terminate()
-        sys.exit(0)
-    if cmd == "start":
-        return master.start(args)
-    if cmd == "stop":
-        return master.stop(args)
-    if cmd == "restart":
-        return master.restart(args)
-    if cmd == "status":
-        return master.status(args)
-    if cmd == "avail":
-        return master.avail()
-    if cmd == "availx":
-        return master.availX()
-    if cmd == "availxl":
-        return master.availXL()
-    if cmd == "reload":
-        return master.reload()
-    return f"Unknown command: {cmd}"
-
-
-def handle_client(conn: socket.socket) -> None:
-    addr = conn.getpeername()
-    try:
-        data = conn.recv(8192)
-        if data:
-            message = data.decode().strip()
-            logger.info(f"Received from {addr}: {message}")
-            response = select_action(message.split()[0], message.split()[1:])
-            conn.sendall(response.encode())
+def reload_config(args: Optional[List[str]] = None) -> str:
+    """
+    Reload (control command, SIGHUP or config watcher)
+    """
+    message: str = master.reload()
+    if config_watcher is not None:
+        config_watcher.refresh()  # the include patterns may have changed
+    return message
+
+
+def shutdown(args: List[str]) -> str:
+    # just like SIGTERM handling
+    return request_shutdown(0)
+
+
+def upgrade(conn: "Connection", request_id: int) -> Optional[str]:
+    """
+    Re-exec taskmasterd (new code) without stopping the processes: the new
+    one inherits the control sockets and adopts the processes (see adoption.py).
+    The new taskmasterd answers on the same connection (the old one if the exec failed).
+    """
+    if master.shutting_down:
+        return "upgrade: ERROR (shutting down)"
+    if spawner.inflight:
+        return "upgrade: ERROR (processes being spawned, try again)"
+    # Once the callbacks of this loop iteration ran: the other requests read
+    # with this one are answered by this taskmasterd (they may spawn, see exec_upgrade)
+    timers.schedule(0, exec_upgrade, conn, request_id, timers.now() + UPGRADE_WAIT)
+    return None
+
+
+def exec_upgrade(conn: "Connection", request_id: int, deadline: float) -> None:
+    # A spawn submitted since the upgrade command (pipelined start, autorestart)
+    # would be lost by the exec: wait until it is delivered
+    if master.shutting_down:
+        conn.send("upgrade: ERROR (shutting down)", request_id)
+        return
+    if spawner.inflight:
+        if timers.now() < deadline:
+            timers.schedule(UPGRADE_RETRY, exec_upgrade, conn, request_id, deadline)
         else:
-            logger.info(f"Connection closed by {addr}")
-            sel.unregister(conn)
-            conn.close()
-    except ConnectionResetError:
-        logger.warning(f"Connection reset by {addr}")
-        sel.unregister(conn)
-        conn.close()
-    except Exception as e:
-        logger.error(f"Error with {addr}: {e}")
-        sel.unregister(conn)
-        conn.close()
+            conn.send("upgrade: ERROR (processes being spawned, try again)", request_id)
+        return
+    path: str = tracker.path or os.path.join(STATE_DIR, f"taskmaster-upgrade-{master.pid}.state")
+    tracker.write(path)
+    fds: List[int] = [sock.fileno() for sock in control_listeners]
+    client: Optional[int] = None if conn.closed else conn.sock.fileno()
+    for fd in fds + ([client] if client is not None else []):
+        os.set_inheritable(fd, True)
+    os.environ[UPGRADE_ENV] = json.dumps({"fds": fds, "state": path, "client": client, "request_id": request_id})
+    logger.warning(f"Upgrade: exec {' '.join(sys.argv)}")
+    flush_logging()  # the records queued would be lost with the exec
+    try:
+        os.execv(sys.executable, [sys.executable] + sys.argv)
+    except OSError as e:
+        del os.environ[UPGRADE_ENV]
+        for fd in fds + ([client] if client is not None else []):
+            os.set_inheritable(fd, False)
+        if path != tracker.path:
+            os.unlink(path)
+        logger.error(f"Upgrade failed: {e}")
+        conn.send(f"upgrade: ERROR ({e})", request_id)
+
+
+def resume_upgrade_client(fd: int, request_id: int) -> None:
+    """
+    Answer the upgrade command on the connection inherited from the previous taskmasterd
+    """
+    sock = socket.socket(fileno=fd)
+    sock.set_inheritable(False)
+    addr = sock.getpeername()
+    if sock.family == socket.AF_UNIX:
+        pid, uid, gid = peer_credentials(sock)
+        addr = f"pid={pid} uid={uid} gid={gid}"
+    conn = Connection(sock, addr, sel, handle_message)
+    conn.send(f"upgrade: taskmasterd re-executed (pid {master.pid})", request_id)
 
 
-def accept_connection(sock):
-    conn, addr = sock.accept()
-    logger.info(f"Accept connection from {addr}")
-    conn.setblocking(False)
-    sel.register(conn, selectors.EVENT_READ, data=handle_client)
+def batch(args: List[str]) -> str:
+    """
+    Run several commands separated by ';' in one message:
+    batch start web ; stop worker ; status
+    """
+    messages: List[str] = []
+    for command in " ".join(args).split(";"):
+        if not command.split():
+            continue
+        cmd, cmd_args = command.split()[0], command.split()[1:]
+        if cmd == "batch":
+            messages.append("batch: ERROR (nested batch)")
+            continue
+        messages.append(select_action(cmd, cmd_args))
+    return os.linesep.join(messages)
+
+
+# Control commands: name -> function(args) returning the response
+ACTIONS: Dict[str, Callable[[List[str]], str]] = {
+    "shutdown": shutdown,
+    "start": lambda args: master.start(args),
+    "stop": lambda args: master.stop(args),
+    "restart": lambda args: master.restart(args),
+    "status": lambda args: master.status(args),
+    "avail": lambda args: master.avail(),
+    "availx": lambda args: master.availX(),
+    "availxl": lambda args: master.availXL(),
+    "reload": reload_config,
+    "tail": lambda args: master.tail(args),
+    "top": lambda args: master.top(args),
+    "profile": lambda args: profiler.command(args),
+    "batch": batch,
+}
 
 
-def run_server(host="0.0.0.0", port=65432):
+def select_action(cmd: str, args: List[str]) -> str:
+    action = ACTIONS.get(cmd)
+    if action is None:
+        return f"Unknown command: {cmd}"
+    start: float = time.perf_counter()
+    try:
+        return action(args)
+    finally:
+        metrics.commands.observe(cmd, time.perf_counter() - start)
+
+
+def handle_message(conn: "Connection", request_id: int, message: str) -> Optional[str]:
+    logger.info(f"Received from {conn.addr} (#{request_id}): {message}")
+    if not message.split():
+        return "Empty command"
+    cmd, args = message.split()[0], message.split()[1:]
+    if cmd == "tail" and "-f" in args:
+        # Stream: the responses are sent on the connection as the file grows
+        return master.follow(conn, request_id, args)
+    if cmd == "subscribe":
+        # Stream: the state transitions are sent on the connection (see events.py)
+        return master.subscribe(conn, request_id, args)
+    if cmd == "upgrade":
+        # Answered once re-executed, by the new taskmasterd
+        return upgrade(conn, request_id)
+    return select_action(cmd, args)
+
+
+def accept_connection(sock: socket.socket, mask: int) -> None:
+    # Accept every pending connection at once (burst of controllers)
+    while True:
+        try:
+            conn, addr = sock.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        if conn.family == socket.AF_UNIX:
+            pid, uid, gid = peer_credentials(conn)
+            addr = f"pid={pid} uid={uid} gid={gid}"
+            if uid not in unix_allowed_uids:
+                logger.warning(f"Refused connection from {addr}: user not allowed")
+                conn.close()
+                continue
+        logger.info(f"Accept connection from {addr}")
+        Connection(conn, addr, sel, handle_message)
+
+
+def open_listeners(server_conf: Dict, inherited: List[int]) -> List[socket.socket]:
+    """
+    Bind the control endpoints (unix socket and/or TCP) configured in the 'server' section.
+    Raise if one of them can't be bound (e.g. another taskmaster is running).
+    After an upgrade, the inherited endpoints are used as they are.
+    """
+    global unix_allowed_uids
+    if inherited:
+        if server_conf["unixsocket"]:
+            unix_allowed_uids = allowed_uids(server_conf["unixusers"])
+        listeners = [socket.socket(fileno=fd) for fd in inherited]
+        for sock in listeners:
+            sock.set_inheritable(False)
+        return listeners
+    listeners: List[socket.socket] = []
+    try:
+        if server_conf["unixsocket"]:
+            listeners.append(
+                open_unix_listener(server_conf["unixsocket"], server_conf["unixmode"])
+            )
+            unix_allowed_uids = allowed_uids(server_conf["unixusers"])
+        if server_conf["tcp"]:
+            listeners.append(
+                open_tcp_listener(server_conf["host"], server_conf["port"])
+            )
+    except Exception:
+        close_listeners(listeners)
+        raise
+    if not listeners:
+        raise ValueError("No control endpoint: enable 'unixsocket' and/or 'tcp'")
+    return listeners
+
+
+def open_metrics(server_conf: Dict, listeners: List[socket.socket]):
+    """
+    Bind the metrics endpoint if enabled (the control listeners are closed if it fails)
+    """
+    if not server_conf["metrics"]:
+        return None
+    try:
+        return MetricsServer(server_conf["metricshost"], server_conf["metricsport"])
+    except Exception:
+        close_listeners(listeners)
+        raise
+
+
+def close_listeners(listeners: List[socket.socket]) -> None:
+    for sock in listeners:
+        if sock.family == socket.AF_UNIX:
+            try:
+                os.unlink(sock.getsockname())
+            except OSError:
+                pass
+        sock.close()
 
-    server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
+def run_server(listeners: List[socket.socket]):
+    global shutdown_flag
     try:
-        server_sock.bind((host, port))
-        server_sock.listen()
-        server_sock.setblocking(False)
-        sel.register(server_sock, selectors.EVENT_READ, data=accept_connection)
-        logger.info(f"Server listening on {host}:{port}")
+        for sock in listeners:
+            sel.register(sock, selectors.EVENT_READ, data=accept_connection)
+            logger.info(f"Server listening on {sock.getsockname()}")
         while not shutdown_flag:
-            events = sel.select(timeout=0.005)
-            for key, mask in events:
-                callback = key.data
-                callback(key.fileobj)
-            if not events:
+            # Sleep until a signal (SIGCHLD...), a client or the next deadline
+            events = sel.select(timeout=next_timeout())
+            start: float = time.perf_counter()
+            if watchdog.budget:
+                # Time every callback (see 'slowcallback')
+                for key, mask in events:
+                    watchdog.call(key.data, key.fileobj, mask)
+                if pending_signals:
+                    watchdog.call(handle_signals)
+                timers.run_expired(watchdog.call)
+                if sigchld_flag:
+                    watchdog.call(reap_children)
+                monitoring_start: float = time.perf_counter()
+                watchdog.call(process_monitoring)
+            else:
+                for key, mask in events:
+                    callback = key.data
+                    callback(key.fileobj, mask)
+                if pending_signals:
+                    handle_signals()
+                timers.run_expired()
+                if sigchld_flag:
+                    reap_children()
+                monitoring_start = time.perf_counter()
                 process_monitoring()
-                pass
+            end: float = time.perf_counter()
+            metrics.monitoring.observe(end - monitoring_start)
+            metrics.loop.observe(end - start)
+            tracker.changed()
+            if master.shutting_down and master.is_terminated():
+                shutdown_flag = True
     except Exception as e:
         logger.error(f"Server error: {e}")
     finally:
         logger.info("Cleaning up server...")
-        server_sock.close()
+        if master.shutting_down and master.is_terminated():
+            tracker.remove()  # else (crash) the next taskmasterd adopts the processes
+        close_listeners(listeners)
+        if metrics_server is not None:
+            metrics_server.close()
+        spawner.shutdown()
         sel.close()
         logger.info("Taskmaster exited")
 
@@ -391,36 +643,63 @@ def startup_parsing() -> Tuple[str, str]:
 
 
 def taskmasterd() -> None:
+    global metrics_server, control_listeners, sigchld_flag
     config_file, log_level = startup_parsing()  # log_level = "INFO" if not specified
     logger.setLevel(log_level)
+    # Started by upgrade: the control sockets and the state file of the previous taskmasterd
+    upgraded: Dict = json.loads(os.environ.pop(UPGRADE_ENV, "{}"))
 
     try:
-        config = load_config(config_file)
-        validateConfig(config)
+        loader = ConfigLoader(config_file)
+        config = loader.load()
+        # Bind before spawning anything: fail if another taskmaster owns the endpoints
+        control_listeners = open_listeners(serverConfig(config), upgraded.get("fds", []))
+        metrics_server = open_metrics(serverConfig(config), control_listeners)
     except Exception as e:
         logger.error(e)
         print(f"ERROR: failed to start taskmaster: {e}")
         exit(1)
+    configure_logging(serverConfig(config))
 
     # refer to the existing global variable
-    global master
-    master = MasterCtl(config_file, config)
+    global master, config_watcher
+    master = MasterCtl(config_file, config, loader)
 
     init_signal_handling()
     logger.info(f"Taskmaster is running - pid: {master.pid}")
+    spawner.configure(serverConfig(config)["spawnconcurrency"])
+    sel.register(spawner, selectors.EVENT_READ, data=deliver_spawns)
+    # Adopt the processes of the previous taskmasterd instead of starting them
+    tracker.configure(serverConfig(config)["statefile"])
+    state_file: str = upgraded.get("state", tracker.path)
+    if state_file:
+        tracker.load(state_file)
+        if state_file != tracker.path and os.path.exists(state_file):
+            os.unlink(state_file)
     master.init_services()
-    run_server()
+    tracker.finish()
+    sigchld_flag = True  # children exited during the upgrade
+    sampler.configure(
+        serverConfig(config)["sampleinterval"],
+        serverConfig(config)["samplehistory"],
+        serverConfig(config)["samplechildren"],
+    )
+    sampler.listeners.append(limits.check)
+    watchdog.configure(serverConfig(config)["slowcallback"])
+    sampler.start()
+    if serverConfig(config)["watch"]:
+        config_watcher = ConfigWatcher(
+            loader, reload_config, serverConfig(config)["watchdebounce"]
+        )
+    if upgraded.get("client") is not None:
+        try:
+            resume_upgrade_client(upgraded["client"], upgraded["request_id"])
+        except OSError as e:
+            logger.warning(f"Upgrade: controller gone ({e})")
+    run_server(control_listeners)
+    sys.exit(exit_code)
 
 
 if __name__ == "__main__":
-    try:
-        test = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        test.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        test.bind(("0.0.0.0", 65432))
-    except Exception as e:
-        print(f"Error: {e}")
-        os._exit(1)
-    else:
-        test.close()
-        load_modules()
-        taskmasterd()
+    load_modules()
+    taskmasterd()
@@ -0,0 +1,113 @@
+import heapq, itertools, time
+from typing import Callable, List, Optional, Tuple
+
+MAX_TIMEOUT: float = 86400  # Longest sleep of the server loop (a far deadline can't overflow select())
+
+
+class Timer:
+    """
+    A deadline scheduled in the TimerHeap. Can be cancelled before it expires.
+    """
+
+    __slots__ = ("deadline", "callback", "args", "cancelled", "expired")
+
+    def __init__(self, deadline: float, callback: Callable, args: Tuple):
+        self.deadline: float = deadline  # timers.now() based
+        self.callback: Callable = callback
+        self.args: Tuple = args
+        self.cancelled: bool = False
+        self.expired: bool = False
+
+    def cancel(self) -> None:
+        self.cancelled = True
+
+
+class MonotonicClock:
+    """
+    Clock of the timers and of the process state machine (see simulation.VirtualClock)
+    """
+
+    def now(self) -> float:
+        return time.monotonic()
+
+
+class TimerHeap:
+    """
+    Min-heap of deadlines keyed on the monotonic clock.
+    Cancelled timers are dropped lazily when they reach the top of the heap
+    (or all at once when they become the majority of the heap).
+    """
+
+    def __init__(self):
+        self._heap: List[Tuple[float, int, Timer]] = []
+        self._counter = itertools.count()  # tie-breaker: Timer is not comparable
+        self._cancelled: int = 0
+        self.clock = MonotonicClock()  # replaced by a virtual clock in the simulation
+
+    def __len__(self) -> int:
+        return len(self._heap) - self._cancelled
+
+    def now(self) -> float:
+        return self.clock.now()
+
+    def schedule(self, delay: float, callback: Callable, *args) -> Timer:
+        """
+        Call callback(*args) in delay seconds.
+        """
+        timer = Timer(self.now() + max(delay, 0), callback, args)
+        heapq.heappush(self._heap, (timer.deadline, next(self._counter), timer))
+        return timer
+
+    def cancel(self, timer: Optional[Timer]) -> None:
+        if timer is None or timer.cancelled or timer.expired:
+            return
+        timer.cancel()
+        self._cancelled += 1
+        if self._cancelled > 64 and self._cancelled > len(self._heap) // 2:
+            self._heap = [entry for entry in self._heap if not entry[2].cancelled]
+            heapq.heapify(self._heap)
+            self._cancelled = 0
+
+    def _drop_cancelled(self) -> None:
+        while self._heap and self._heap[0][2].cancelled:
+            heapq.heappop(self._heap)
+            self._cancelled -= 1
+
+    def next_timeout(self) -> Optional[float]:
+        """
+        Seconds until the next deadline (at most MAX_TIMEOUT), None if there is no pending timer.
+        """
+        self._drop_cancelled()
+        if not self._heap:
+            return None
+        timeout: float = self._heap[0][0] - self.now()
+        if not timeout < MAX_TIMEOUT:  # also inf and nan
+            return MAX_TIMEOUT
+        return max(timeout, 0)
+
+    def run_expired(self, call: Optional[Callable] = None) -> int:
+        """
+        Run the callbacks of every expired timer. Return the number of timers run.
+        call(callback, *args) runs the callbacks if given (see profiling.CallbackWatchdog).
+        """
+        now = self.now()
+        count: int = 0
+        while self._heap:
+            deadline, _, timer = self._heap[0]
+            if timer.cancelled:
+                heapq.heappop(self._heap)
+                self._cancelled -= 1
+                continue
+            if deadline > now:
+                break
+            heapq.heappop(self._heap)
+            timer.expired = True
+            if call is None:
+                timer.callback(*timer.args)
+            else:
+                call(timer.callback, *timer.args)
+            count += 1
+        return count
+
+
+timers = TimerHeap()
@@ -0,0 +1,175 @@
+import fnmatch, glob, os, selectors
+from typing import Callable, Dict, List, Optional, Set, Tuple
+from logger import logger
+from loop import sel
+from timers import timers, Timer
+from utils.inotify import (
+    Inotify,
+    IN_CLOSE_WRITE,
+    IN_CREATE,
+    IN_DELETE,
+    IN_MOVED_FROM,
+    IN_MOVED_TO,
+    IN_DELETE_SELF,
+    IN_MOVE_SELF,
+    IN_IGNORED,
+    IN_Q_OVERFLOW,
+    IN_ONLYDIR,
+)
+
+# Directories are watched (not the files): an editor writing a temporary file
+# and renaming it over the configuration replaces the inode of the file.
+WATCH_MASK: int = (
+    IN_CLOSE_WRITE
+    | IN_CREATE
+    | IN_DELETE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+    | IN_ONLYDIR
+)
+MAX_DELAY_FACTOR: int = 10  # A burst delays the reload by at most 10 debounce windows
+
+
+class ConfigWatcher:
+    """
+    Watch the configuration file and its included files, and call reload once
+    the changes stop for `debounce` seconds. Uses inotify on the directories of
+    the files, or polls their stat() if inotify is not available.
+    """
+
+    def __init__(self, loader, reload: Callable[[], str], debounce: float):
+        self.loader = loader  # ConfigLoader: configuration file and include patterns
+        self.reload: Callable[[], str] = reload
+        self.debounce: float = debounce
+        self.patterns: Dict[str, List[str]] = {}  # {directory: [file name patterns]}
+        self.inotify: Optional[Inotify] = None
+        self.watches: Dict[int, str] = {}  # {inotify watch: directory}
+        self.timer: Optional[Timer] = None  # pending reload
+        self.first_event: Optional[float] = None  # start of the current burst
+        self.poll_timer: Optional[Timer] = None
+        self.signature: Optional[Tuple] = None  # stat of the files (polling)
+        try:
+            self.inotify = Inotify()
+            sel.register(self.inotify, selectors.EVENT_READ, data=self.on_events)
+        except OSError as e:
+            logger.warning(f"inotify not available ({e}), polling the configuration files")
+        self.refresh()
+
+    def refresh(self) -> None:
+        """
+        Update the watched directories (the include patterns may have changed)
+        """
+        patterns: Dict[str, List[str]] = {}
+        config_path: str = os.path.abspath(self.loader.configPath)
+        patterns.setdefault(os.path.dirname(config_path), []).append(
+            os.path.basename(config_path)
+        )
+        base: str = os.path.dirname(config_path)
+        document: Dict = self.loader.config or {}
+        for pattern in document.get("include", []):
+            pattern = os.path.join(base, os.path.expanduser(pattern))
+            directory, name = os.path.split(pattern)
+            # Directories given by a pattern (e.g. services/*/conf.yml)
+            for d in glob.glob(directory) if glob.has_magic(directory) else [directory]:
+                patterns.setdefault(d, []).append(name)
+        self.patterns = patterns
+        if self.inotify is not None:
+            self.update_watches()
+        else:
+            self.signature = self.stat_signature()
+            self.schedule_poll()
+
+    def update_watches(self) -> None:
+        directories: Set[str] = set(self.patterns)
+        for wd, directory in list(self.watches.items()):
+            if directory not in directories:
+                self.inotify.rm_watch(wd)
+                del self.watches[wd]
+        watched: Set[str] = set(self.watches.values())
+        for directory in directories - watched:
+            try:
+                self.watches[self.inotify.add_watch(directory, WATCH_MASK)] = directory
+            except OSError as e:
+                logger.warning(f"Can't watch {directory}: {e}")
+
+    def matches(self, directory: str, name: str) -> bool:
+        """
+        True if name is the configuration file or matches an include pattern.
+        Like glob, hidden files (editor swap files...) only match hidden patterns.
+        """
+        for pattern in self.patterns.get(directory, []):
+            if name.startswith(".") and not pattern.startswith("."):
+                continue
+            if fnmatch.fnmatch(name, pattern):
+                return True
+        return False
+
+    def on_events(self, fileobj, mask: int) -> None:
+        changed: bool = False
+        for event in self.inotify.read_events():
+            if event.mask & IN_Q_OVERFLOW:
+                changed = True
+                continue
+            directory: Optional[str] = self.watches.get(event.wd)
+            if directory is None:
+                continue
+            if event.mask & IN_IGNORED:
+                # Directory removed: watched again at the next refresh
+                del self.watches[event.wd]
+                changed = True
+            elif event.mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                changed = True
+            elif self.matches(directory, event.name):
+                changed = True
+        if changed:
+            self.changed()
+
+    def changed(self) -> None:
+        """
+        Debounce: reload once no change happened for `debounce` seconds
+        (or at most MAX_DELAY_FACTOR windows after the first change of a burst)
+        """
+        now: float = timers.now()
+        if self.first_event is None:
+            self.first_event = now
+        delay: float = min(
+            self.debounce, self.first_event + self.debounce * MAX_DELAY_FACTOR - now
+        )
+        timers.cancel(self.timer)
+        self.timer = timers.schedule(delay, self.fire)
+
+    def fire(self) -> None:
+        self.timer = None
+        self.first_event = None
+        logger.info("Configuration changed on disk: reloading")
+        self.reload()
+
+    ###########
+    # polling #
+    ###########
+
+    def stat_signature(self) -> Tuple:
+        entries: List[Tuple] = []
+        for directory, names in sorted(self.patterns.items()):
+            for name in names:
+                for path in sorted(glob.glob(os.path.join(directory, name))):
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    entries.append((path, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns))
+        return tuple(entries)
+
+    def schedule_poll(self) -> None:
+        if self.poll_timer is None:
+            self.poll_timer = timers.schedule(max(self.debounce, 1), self.poll)
+
+    def poll(self) -> None:
+        self.poll_timer = None
+        signature: Tuple = self.stat_signature()
+        if signature != self.signature:
+            self.signature = signature
+            self.changed()
+        self.schedule_poll()
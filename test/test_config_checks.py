@@ -0,0 +1,50 @@
+import os, sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "server"))
+
+from config import DocumentValidator, ServiceValidator, checkDocument, checkService
+
+
+def document(server=None):
+    config = {"services": [{"name": "web", "cmd": "sleep 1000"}]}
+    if server is not None:
+        config["server"] = server
+    return config
+
+
+@pytest.mark.parametrize("field", ["watchdebounce", "sampleinterval", "slowcallback"])
+@pytest.mark.parametrize("value", [True, False])
+def test_server_number_rejects_bool(field, value):
+    config = document({field: value})
+    assert not checkDocument(config)
+    assert not DocumentValidator.validate(config)
+
+
+@pytest.mark.parametrize("value", [True, False])
+def test_service_number_rejects_bool(value):
+    service = {"name": "web", "cmd": "sleep 1000", "maxcpu": value}
+    assert not checkService(service)
+    assert not ServiceValidator.validate(service)
+
+
+@pytest.mark.parametrize("field", ["watchdebounce", "sampleinterval", "slowcallback"])
+@pytest.mark.parametrize("value", [0, 1, 0.5])
+def test_server_number_accepts_numbers(field, value):
+    config = document({field: value})
+    assert checkDocument(config)
+    assert DocumentValidator.validate(config)
+
+
+@pytest.mark.parametrize("value", [0, 50, 12.5])
+def test_service_number_accepts_numbers(value):
+    service = {"name": "web", "cmd": "sleep 1000", "maxcpu": value}
+    assert checkService(service)
+    assert ServiceValidator.validate(service)
+
+
+def test_integer_bool_left_to_cerberus():
+    # Cerberus takes a bool as an integer: the compiled check leaves it the decision
+    service = {"name": "web", "cmd": "sleep 1000", "numprocs": True}
+    assert not checkService(service)